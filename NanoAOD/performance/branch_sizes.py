@@ -0,0 +1,394 @@
+#
+# Output size accounting for NanoAOD files
+#
+# Compressed and uncompressed bytes of each branch of the Events tree
+# are attributed to flat tables and to the cff PSets where the table
+# variables are defined, ex. mm_kin_pv2_alpha comes from
+# kinematic_displacement_pset of DileptonPlusX_cff.py. Branches are
+# ranked by their size per event and per selected candidate, and the
+# savings from dropping them or from reducing the float precision are
+# estimated.
+#
+# The cff files are parsed as text, so CMSSW is not needed. The parser
+# understands the patterns used in BmmScout cff files: Var definitions
+# in cms.PSet, merge_psets, copy_pset with renaming, make_track_info_pset
+# and fix_parameter_names. Variables that cannot be traced are assigned
+# to the variables PSet of their table.
+#
+# Precision savings are estimated by rounding the mantissa of a sample
+# of values the same way NanoAOD does for Var(..., precision=N) and
+# compressing the sample with and without rounding using the file
+# compression algorithm (LZMA or ZLIB for the others).
+#
+import glob
+import lzma
+import os
+import re
+import zlib
+import numpy
+
+cff_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python")
+
+default_bits = [10, 14]
+
+
+## cff parsing
+
+_var_re = re.compile(r"(\w+)\s*=\s*Var\(")
+_fvar_re = re.compile(r"f[\"']\{(\w+)\}(\w+)[\"']\s*:\s*Var\(")
+_copy_re = re.compile(r"copy_pset\(\s*(\w+)\s*,\s*\{([^}]*)\}\s*\)")
+_replace_re = re.compile(r"[\"']([^\"']*)[\"']\s*:\s*[\"']([^\"']*)[\"']")
+_call_re = re.compile(r"(\w+)\(\s*[\"'](\w*)[\"']\s*\)")
+
+
+def _statements(path):
+    """Top level assignments and function definitions of a python file"""
+    statements = []
+    with open(path) as f:
+        for line in f:
+            match = re.search(r"^(?:def\s+(\w+)|(\w+)\s*=)", line)
+            if match:
+                statements.append([match.group(1) or match.group(2),
+                                   match.group(1) != None, line])
+            elif len(statements) > 0 and not re.search(r"^\S", line.rstrip() or " "):
+                statements[-1][2] += line
+            elif len(statements) > 0 and re.search(r"^[\)\]\}]", line):
+                statements[-1][2] += line
+    return statements
+
+
+def _fix_parameter_names(variables):
+    result = dict()
+    for name, origin in variables.items():
+        if "el1_" in name:
+            name = name.replace("el1_", "el_")
+        elif "mu2_" in name:
+            name = name.replace("mu2_", "mu_")
+        result[name] = origin
+    return result
+
+
+def parse_cff(path):
+    """Flat tables of a cff file and the origin of their variables
+
+    Returns a map between table names and lists of (producer, variables)
+    where variables maps variable names to their origin PSet.
+    """
+    cff = os.path.splitext(os.path.basename(path))[0]
+    psets = dict()
+    functions = dict()
+    tables = dict()
+    for name, is_function, text in _statements(path):
+        if is_function:
+            variables = [m.groups() for m in _fvar_re.finditer(text)]
+            if len(variables) > 0:
+                functions[name] = variables
+            continue
+        variables = dict()
+        # renamed copies
+        for match in _copy_re.finditer(text):
+            source = psets.get(match.group(1), {})
+            replacements = _replace_re.findall(match.group(2))
+            for var, origin in source.items():
+                for pattern, repl in replacements:
+                    var = re.sub(pattern, repl, var)
+                variables[var] = origin
+        remaining = _copy_re.sub("", text)
+        # generated PSets
+        for match in _call_re.finditer(remaining):
+            if match.group(1) in functions:
+                for argument, suffix in functions[match.group(1)]:
+                    variables[match.group(2) + suffix] = "%s.%s" % (cff, match.group(1))
+        # included PSets
+        for identifier in set(re.findall(r"\b(\w+)\b", remaining)):
+            if identifier != name and identifier in psets:
+                variables.update(psets[identifier])
+        # direct definitions
+        for var in _var_re.findall(remaining):
+            variables[var] = "%s.%s" % (cff, name)
+        if re.search(r"^\s*\w+\s*=\s*fix_parameter_names\(", text):
+            variables = _fix_parameter_names(variables)
+        if len(variables) > 0:
+            psets[name] = variables
+
+        if re.search(r"FlatTableProducer", text):
+            match = re.search(r"\bname\s*=\s*cms\.string\(\s*[\"'](\w+)[\"']", text)
+            if match:
+                tables.setdefault(match.group(1), []).append(("%s.%s" % (cff, name), variables))
+    return tables
+
+
+def load_tables(cff_files=None):
+    """Map between table names and (cff producer, variables) of all cff files"""
+    if cff_files == None:
+        cff_files = sorted(glob.glob(os.path.join(cff_dir, "*_cff.py")))
+    tables = dict()
+    for path in cff_files:
+        for table, producers in parse_cff(path).items():
+            tables.setdefault(table, []).extend(producers)
+    return tables
+
+
+## Branch sizes
+
+class BranchSize(object):
+    def __init__(self, name, type_name, table, counter, zip_bytes, tot_bytes):
+        self.name = name
+        self.type_name = type_name
+        self.table = table
+        self.counter = counter
+        self.zip_bytes = zip_bytes
+        self.tot_bytes = tot_bytes
+        self.origin = None
+        self.producer = None
+        # estimated compressed bytes saved with reduced precision by number of bits
+        self.precision_savings = dict()
+
+    @property
+    def variable(self):
+        if self.name.startswith(self.table + "_"):
+            return self.name[len(self.table) + 1:]
+        return self.name
+
+
+def _table_name(name, counter):
+    if counter:
+        return re.sub(r"^n", "", counter)
+    match = re.search(r"^n([A-Za-z0-9]+)$", name)
+    if match:
+        return match.group(1)
+    return name.split("_")[0]
+
+
+def read_branch_sizes(tree):
+    """Sizes of all branches of a tree"""
+    branches = []
+    for br in tree.GetListOfBranches():
+        name = br.GetName()
+        leaf = br.GetLeaf(name)
+        counter = None
+        type_name = None
+        if leaf:
+            type_name = leaf.GetTypeName()
+            if leaf.GetLeafCount():
+                counter = leaf.GetLeafCount().GetName()
+        branches.append(BranchSize(name, type_name, _table_name(name, counter), counter,
+                                   br.GetZipBytes("*"), br.GetTotBytes("*")))
+    return branches
+
+
+def assign_origins(branches, tables):
+    """Find producers and origin PSets of branches
+
+    If several producers make a table with the same name (data and MC
+    versions, scouting), the one with the largest overlap with the
+    branches in the file is used.
+    """
+    by_table = dict()
+    for b in branches:
+        by_table.setdefault(b.table, []).append(b)
+    for table, table_branches in by_table.items():
+        if table not in tables:
+            for b in table_branches:
+                b.origin = "other"
+            continue
+        variables = set(b.variable for b in table_branches)
+        producer, definitions = max(tables[table], key=lambda p: len(variables & set(p[1])))
+        for b in table_branches:
+            b.producer = producer
+            if b.counter == None and b.name == "n" + table:
+                b.origin = "%s counter" % producer
+            elif b.variable in definitions:
+                b.origin = definitions[b.variable]
+            else:
+                b.origin = "%s (untraced)" % producer
+
+
+def count_candidates(tree, counters):
+    """Total number of candidates for each counter branch"""
+    import ROOT
+    df = ROOT.RDataFrame(tree)
+    sums = dict((c, df.Sum(c)) for c in counters)
+    return dict((c, s.GetValue()) for c, s in sums.items())
+
+
+## Precision
+
+def reduce_precision(values, bits):
+    """Round float32 mantissa to bits like Var(..., precision=bits) in NanoAOD"""
+    values = numpy.ascontiguousarray(values, dtype=numpy.float32)
+    shift = 23 - bits
+    if shift <= 0:
+        return values
+    words = values.view(numpy.uint32)
+    mantissa = (words & numpy.uint32(0x007FFFFF)) >> numpy.uint32(shift)
+    round_up = ((words & numpy.uint32(1 << (shift - 1))) != 0) & (mantissa < (1 << bits) - 2)
+    mantissa = mantissa + round_up.astype(numpy.uint32)
+    words = (words & numpy.uint32(0xFF800000)) | (mantissa << numpy.uint32(shift))
+    # keep inf and nan as they are
+    return numpy.where(numpy.isfinite(values), words.view(numpy.float32), values)
+
+
+def _compressed_size(data, algorithm):
+    if algorithm == 2:
+        return len(lzma.compress(data, preset=9))
+    return len(zlib.compress(data, 9))
+
+
+def precision_saving_fraction(values, bits, algorithm):
+    """Fraction of compressed bytes saved by rounding values to bits"""
+    values = numpy.asarray(values, dtype=numpy.float32)
+    if len(values) == 0:
+        return 0.
+    full = _compressed_size(values.astype('>f4').tobytes(), algorithm)
+    reduced = _compressed_size(reduce_precision(values, bits).astype('>f4').tobytes(), algorithm)
+    return max(0., 1. - float(reduced) / full)
+
+
+def read_values(tree, branches, n_events):
+    """Flattened values of branches for the first n_events"""
+    import ROOT
+    df = ROOT.RDataFrame(tree).Range(n_events)
+    data = df.AsNumpy([b.name for b in branches])
+    values = dict()
+    for b in branches:
+        column = data[b.name]
+        if len(column) > 0 and column.dtype == object:
+            values[b.name] = numpy.concatenate([numpy.asarray(v, dtype=numpy.float32) for v in column] +
+                                               [numpy.zeros(0, dtype=numpy.float32)])
+        else:
+            values[b.name] = numpy.asarray(column, dtype=numpy.float32)
+    return values
+
+
+def estimate_precision_savings(tree, branches, algorithm, bits=default_bits, n_events=2000):
+    for b in branches:
+        b.precision_savings = dict()
+    if len(branches) == 0:
+        return
+    values = read_values(tree, branches, n_events)
+    for b in branches:
+        for nbits in bits:
+            b.precision_savings[nbits] = b.zip_bytes * \
+                precision_saving_fraction(values[b.name], nbits, algorithm)
+
+
+## Report
+
+class SizeReport(object):
+    """Branch sizes of the Events tree of a NanoAOD file"""
+
+    def __init__(self, path, cff_files=None, tree_name="Events"):
+        import ROOT
+        self.path = path
+        self.file = ROOT.TFile.Open(path)
+        if not self.file or self.file.IsZombie():
+            raise Exception("Cannot open %s" % path)
+        self.tree = self.file.Get(tree_name)
+        if not self.tree:
+            raise Exception("%s doesn't have %s tree" % (path, tree_name))
+        self.nevents = self.tree.GetEntries()
+        self.file_size = os.path.getsize(path) if os.path.exists(path) else self.file.GetSize()
+        self.algorithm = self.file.GetCompressionAlgorithm()
+        self.branches = read_branch_sizes(self.tree)
+        assign_origins(self.branches, load_tables(cff_files))
+        self._candidates = None
+
+    @property
+    def candidates(self):
+        """Total number of candidates by counter branch"""
+        if self._candidates == None:
+            counters = sorted(set(b.counter for b in self.branches if b.counter))
+            self._candidates = count_candidates(self.tree, counters)
+        return self._candidates
+
+    def float_branches(self, bmm_only=True):
+        return [b for b in self.branches if b.type_name == "Float_t" and
+                (not bmm_only or b.producer != None)]
+
+    def estimate_precision_savings(self, top=50, bits=default_bits, n_events=2000):
+        """Estimate precision savings for the largest float branches"""
+        branches = sorted(self.float_branches(), key=lambda b: b.zip_bytes, reverse=True)[:top]
+        estimate_precision_savings(self.tree, branches, self.algorithm, bits, n_events)
+        return branches
+
+    def candidates_per_event(self, b):
+        if b.counter == None:
+            return 1.
+        return float(self.candidates.get(b.counter, 0)) / self.nevents
+
+    def bytes_per_candidate(self, b):
+        if b.counter == None:
+            return b.zip_bytes / float(self.nevents)
+        return b.zip_bytes / max(1., float(self.candidates.get(b.counter, 0)))
+
+    def group(self, key):
+        """Compressed and uncompressed bytes and number of branches by key"""
+        groups = dict()
+        for b in self.branches:
+            name = key(b)
+            info = groups.setdefault(name, {'zip_bytes': 0, 'tot_bytes': 0, 'branches': 0, 'counter': b.counter})
+            info['zip_bytes'] += b.zip_bytes
+            info['tot_bytes'] += b.tot_bytes
+            info['branches'] += 1
+            if b.counter:
+                info['counter'] = b.counter
+        return groups
+
+    def table_sizes(self):
+        """Compressed kB per event by table"""
+        return dict((table, info['zip_bytes'] / 1024. / self.nevents)
+                    for table, info in self.group(lambda b: b.table).items())
+
+    def print_report(self, top=30, bits=default_bits):
+        nevents = float(self.nevents)
+        total_zip = sum(b.zip_bytes for b in self.branches)
+        total_tot = sum(b.tot_bytes for b in self.branches)
+        print("File: %s" % self.path)
+        print("Events: %u, file size: %0.1f kB/event, Events tree: %0.2f kB/event compressed, %0.2f kB/event uncompressed" %
+              (self.nevents, self.file_size / 1024. / nevents, total_zip / 1024. / nevents, total_tot / 1024. / nevents))
+
+        print("\nTables:")
+        print("\t%-24s\t%8s\t%10s\t%12s\t%12s\t%8s\t%12s\t%6s" %
+              ("Table", "Branches", "Cands/evt", "kB/evt zip", "kB/evt raw", "Ratio", "B/cand zip", "%"))
+        tables = self.group(lambda b: b.table)
+        for table in sorted(tables, key=lambda t: tables[t]['zip_bytes'], reverse=True):
+            info = tables[table]
+            ncands = self.candidates.get(info['counter'], nevents) if info['counter'] else nevents
+            print("\t%-24s\t%8u\t%10.2f\t%12.3f\t%12.3f\t%8.2f\t%12.1f\t%6.1f" %
+                  (table, info['branches'], ncands / nevents, info['zip_bytes'] / 1024. / nevents,
+                   info['tot_bytes'] / 1024. / nevents, info['tot_bytes'] / max(1., info['zip_bytes']),
+                   info['zip_bytes'] / max(1., ncands), 100. * info['zip_bytes'] / total_zip))
+
+        print("\nOrigins:")
+        print("\t%-60s\t%8s\t%12s\t%12s\t%6s" % ("cff.PSet", "Branches", "kB/evt zip", "kB/evt raw", "%"))
+        origins = self.group(lambda b: b.origin)
+        for origin in sorted(origins, key=lambda o: origins[o]['zip_bytes'], reverse=True):
+            info = origins[origin]
+            print("\t%-60s\t%8u\t%12.3f\t%12.3f\t%6.1f" %
+                  (origin, info['branches'], info['zip_bytes'] / 1024. / nevents,
+                   info['tot_bytes'] / 1024. / nevents, 100. * info['zip_bytes'] / total_zip))
+
+        print("\nMost expensive Bmm branches per selected candidate:")
+        print("\t%-40s\t%-8s\t%12s\t%12s\t%12s\t%s" %
+              ("Branch", "Type", "B/cand zip", "B/evt zip", "B/evt raw", "Origin"))
+        bmm = [b for b in self.branches if b.producer != None]
+        for b in sorted(bmm, key=self.bytes_per_candidate, reverse=True)[:top]:
+            print("\t%-40s\t%-8s\t%12.2f\t%12.2f\t%12.2f\t%s" %
+                  (b.name, b.type_name, self.bytes_per_candidate(b), b.zip_bytes / nevents,
+                   b.tot_bytes / nevents, b.origin))
+
+        estimated = [b for b in self.branches if len(b.precision_savings) > 0]
+        if len(estimated) == 0:
+            return
+        print("\nEstimated savings in kB/event (drop: remove the branch, N bits: Var precision=N):")
+        print("\t%-40s\t%12s\t%12s" % ("Branch", "kB/evt zip", "drop") +
+              "".join("\t%12s" % ("%u bits" % n) for n in bits))
+        estimated.sort(key=lambda b: b.precision_savings.get(bits[0], 0), reverse=True)
+        for b in estimated:
+            print("\t%-40s\t%12.4f\t%12.4f" % (b.name, b.zip_bytes / 1024. / nevents, b.zip_bytes / 1024. / nevents) +
+                  "".join("\t%12.4f" % (b.precision_savings.get(n, 0) / 1024. / nevents) for n in bits))
+        print("\t%-40s\t%12.4f\t%12.4f" % ("Total", sum(b.zip_bytes for b in estimated) / 1024. / nevents,
+                                           sum(b.zip_bytes for b in estimated) / 1024. / nevents) +
+              "".join("\t%12.4f" % (sum(b.precision_savings.get(n, 0) for b in estimated) / 1024. / nevents)
+                      for n in bits))
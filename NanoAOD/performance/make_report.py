@@ -1,90 +1,255 @@
 #!/usr/bin/env python3
+"""Performance report for cmsRun logs with TimeReport and MemoryCheck output
+
+Usage:
+    make_report.py <log file>
+        print the report
+    make_report.py store <log file> <version> <config> [--output <NanoAOD file>]
+        parse the log and store it in the history database
+    make_report.py compare <log file> <baseline version> <config> [--output <NanoAOD file>]
+    make_report.py compare <version> <baseline version> <config>
+        compare a new or stored report with a stored baseline
+    make_report.py history [config]
+        list stored reports
+    make_report.py import <README.md>
+        import the result tables of the README into the history database
+    make_report.py sizes <NanoAOD file> [--top N] [--precision-top N] [--bits 10,14]
+        output size by branch, table and cff PSet with savings estimates
+
+See performance_history.py for the database and the thresholds and
+branch_sizes.py for the output size accounting.
+"""
+import argparse
+import os
 import sys
 import re
 
-if len(sys.argv) != 2:
-    print("Usage:\n\t%s <log file>\n" % sys.argv[0])
-    sys.exit()
-
-nanoaod_block = dict()
-total_time = None
-loop_time = None
-block_time = dict()
-nevents = None
-max_rss = None
-with open(sys.argv[1]) as logfile:
-    timereport_block = None
-    for line in logfile:
-        match = re.search('^MemoryCheck.*?RSS\s+(\S+)', line)
-        if match:
-            rss = float(match.group(1))
-            if not max_rss or max_rss < rss:
-                max_rss = rss
-            continue
-        match = re.search('TrigReport Events total = (\d+)', line)
-        if match:
-            nevents = int(match.group(1))
-            continue
-        match = re.search('TimeReport> Time report complete in\s+(\S+)', line)
-        if match:
-            total_time = float(match.group(1))
-            continue
-        match = re.search('Total loop:\s+(\S+)', line)
-        if match:
-            loop_time = float(match.group(1))
-            continue
-        match = re.search('^TimeReport\s*\-+\s*(\S.*?)\s*\-\-', line)
-        if match:
-            timereport_block = match.group(1)
-            continue
-        if timereport_block == 'Modules in Path: nanoAOD_step':
-            match = re.search('^TimeReport\s+([\d\.]+)\s+([\d\.]+)\s+(\S+)', line)
+bmm_module_patterns = ['BxToMuMu', 'ForMuonFake', 'BmmMuonId', 'Dileptons']
+
+
+def parse_log(path):
+    """Extract time, memory and per module information from a cmsRun log"""
+    nanoaod_block = dict()
+    module_rss = dict()
+    total_time = None
+    loop_time = None
+    block_time = dict()
+    nevents = None
+    max_rss = None
+    with open(path) as logfile:
+        timereport_block = None
+        for line in logfile:
+            match = re.search(r'^MemoryCheck.*?RSS\s+(\S+)', line)
+            if match:
+                rss = float(match.group(1))
+                if not max_rss or max_rss < rss:
+                    max_rss = rss
+                # memory growth attributed to a module
+                match = re.search(r'^MemoryCheck: module \S+?:(\S+)\s+VSIZE.*?RSS\s+\S+\s+(\S+)', line)
+                if match:
+                    module = match.group(1)
+                    module_rss[module] = module_rss.get(module, 0) + float(match.group(2))
+                continue
+            match = re.search(r'TrigReport Events total = (\d+)', line)
             if match:
-                nanoaod_block[match.group(3)] = float(match.group(1))
-        match = re.search('^TimeReport\s+([\d\.]+)', line)
-        if match:
-            if timereport_block not in block_time:
-                block_time[timereport_block] = 0
-            block_time[timereport_block] += float(match.group(1))
-            
-print("Max RSS: %f" % max_rss)
-print("Total time: %0.1f sec" % total_time)
-print("Total event loop time: %0.1f sec" % loop_time)
-if loop_time/total_time < 0.90:
-    print("WARNING: overhead is %0.0f%% of total time" % (100.*(1-loop_time/total_time)))
-    print("Consider running more events for more reliable results")
-
-print("Time per event (total time): %0.3f sec" % (total_time/nevents))
-print("Time per event (event loop time): %0.3f sec\n" % (loop_time/nevents))
-
-nanoaod_block_time_per_event = 0
-for module, time in nanoaod_block.items():
-    nanoaod_block_time_per_event += time
-print("nanoAOD_step path time per event: %0.3f sec" % nanoaod_block_time_per_event)
+                nevents = int(match.group(1))
+                continue
+            match = re.search(r'TimeReport> Time report complete in\s+(\S+)', line)
+            if match:
+                total_time = float(match.group(1))
+                continue
+            match = re.search(r'Total loop:\s+(\S+)', line)
+            if match:
+                loop_time = float(match.group(1))
+                continue
+            match = re.search(r'^TimeReport\s*\-+\s*(\S.*?)\s*\-\-', line)
+            if match:
+                timereport_block = match.group(1)
+                continue
+            if timereport_block == 'Modules in Path: nanoAOD_step':
+                match = re.search(r'^TimeReport\s+([\d\.]+)\s+([\d\.]+)\s+(\S+)', line)
+                if match:
+                    nanoaod_block[match.group(3)] = float(match.group(1))
+            match = re.search(r'^TimeReport\s+([\d\.]+)', line)
+            if match:
+                if timereport_block not in block_time:
+                    block_time[timereport_block] = 0
+                block_time[timereport_block] += float(match.group(1))
 
-bmm_module_patterns = ['BxToMuMu', 'ForMuonFake', 'BmmMuonId', 'Dileptons']
+    if max_rss == None or total_time == None or loop_time == None or not nevents:
+        raise Exception("%s doesn't have complete TimeReport and MemoryCheck information" % path)
+
+    return {
+        'log': os.path.abspath(path),
+        'nevents': nevents,
+        'total_time': total_time,
+        'loop_time': loop_time,
+        'max_rss': max_rss,
+        'size_per_event': None,
+        'modules': nanoaod_block,
+        'module_rss': module_rss,
+        'block_time': block_time,
+    }
 
-print("Bmm modules:")
-for module in sorted(nanoaod_block, key=nanoaod_block.get, reverse=True):
-    report_module = False
+
+def add_output_size(report, path):
+    """Output size per event in kB, per table if ROOT is available"""
+    report['size_per_event'] = os.path.getsize(path) / 1024. / report['nevents']
+    try:
+        import branch_sizes
+        report['table_size'] = branch_sizes.SizeReport(path).table_sizes()
+    except ImportError:
+        print("ROOT is not available, skip table sizes")
+    return report
+
+
+def is_bmm_module(module):
     for pattern in bmm_module_patterns:
         if re.search(pattern, module):
-            report_module = True
-            break
-    if not report_module:
-        continue
-    time = nanoaod_block[module]
-    print("\t%-60s\t%0.4f (%4.1f%%)" % (module, time, 100.*time/nanoaod_block_time_per_event))
-
-show_top = 10
-print("Top contributors:")
-for module in sorted(nanoaod_block, key=nanoaod_block.get, reverse=True):
-    time = nanoaod_block[module]
-    if show_top > 0:
+            return True
+    return False
+
+
+def print_report(report):
+    nanoaod_block = report['modules']
+    total_time = report['total_time']
+    loop_time = report['loop_time']
+    nevents = report['nevents']
+
+    print("Max RSS: %f" % report['max_rss'])
+    print("Total time: %0.1f sec" % total_time)
+    print("Total event loop time: %0.1f sec" % loop_time)
+    if loop_time/total_time < 0.90:
+        print("WARNING: overhead is %0.0f%% of total time" % (100.*(1-loop_time/total_time)))
+        print("Consider running more events for more reliable results")
+
+    print("Time per event (total time): %0.3f sec" % (total_time/nevents))
+    print("Time per event (event loop time): %0.3f sec\n" % (loop_time/nevents))
+    if report.get('size_per_event') != None:
+        print("Output size per event: %0.1f kB\n" % report['size_per_event'])
+
+    nanoaod_block_time_per_event = 0
+    for module, time in nanoaod_block.items():
+        nanoaod_block_time_per_event += time
+    print("nanoAOD_step path time per event: %0.3f sec" % nanoaod_block_time_per_event)
+
+    print("Bmm modules:")
+    for module in sorted(nanoaod_block, key=nanoaod_block.get, reverse=True):
+        if not is_bmm_module(module):
+            continue
+        time = nanoaod_block[module]
         print("\t%-60s\t%0.4f (%4.1f%%)" % (module, time, 100.*time/nanoaod_block_time_per_event))
-        show_top -= 1
 
-# print("Block time:")
-# for block in sorted(block_time, key=block_time.get, reverse=True):
-#    time = block_time[block]
-#    print("\t%-30s\t%0.4f (%4.1f%%)" % (block, time, 100.*time/total_time*nevents))
+    show_top = 10
+    print("Top contributors:")
+    for module in sorted(nanoaod_block, key=nanoaod_block.get, reverse=True):
+        time = nanoaod_block[module]
+        if show_top > 0:
+            print("\t%-60s\t%0.4f (%4.1f%%)" % (module, time, 100.*time/nanoaod_block_time_per_event))
+            show_top -= 1
+
+    # print("Block time:")
+    # for block in sorted(block_time, key=block_time.get, reverse=True):
+    #    time = block_time[block]
+    #    print("\t%-30s\t%0.4f (%4.1f%%)" % (block, time, 100.*time/total_time*nevents))
+
+
+def _read_report(path, output):
+    report = parse_log(path)
+    if output:
+        add_output_size(report, output)
+    return report
+
+
+def main(argv):
+    if len(argv) == 1 and os.path.exists(argv[0]):
+        print_report(parse_log(argv[0]))
+        return 0
+
+    import performance_history
+
+    parser = argparse.ArgumentParser(description="NanoAOD performance reports and regression tests")
+    parser.add_argument('--db', default=performance_history.default_db,
+                        help="history database (default: %(default)s)")
+    parser.add_argument('--thresholds', default=None,
+                        help="JSON file with thresholds overriding the defaults")
+    commands = parser.add_subparsers(dest='command')
+
+    store = commands.add_parser('store', help="store a parsed log in the history database")
+    store.add_argument('log')
+    store.add_argument('version')
+    store.add_argument('config')
+    store.add_argument('--output', help="NanoAOD file produced by the job to measure output size")
+
+    compare = commands.add_parser('compare', help="compare a report with a baseline")
+    compare.add_argument('report', help="log file or stored version")
+    compare.add_argument('baseline', help="stored baseline version")
+    compare.add_argument('config')
+    compare.add_argument('--output', help="NanoAOD file produced by the job to measure output size")
+
+    history = commands.add_parser('history', help="list stored reports")
+    history.add_argument('config', nargs='?')
+
+    readme = commands.add_parser('import', help="import README result tables")
+    readme.add_argument('readme')
+
+    sizes = commands.add_parser('sizes', help="output size by branch, table and cff PSet")
+    sizes.add_argument('file', help="NanoAOD file")
+    sizes.add_argument('--top', type=int, default=30, help="number of branches to show")
+    sizes.add_argument('--precision-top', type=int, default=50,
+                       help="number of largest float branches to estimate precision savings for")
+    sizes.add_argument('--bits', default="10,14", help="mantissa bits to estimate savings for")
+    sizes.add_argument('--events', type=int, default=2000,
+                       help="number of events used to estimate precision savings")
+
+    args = parser.parse_args(argv)
+    if args.command == 'sizes':
+        import branch_sizes
+        bits = [int(n) for n in args.bits.split(",")]
+        report = branch_sizes.SizeReport(args.file)
+        if args.precision_top > 0:
+            report.estimate_precision_savings(args.precision_top, bits, args.events)
+        report.print_report(args.top, bits)
+        return 0
+
+    db = performance_history.PerformanceHistory(args.db)
+    if args.command == 'store':
+        report = _read_report(args.log, args.output)
+        print_report(report)
+        db.store(args.version, args.config, report)
+        print("\nStored %s/%s in %s" % (args.version, args.config, args.db))
+    elif args.command == 'compare':
+        if os.path.exists(args.report):
+            report = _read_report(args.report, args.output)
+            version = os.path.basename(args.report)
+        else:
+            report = db.get(args.report, args.config)
+            version = args.report
+            if report == None:
+                print("No report for %s/%s in %s" % (args.report, args.config, args.db))
+                return 2
+        baseline = db.get(args.baseline, args.config)
+        if baseline == None:
+            print("No baseline %s/%s in %s" % (args.baseline, args.config, args.db))
+            return 2
+        thresholds = performance_history.load_thresholds(args.thresholds)
+        diff = performance_history.compare(report, baseline, thresholds)
+        performance_history.print_diff(diff, version, args.baseline, args.config)
+        # non-zero exit code for regressions to be usable in scripts
+        return 1 if any(entry['regression'] for entry in diff) else 0
+    elif args.command == 'history':
+        performance_history.print_history(db, args.config)
+    elif args.command == 'import':
+        n = performance_history.import_readme(db, args.readme)
+        print("Imported %u reports from %s into %s" % (n, args.readme, args.db))
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit()
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,344 @@
+#
+# History of NanoAOD performance reports
+#
+# Parsed make_report.py results are kept in a SQLite database keyed by
+# version (ex. NanoAODv14-V02 or a production version) and config (ex.
+# BsToMuMu_BMuonFilter). New reports are compared with a stored baseline
+# and changes above the thresholds are reported as regressions together
+# with the modules responsible for them. Everything works from the
+# stored logs, no grid access is needed.
+#
+import sqlite3
+import json
+import os
+import re
+import time
+
+default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), "performance_history.db")
+
+# Allowed increase with respect to the baseline as (relative, absolute).
+# A change is a regression if it exceeds both, so that small modules
+# and timing noise don't produce false alarms.
+default_thresholds = {
+    'time_per_event': (0.05, 0.002),    # sec/event, event loop time
+    'max_rss':        (0.05, 20.),      # MB
+    'size_per_event': (0.05, 0.1),      # kB/event
+    'module_time':    (0.10, 0.001),    # sec/event
+    'module_rss':     (0.10, 5.),       # MB, memory growth attributed to the module
+    'table_size':     (0.05, 0.05),     # kB/event, compressed size of a flat table
+}
+
+# Module specific thresholds: regular expression for the module label
+# or table name and thresholds for module_time, module_rss or table_size
+module_thresholds = {
+}
+
+metric_units = {
+    'time_per_event': 'sec/event',
+    'max_rss':        'MB',
+    'size_per_event': 'kB/event',
+    'module_time':    'sec/event',
+    'module_rss':     'MB',
+    'table_size':     'kB/event',
+}
+
+
+def load_thresholds(path=None):
+    """Default thresholds updated with a JSON file
+
+    File format:
+    {
+      "metrics": {"time_per_event": [0.05, 0.002], ...},
+      "modules": {"BxToMuMu": {"module_time": [0.2, 0.005]}, ...}
+    }
+    """
+    thresholds = {'metrics': dict(default_thresholds), 'modules': dict(module_thresholds)}
+    if path:
+        with open(path) as f:
+            info = json.load(f)
+        for metric, value in info.get('metrics', {}).items():
+            if metric not in default_thresholds:
+                raise Exception("Unknown metric %s in %s" % (metric, path))
+            thresholds['metrics'][metric] = tuple(value)
+        for pattern, values in info.get('modules', {}).items():
+            thresholds['modules'][pattern] = dict((m, tuple(v)) for m, v in values.items())
+    return thresholds
+
+
+class PerformanceHistory(object):
+    """SQLite store of parsed performance reports"""
+
+    def __init__(self, path=default_db):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=600)
+        with self.connection:
+            self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS reports (
+                version TEXT,
+                config TEXT,
+                created REAL,
+                log TEXT,
+                nevents INTEGER,
+                total_time REAL,
+                loop_time REAL,
+                time_per_event REAL,
+                max_rss REAL,
+                size_per_event REAL,
+                PRIMARY KEY (version, config)
+            );
+            CREATE TABLE IF NOT EXISTS modules (
+                version TEXT,
+                config TEXT,
+                module TEXT,
+                time REAL,
+                rss REAL,
+                PRIMARY KEY (version, config, module)
+            );
+            CREATE TABLE IF NOT EXISTS tables (
+                version TEXT,
+                config TEXT,
+                name TEXT,
+                size REAL,
+                PRIMARY KEY (version, config, name)
+            );
+            """)
+
+    def store(self, version, config, report):
+        """Store or replace a report"""
+        metrics = report_metrics(report)
+        with self.connection:
+            self.connection.execute("DELETE FROM modules WHERE version=? AND config=?", (version, config))
+            self.connection.execute("DELETE FROM tables WHERE version=? AND config=?", (version, config))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO reports (version, config, created, log, nevents, total_time, "
+                "loop_time, time_per_event, max_rss, size_per_event) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (version, config, time.time(), report.get('log'), report.get('nevents'),
+                 report.get('total_time'), report.get('loop_time'), metrics['time_per_event'],
+                 metrics['max_rss'], metrics['size_per_event']))
+            modules = report.get('modules', {})
+            module_rss = report.get('module_rss', {})
+            for module in set(modules) | set(module_rss):
+                self.connection.execute(
+                    "INSERT INTO modules (version, config, module, time, rss) VALUES (?, ?, ?, ?, ?)",
+                    (version, config, module, modules.get(module), module_rss.get(module)))
+            for table, size in report.get('table_size', {}).items():
+                self.connection.execute("INSERT INTO tables (version, config, name, size) VALUES (?, ?, ?, ?)",
+                                        (version, config, table, size))
+
+    def get(self, version, config):
+        """Stored report in the make_report.parse_log format or None"""
+        row = self.connection.execute(
+            "SELECT log, nevents, total_time, loop_time, time_per_event, max_rss, size_per_event "
+            "FROM reports WHERE version=? AND config=?", (version, config)).fetchone()
+        if row == None:
+            return None
+        report = dict(zip(['log', 'nevents', 'total_time', 'loop_time', 'time_per_event',
+                           'max_rss', 'size_per_event'], row))
+        report['modules'] = dict()
+        report['module_rss'] = dict()
+        rows = self.connection.execute("SELECT module, time, rss FROM modules WHERE version=? AND config=?",
+                                       (version, config))
+        for module, module_time, rss in rows:
+            if module_time != None:
+                report['modules'][module] = module_time
+            if rss != None:
+                report['module_rss'][module] = rss
+        rows = self.connection.execute("SELECT name, size FROM tables WHERE version=? AND config=?",
+                                       (version, config))
+        report['table_size'] = dict(rows.fetchall())
+        return report
+
+    def get_reports(self, config=None):
+        """Stored versions and configs ordered by creation time"""
+        if config == None:
+            rows = self.connection.execute("SELECT version, config, time_per_event, max_rss, size_per_event "
+                                           "FROM reports ORDER BY config, created")
+        else:
+            rows = self.connection.execute("SELECT version, config, time_per_event, max_rss, size_per_event "
+                                           "FROM reports WHERE config=? ORDER BY created", (config,))
+        return rows.fetchall()
+
+
+def report_metrics(report):
+    """Job level metrics of a report"""
+    time_per_event = report.get('time_per_event')
+    if time_per_event == None and report.get('loop_time') != None and report.get('nevents'):
+        time_per_event = report['loop_time'] / report['nevents']
+    return {
+        'time_per_event': time_per_event,
+        'max_rss': report.get('max_rss'),
+        'size_per_event': report.get('size_per_event'),
+    }
+
+
+def _module_threshold(thresholds, module, metric):
+    for pattern, values in thresholds['modules'].items():
+        if re.search(pattern, module) and metric in values:
+            return values[metric]
+    return thresholds['metrics'][metric]
+
+
+def _diff_entry(scope, metric, value, baseline, threshold):
+    delta = (value or 0) - (baseline or 0)
+    relative = delta / baseline if baseline else None
+    regression = delta > threshold[1] and (relative == None or relative > threshold[0])
+    return {'scope': scope, 'metric': metric, 'value': value, 'baseline': baseline,
+            'delta': delta, 'relative': relative, 'regression': regression}
+
+
+def compare(report, baseline, thresholds=None):
+    """Differences between a report and its baseline
+
+    Returns a list of entries with scope ('job', the module label or
+    the table name), metric, value, baseline, delta, relative change and
+    a regression flag.
+    Metrics missing in either report are skipped.
+    """
+    if thresholds == None:
+        thresholds = load_thresholds()
+    diff = []
+    metrics = report_metrics(report)
+    base_metrics = report_metrics(baseline)
+    for metric in ['time_per_event', 'max_rss', 'size_per_event']:
+        if metrics[metric] == None or base_metrics[metric] == None:
+            continue
+        diff.append(_diff_entry('job', metric, metrics[metric], base_metrics[metric],
+                                thresholds['metrics'][metric]))
+    for metric, key in [('module_time', 'modules'), ('module_rss', 'module_rss'),
+                        ('table_size', 'table_size')]:
+        values = report.get(key, {})
+        base_values = baseline.get(key, {})
+        # modules and tables are only compared if both reports have the information
+        if len(values) == 0 or len(base_values) == 0:
+            continue
+        for module in set(values) | set(base_values):
+            diff.append(_diff_entry(module, metric, values.get(module), base_values.get(module),
+                                    _module_threshold(thresholds, module, metric)))
+    return diff
+
+
+def _format_value(value):
+    if value == None:
+        return "-"
+    return "%0.4g" % value
+
+
+def _format_change(entry):
+    if entry['relative'] == None:
+        return "%+0.4g (new)" % entry['delta']
+    return "%+0.4g (%+0.1f%%)" % (entry['delta'], 100. * entry['relative'])
+
+
+def print_diff(diff, version, baseline_version, config, show_top=10):
+    """Print the comparison and the modules responsible for regressions"""
+    print("Performance of %s compared to %s for %s" % (version, baseline_version, config))
+    print("\t%-60s\t%12s\t%12s\t%s" % ("Metric", baseline_version[:12], version[:12], "Change"))
+    job_entries = [e for e in diff if e['scope'] == 'job']
+    for entry in job_entries:
+        print("\t%-60s\t%12s\t%12s\t%-24s%s" %
+              ("%s [%s]" % (entry['metric'], metric_units[entry['metric']]),
+               _format_value(entry['baseline']), _format_value(entry['value']),
+               _format_change(entry), "REGRESSION" if entry['regression'] else ""))
+
+    for metric in ['module_time', 'module_rss', 'table_size']:
+        entries = [e for e in diff if e['metric'] == metric]
+        if len(entries) == 0:
+            continue
+        entries.sort(key=lambda e: e['delta'], reverse=True)
+        print("\nLargest %s increase [%s]:" % (metric, metric_units[metric]))
+        shown = 0
+        for entry in entries:
+            if entry['delta'] <= 0:
+                break
+            if shown >= show_top and not entry['regression']:
+                continue
+            print("\t%-60s\t%12s\t%12s\t%-24s%s" %
+                  (entry['scope'], _format_value(entry['baseline']), _format_value(entry['value']),
+                   _format_change(entry), "REGRESSION" if entry['regression'] else ""))
+            shown += 1
+
+    regressions = [e for e in diff if e['regression']]
+    if len(regressions) == 0:
+        print("\nNo regressions found")
+        return
+    print("\nRegressions:")
+    for entry in regressions:
+        print("\t%s %s: %s" % (entry['scope'], entry['metric'], _format_change(entry)))
+    module_entries = [e for e in diff if e['scope'] != 'job']
+    if len(module_entries) == 0 and len(job_entries) > 0:
+        print("Module and table information is not available for one of the reports")
+
+
+def print_history(db, config=None):
+    print("\t%-20s\t%-30s\t%12s\t%12s\t%12s" % ("Version", "Config", "sec/event", "RSS, MB", "kB/event"))
+    for version, cfg, time_per_event, max_rss, size_per_event in db.get_reports(config):
+        print("\t%-20s\t%-30s\t%12s\t%12s\t%12s" %
+              (version, cfg, _format_value(time_per_event), _format_value(max_rss),
+               _format_value(size_per_event)))
+
+
+## README tables
+
+_readme_metrics = [
+    ('Time per event', 'time_per_event', r'([\d\.]+)\s*sec/event'),
+    ('File size per event', 'size_per_event', r'([\d\.]+)\s*kB/event'),
+    ('Memory Usage', 'max_rss', r'([\d\.]+)\s*kB'),
+]
+
+_readme_columns = {
+    'Reference NanoAOD': '_reference',
+    'NanoAOD + Customizations': '',
+}
+
+
+def import_readme(db, path):
+    """Import the result tables of the README as reports
+
+    Config names are the datasets with a _reference suffix for the
+    standard NanoAOD column. Older reports don't have module
+    information, but can be used as baselines for job level metrics.
+    Existing reports are not overwritten.
+    """
+    reports = dict()
+    dataset = None
+    metric = None
+    pattern = None
+    header = None
+    with open(path) as f:
+        for line in f:
+            match = re.search(r'^Dataset:\s*(\S+)', line) or re.search(r'^###\s+Data:\s*(.*?)\s*$', line)
+            if match:
+                dataset = re.sub(r'\s+', '_', match.group(1))
+                continue
+            if line.startswith('####'):
+                metric = None
+                header = None
+                for title, name, value_pattern in _readme_metrics:
+                    if title in line:
+                        metric, pattern = name, value_pattern
+                continue
+            if metric == None or dataset == None or not line.startswith('|'):
+                continue
+            cells = [c.strip() for c in line.strip().strip('|').split('|')]
+            if header == None:
+                header = cells
+                continue
+            if re.search(r'^-+$', cells[0]):
+                continue
+            version = cells[0]
+            for column, value in zip(header, cells):
+                if column not in _readme_columns:
+                    continue
+                match = re.search(pattern, value)
+                if not match:
+                    continue
+                key = (version, dataset + _readme_columns[column])
+                reports.setdefault(key, {'log': path})[metric] = float(match.group(1))
+
+    n = 0
+    for (version, config), report in reports.items():
+        if db.get(version, config) != None:
+            continue
+        db.store(version, config, report)
+        n += 1
+    return n
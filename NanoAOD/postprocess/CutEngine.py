@@ -0,0 +1,540 @@
+#
+# Compiled candidate selection for FlatNtuple processors
+#
+# Task cuts in postprocessing_cfg.py are written in a python-like
+# syntax with NanoAOD branch names, for example
+#
+#   "mm_mu1_index>=0 and Muon_softMva[mm_mu1_index] > 0.45"
+#
+# Historically the cut was turned into a string template and eval'd
+# for every candidate. CompiledCut parses the cut once and provides
+#   - select(tree, n) - indices of good candidates in the current event
+#   - evaluate(columns) - candidate mask for a batch of events stored
+#     as NumPy columns
+#
+import ast
+import builtins
+import math
+import re
+import time
+
+import numpy as np
+
+def parse_cut(cut, branches):
+    """Parse cut for keywords and add placeholders for tree and index
+
+    branches is a map between branch names and the name of their
+    counter branch. Scalar branches have an empty counter.
+    """
+
+    # replace ROOT style AND with the one that is acceptable for python
+    cut = re.sub(r'\&\&', ' and ', cut)
+
+    # tokenize the cut string into elements so that we can add the tree and element index
+    cut_list = re.split(r'([^\w\_]+)', cut)
+
+    parsed_cut = ""
+    for i in range(len(cut_list)):
+        if not re.search(r'^[\w\_]+$', cut_list[i]) or cut_list[i] not in branches:
+            # element is not a branch name, store and move on
+            parsed_cut += cut_list[i]
+        else:
+            # element is a branch name
+
+            # make an index formater for arrays
+            index = branches[cut_list[i]]
+            if index != "":
+                index = "[{" + index + "}]"
+
+            if i < len(cut_list)-1 and re.search(r'^\[', cut_list[i+1]):
+                parsed_cut += "{tree}." + cut_list[i]
+            else:
+                parsed_cut += "{tree}." + cut_list[i] + index
+    return parsed_cut
+
+def get_branch_counters(tree):
+    """Map between branch names and their counter branches"""
+    branches = dict()
+
+    # collect branch names, corresponding leafs and their event
+    # counter for arrays
+    for br in tree.GetListOfBranches():
+        name = br.GetName()
+        leaf = br.GetLeaf(name)
+        if leaf.GetLeafCount():
+            branches[name] = leaf.GetLeafCount().GetName()
+        else:
+            branches[name] = ""
+    return branches
+
+def load_columns(tree, branches):
+    """Read branches of a tree into flat NumPy columns
+
+    Array branches are concatenated over events. Their counter
+    branches are needed to interpret them and should be included in
+    the list.
+    """
+    from ROOT import RDataFrame
+
+    columns = dict()
+    data = RDataFrame(tree).AsNumpy(list(branches))
+    for name, values in data.items():
+        if values.dtype == object:
+            arrays = [np.asarray(v) for v in values]
+            if len(arrays) > 0:
+                columns[name] = np.concatenate(arrays)
+            else:
+                columns[name] = np.empty(0)
+        else:
+            columns[name] = values
+    return columns
+
+
+class CompiledCut(object):
+    """Candidate selection compiled once from a task cut"""
+
+    # python functions allowed in the cut and their NumPy equivalents
+    functions = {
+        'abs': np.abs,
+        'min': np.minimum,
+        'max': np.maximum,
+    }
+
+    comparisons = {
+        ast.Lt: np.less,
+        ast.LtE: np.less_equal,
+        ast.Gt: np.greater,
+        ast.GtE: np.greater_equal,
+        ast.Eq: np.equal,
+        ast.NotEq: np.not_equal,
+    }
+
+    operators = {
+        ast.Add: np.add,
+        ast.Sub: np.subtract,
+        ast.Mult: np.multiply,
+        ast.Div: np.true_divide,
+        ast.FloorDiv: np.floor_divide,
+        ast.Mod: np.mod,
+        ast.Pow: np.power,
+        ast.BitAnd: np.bitwise_and,
+        ast.BitOr: np.bitwise_or,
+    }
+
+    def __init__(self, cut, branches, index):
+        """Compile the cut
+
+        cut      - selection in the postprocessing_cfg.py syntax
+        branches - map between branch names and their counter branches
+        index    - counter branch of the candidates, ex. nmm
+        """
+        self.cut = cut
+        self.branches = branches
+        self.index = index
+        self.parsed_cut = parse_cut(cut, branches)
+
+        # event loop predicate
+        try:
+            expression = self.parsed_cut.format(**{'tree': '_tree', index: '_i'})
+        except KeyError as e:
+            raise Exception("Cut uses branches that are not indexed by %s: %s\n%s" % (index, e, cut))
+        scope = {'__builtins__': builtins, 'math': math}
+        self._select = eval(compile("lambda _tree, _n: [_i for _i in range(_n) if (%s)]" % expression,
+                                    "<cut>", "eval"), scope)
+        self._passes = eval(compile("lambda _tree, _i: bool(%s)" % expression,
+                                    "<cut>", "eval"), scope)
+
+        # columnar predicate. Cuts that cannot be vectorized are still
+        # usable in the event loop.
+        self.required_branches = set([index])
+        self._evaluate = None
+        self._columnar_error = None
+        self._ast = None
+        try:
+            self._ast = ast.parse(re.sub(r'\&\&', ' and ', cut).strip(), mode='eval').body
+            self._evaluate = self._compile_node(self._ast)
+        except Exception as e:
+            self._columnar_error = str(e)
+
+    def select(self, tree, n=None):
+        """Indices of candidates passing the cut in the current event"""
+        if n is None:
+            n = getattr(tree, self.index)
+        return self._select(tree, n)
+
+    def passes(self, tree, i):
+        """Check if candidate i of the current event passes the cut"""
+        return self._passes(tree, i)
+
+    def evaluate(self, columns):
+        """Evaluate the cut for all candidates of a batch of events
+
+        columns map branch names to NumPy arrays. Scalar branches
+        have one entry per event, array branches are flattened over
+        events and are interpreted using their counter branches. All
+        branches in required_branches must be present.
+
+        Returns a boolean mask over the flattened candidates.
+        """
+        if self._evaluate is None:
+            raise Exception("Cut cannot be evaluated on columns: %s" % self._columnar_error)
+        batch = _Batch(columns, self.index)
+        result = self._evaluate(batch)
+        return np.broadcast_to(np.asarray(result, dtype=bool), (batch.n_candidates,)).copy()
+
+    def select_batch(self, columns):
+        """Indices of candidates passing the cut for each event in a batch"""
+        mask = self.evaluate(columns)
+        counts = np.asarray(columns[self.index], dtype=np.int64)
+        candidate_event = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(len(mask)) - (np.cumsum(counts) - counts)[candidate_event]
+        n_passed = np.bincount(candidate_event[mask], minlength=len(counts))
+        return np.split(local[mask], np.cumsum(n_passed)[:-1])
+
+    def cpp_expression(self, candidate):
+        """C++ version of the cut for RDataFrame
+
+        The expression is written in terms of the candidate index
+        variable and NanoAOD columns. Logical operators short-circuit
+        the same way as in the python event loop.
+        """
+        if self._ast is None:
+            raise Exception("Cut cannot be converted to C++: %s" % self._columnar_error)
+        return self._cpp_node(self._ast, candidate)
+
+    ### C++ translation
+
+    cpp_comparisons = {
+        ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=', ast.Eq: '==', ast.NotEq: '!=',
+    }
+
+    cpp_operators = {
+        ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.BitAnd: '&', ast.BitOr: '|',
+    }
+
+    def _cpp_node(self, node, candidate):
+        """Convert an AST node into a C++ expression"""
+        if isinstance(node, ast.BoolOp):
+            op = ' && ' if isinstance(node.op, ast.And) else ' || '
+            return "(" + op.join(self._cpp_node(v, candidate) for v in node.values) + ")"
+
+        if isinstance(node, ast.UnaryOp):
+            operand = self._cpp_node(node.operand, candidate)
+            if isinstance(node.op, ast.Not):
+                return "(!%s)" % operand
+            if isinstance(node.op, ast.USub):
+                return "(-%s)" % operand
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            raise Exception("Unsupported unary operator in cut: %s" % ast.dump(node))
+
+        if isinstance(node, ast.BinOp):
+            left = self._cpp_node(node.left, candidate)
+            right = self._cpp_node(node.right, candidate)
+            if isinstance(node.op, ast.Div):
+                # python division is always a floating point division
+                return "(static_cast<double>(%s) / %s)" % (left, right)
+            if isinstance(node.op, ast.Pow):
+                return "std::pow(%s, %s)" % (left, right)
+            if type(node.op) not in self.cpp_operators:
+                raise Exception("Unsupported operator in cut: %s" % ast.dump(node))
+            return "(%s %s %s)" % (left, self.cpp_operators[type(node.op)], right)
+
+        if isinstance(node, ast.Compare):
+            values = [self._cpp_node(node.left, candidate)]
+            values += [self._cpp_node(c, candidate) for c in node.comparators]
+            parts = []
+            for i, op in enumerate(node.ops):
+                if type(op) not in self.cpp_comparisons:
+                    raise Exception("Unsupported comparison in cut: %s" % ast.dump(node))
+                parts.append("(%s %s %s)" % (values[i], self.cpp_comparisons[type(op)], values[i+1]))
+            return "(" + " && ".join(parts) + ")"
+
+        if isinstance(node, ast.IfExp):
+            return "(%s ? %s : %s)" % (self._cpp_node(node.test, candidate),
+                                       self._cpp_node(node.body, candidate),
+                                       self._cpp_node(node.orelse, candidate))
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in self.functions or node.keywords:
+                raise Exception("Unsupported function call in cut: %s" % ast.dump(node))
+            args = ["static_cast<double>(%s)" % self._cpp_node(a, candidate) for a in node.args]
+            if node.func.id == 'abs':
+                return "std::abs(%s)" % args[0]
+            result = args[0]
+            for arg in args[1:]:
+                result = "std::%s(%s, %s)" % (node.func.id, result, arg)
+            return result
+
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool):
+                return "true" if node.value else "false"
+            if isinstance(node.value, (int, float)):
+                return repr(node.value)
+            raise Exception("Unsupported constant in cut: %s" % ast.dump(node))
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name not in self.branches:
+                raise Exception("Unknown branch in cut: %s" % name)
+            counter = self.branches[name]
+            if counter == "":
+                return name
+            if counter != self.index:
+                raise Exception("Cut uses branches that are not indexed by %s: %s" % (self.index, name))
+            return "%s[%s]" % (name, candidate)
+
+        if isinstance(node, ast.Subscript):
+            if not isinstance(node.value, ast.Name) or node.value.id not in self.branches or \
+               self.branches[node.value.id] == "":
+                raise Exception("Only array branches can be indexed in cut: %s" % ast.dump(node))
+            return "%s[%s]" % (node.value.id, self._cpp_node(node.slice, candidate))
+
+        raise Exception("Unsupported expression in cut: %s" % ast.dump(node))
+
+    ### Columnar compiler
+
+    def _compile_node(self, node):
+        """Convert an AST node into a function of a _Batch"""
+        if isinstance(node, ast.BoolOp):
+            values = [self._compile_node(v) for v in node.values]
+            if isinstance(node.op, ast.And):
+                reducer = np.logical_and
+            else:
+                reducer = np.logical_or
+            def bool_op(batch):
+                result = values[0](batch)
+                for value in values[1:]:
+                    result = reducer(result, value(batch))
+                return result
+            return bool_op
+
+        if isinstance(node, ast.UnaryOp):
+            operand = self._compile_node(node.operand)
+            if isinstance(node.op, ast.Not):
+                return lambda batch: np.logical_not(operand(batch))
+            if isinstance(node.op, ast.USub):
+                return lambda batch: np.negative(operand(batch))
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            raise Exception("Unsupported unary operator in cut: %s" % ast.dump(node))
+
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in self.operators:
+                raise Exception("Unsupported operator in cut: %s" % ast.dump(node))
+            operator = self.operators[type(node.op)]
+            left = self._compile_node(node.left)
+            right = self._compile_node(node.right)
+            return lambda batch: operator(left(batch), right(batch))
+
+        if isinstance(node, ast.Compare):
+            operands = [self._compile_node(node.left)]
+            operands += [self._compile_node(c) for c in node.comparators]
+            ops = []
+            for op in node.ops:
+                if type(op) not in self.comparisons:
+                    raise Exception("Unsupported comparison in cut: %s" % ast.dump(node))
+                ops.append(self.comparisons[type(op)])
+            def compare(batch):
+                values = [operand(batch) for operand in operands]
+                result = ops[0](values[0], values[1])
+                for i in range(1, len(ops)):
+                    result = np.logical_and(result, ops[i](values[i], values[i+1]))
+                return result
+            return compare
+
+        if isinstance(node, ast.IfExp):
+            test = self._compile_node(node.test)
+            body = self._compile_node(node.body)
+            orelse = self._compile_node(node.orelse)
+            return lambda batch: np.where(test(batch), body(batch), orelse(batch))
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in self.functions or node.keywords:
+                raise Exception("Unsupported function call in cut: %s" % ast.dump(node))
+            function = self.functions[node.func.id]
+            args = [self._compile_node(a) for a in node.args]
+            if len(args) == 1:
+                return lambda batch: function(args[0](batch))
+            def call(batch):
+                result = args[0](batch)
+                for arg in args[1:]:
+                    result = function(result, arg(batch))
+                return result
+            return call
+
+        if isinstance(node, ast.Constant):
+            value = node.value
+            return lambda batch: value
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name not in self.branches:
+                raise Exception("Unknown branch in cut: %s" % name)
+            counter = self.branches[name]
+            self.required_branches.add(name)
+            if counter == "":
+                return lambda batch: batch.event_column(name)
+            if counter != self.index:
+                raise Exception("Cut uses branches that are not indexed by %s: %s" % (self.index, name))
+            return lambda batch: batch.column(name)
+
+        if isinstance(node, ast.Subscript):
+            if not isinstance(node.value, ast.Name) or node.value.id not in self.branches or \
+               self.branches[node.value.id] == "":
+                raise Exception("Only array branches can be indexed in cut: %s" % ast.dump(node))
+            name = node.value.id
+            counter = self.branches[name]
+            self.required_branches.update([name, counter])
+            index = self._compile_node(node.slice)
+            return lambda batch: batch.gather(name, counter, index(batch))
+
+        raise Exception("Unsupported expression in cut: %s" % ast.dump(node))
+
+
+class _Batch(object):
+    """Flattened candidate view of a batch of events"""
+
+    def __init__(self, columns, index):
+        self.columns = columns
+        counts = np.asarray(columns[index], dtype=np.int64)
+        self.n_candidates = int(np.sum(counts))
+        self.candidate_event = np.repeat(np.arange(len(counts)), counts)
+        self._offsets = dict()
+        self._cache = dict()
+
+    @staticmethod
+    def _promote(values):
+        """Use python-like precision for arithmetics and comparisons"""
+        values = np.asarray(values)
+        if values.dtype.kind == 'f':
+            return values.astype(np.float64)
+        if values.dtype.kind == 'i' or (values.dtype.kind == 'u' and values.dtype.itemsize < 8):
+            return values.astype(np.int64)
+        return values
+
+    def _get(self, name):
+        if name not in self._cache:
+            self._cache[name] = self._promote(self.columns[name])
+        return self._cache[name]
+
+    def column(self, name):
+        """Candidate level array branch"""
+        return self._get(name)
+
+    def event_column(self, name):
+        """Event level branch broadcasted to candidates"""
+        return self._get(name)[self.candidate_event]
+
+    def gather(self, name, counter, index):
+        """Array branch element with event local index for each candidate
+
+        Out of range indices give 0. As in the event loop, cuts are
+        expected to guard against them.
+        """
+        if counter not in self._offsets:
+            counts = np.asarray(self.columns[counter], dtype=np.int64)
+            self._offsets[counter] = (counts, np.cumsum(counts) - counts)
+        counts, offsets = self._offsets[counter]
+        values = self._get(name)
+        index = np.broadcast_to(np.asarray(index, dtype=np.int64), (self.n_candidates,))
+        valid = (index >= 0) & (index < counts[self.candidate_event])
+        if len(values) == 0:
+            return np.zeros(self.n_candidates, dtype=values.dtype)
+        position = np.where(valid, offsets[self.candidate_event] + index, 0)
+        return np.where(valid, values[position], 0)
+
+
+class _SyntheticEvent(object):
+    """Minimal stand-in for a PyROOT event used by the benchmark"""
+    pass
+
+def _make_synthetic_events(n_events, seed=1):
+    """Generate bkmm-like events with mm and Muon collections"""
+    rng = np.random.default_rng(seed)
+    events = []
+    for i in range(n_events):
+        event = _SyntheticEvent()
+        event.nMuon = int(rng.integers(2, 6))
+        event.nmm = int(rng.integers(1, 4))
+        event.nbkmm = int(rng.integers(0, 12))
+        event.Muon_charge = rng.choice(np.array([-1, 1], dtype=np.int32), event.nMuon)
+        event.Muon_isGlobal = rng.random(event.nMuon) > 0.1
+        event.Muon_softMva = rng.random(event.nMuon).astype(np.float32)
+        event.mm_mu1_index = rng.integers(-1, event.nMuon, event.nmm).astype(np.int32)
+        event.mm_mu2_index = rng.integers(-1, event.nMuon, event.nmm).astype(np.int32)
+        event.mm_kin_vtx_prob = rng.random(event.nmm).astype(np.float32)
+        event.bkmm_mm_index = rng.integers(0, event.nmm, event.nbkmm).astype(np.int32)
+        event.bkmm_jpsimc_vtx_prob = rng.random(event.nbkmm).astype(np.float32)
+        event.bkmm_jpsimc_sl3d = (10 * rng.random(event.nbkmm)).astype(np.float32)
+        event.bkmm_jpsimc_alpha = (0.2 * rng.random(event.nbkmm) - 0.1).astype(np.float32)
+        event.bkmm_jpsimc_mass = (4.5 + 2 * rng.random(event.nbkmm)).astype(np.float32)
+        event.HLT_DoubleMu4_3_LowMass = bool(rng.random() > 0.2)
+        events.append(event)
+    return events
+
+def benchmark(n_events=20000):
+    """Compare candidate rates of the eval based and compiled selections"""
+    cut = "mm_mu1_index[bkmm_mm_index]>=0 and "\
+          "mm_mu2_index[bkmm_mm_index]>=0 and "\
+          "Muon_charge[mm_mu1_index[bkmm_mm_index]] * Muon_charge[mm_mu2_index[bkmm_mm_index]] < 0 and "\
+          "Muon_isGlobal[mm_mu1_index[bkmm_mm_index]] and "\
+          "Muon_isGlobal[mm_mu2_index[bkmm_mm_index]] and "\
+          "mm_kin_vtx_prob[bkmm_mm_index]>0.01 and "\
+          "bkmm_jpsimc_vtx_prob>0.025 and "\
+          "bkmm_jpsimc_sl3d>3 and "\
+          "abs(bkmm_jpsimc_alpha) < 0.1 and "\
+          "abs(bkmm_jpsimc_mass-5.4)<0.5 and "\
+          "HLT_DoubleMu4_3_LowMass"
+    branches = {'nMuon':"", 'nmm':"", 'nbkmm':"", 'HLT_DoubleMu4_3_LowMass':""}
+    for name in ['Muon_charge', 'Muon_isGlobal', 'Muon_softMva']:
+        branches[name] = 'nMuon'
+    for name in ['mm_mu1_index', 'mm_mu2_index', 'mm_kin_vtx_prob']:
+        branches[name] = 'nmm'
+    for name in ['bkmm_mm_index', 'bkmm_jpsimc_vtx_prob', 'bkmm_jpsimc_sl3d',
+                 'bkmm_jpsimc_alpha', 'bkmm_jpsimc_mass']:
+        branches[name] = 'nbkmm'
+
+    events = _make_synthetic_events(n_events)
+    n_candidates = sum(e.nbkmm for e in events)
+    print("Events: %u, candidates: %u" % (n_events, n_candidates))
+
+    # eval based selection as used in the FlatNtuple event loops
+    parsed_cut = parse_cut(cut, branches)
+    t0 = time.perf_counter()
+    selected_eval = []
+    for event in events:
+        candidates = []
+        for cand in range(event.nbkmm):
+            if not eval(parsed_cut.format(**{'nbkmm': cand, 'tree': 'event'})):
+                continue
+            candidates.append(cand)
+        selected_eval.append(candidates)
+    dt_eval = time.perf_counter() - t0
+    print("eval:      %10.0f candidates/s" % (n_candidates / dt_eval))
+
+    # compiled event loop selection
+    t0 = time.perf_counter()
+    compiled = CompiledCut(cut, branches, 'nbkmm')
+    selected_compiled = [compiled.select(event) for event in events]
+    dt_compiled = time.perf_counter() - t0
+    print("compiled:  %10.0f candidates/s (x%.1f)" % (n_candidates / dt_compiled, dt_eval / dt_compiled))
+
+    # columnar selection
+    columns = dict()
+    for name, counter in branches.items():
+        values = [getattr(e, name) for e in events]
+        columns[name] = np.concatenate(values) if counter != "" else np.asarray(values)
+    t0 = time.perf_counter()
+    selected_batch = compiled.select_batch(columns)
+    dt_batch = time.perf_counter() - t0
+    print("columnar:  %10.0f candidates/s (x%.1f)" % (n_candidates / dt_batch, dt_eval / dt_batch))
+
+    if selected_compiled != selected_eval:
+        raise Exception("Compiled selection differs from eval")
+    if [list(s) for s in selected_batch] != selected_eval:
+        raise Exception("Columnar selection differs from eval")
+    print("Selected %u candidates. All selections are identical." % sum(len(s) for s in selected_eval))
+
+if __name__ == "__main__":
+    benchmark()
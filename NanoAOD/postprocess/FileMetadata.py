@@ -0,0 +1,299 @@
+#
+# Persistent cache of input file metadata
+#
+# Information about input files is stored in a SQLite database keyed by
+# the file path. Each record keeps the size and modification time of
+# the file when it was read, so a modified file is read again. EOS files
+# are checked through the FUSE mount, other remote files with xrootd.
+# Files that cannot be checked or cannot be opened are always read,
+# since failures to open files over xrootd are often transient.
+#
+# Cached information:
+#   readable   - file can be opened, is not a zombie and wasn't recovered
+#   bytes      - file size reported by ROOT
+#   entries    - number of entries in the Events tree or None if it's missing
+#   branches   - [name, type] of Events branches in their original order
+#   lumis      - [run, lumi] pairs from LuminosityBlocks or None if it's missing
+#   gen_filter - [passed, total] GenFilter counts for each lumi or None
+#   info       - sums of numeric branches of the info tree or None
+#
+# Files of a dataset usually have the same branches, so branch lists are
+# stored once and decoded once per process.
+#
+import sqlite3
+import hashlib
+import json
+import os
+import re
+import time
+from JobStore import network_file_systems
+
+class FileMetadataCache(object):
+    """Input file metadata keyed by path, size and modification time"""
+
+    columns = ['path', 'size', 'mtime', 'branches', 'metadata']
+
+    def __init__(self, path):
+        self.path = path
+        self.branch_lists = dict()
+        self._connect()
+
+    def _connect(self):
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(self.path, timeout=600)
+        existing = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        with self.connection:
+            # it's only a cache, so an outdated layout is dropped
+            if len(existing) > 0 and existing != self.columns:
+                self.connection.execute("DROP TABLE files")
+            self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                branches TEXT,
+                metadata TEXT
+            );
+            CREATE TABLE IF NOT EXISTS branch_lists (
+                id TEXT PRIMARY KEY,
+                branches TEXT
+            );
+            """)
+
+    def _db(self):
+        """Connection of the current process. SQLite connections don't survive fork"""
+        if self.pid != os.getpid():
+            self._connect()
+        return self.connection
+
+    @staticmethod
+    def local_path(file):
+        """Get eos file name without xrootd prefix"""
+        return re.sub("^.*?\/eos\/cms\/store\/", "/eos/cms/store/", file)
+
+    @staticmethod
+    def stat(file):
+        """Size and modification time of a file. None if it's not accessible
+
+        Modification times are in whole seconds, as reported by xrootd,
+        so that the FUSE mount and xrootd give the same record.
+        """
+        try:
+            info = os.stat(FileMetadataCache.local_path(file))
+            return info.st_size, int(info.st_mtime)
+        except OSError:
+            pass
+        # remote files without the FUSE mount
+        if file.startswith("root://"):
+            import ROOT
+            info = ROOT.FileStat_t()
+            if ROOT.gSystem.GetPathInfo(file, info) == 0:
+                return info.fSize, int(info.fMtime)
+        return None, None
+
+    def get(self, file):
+        """Get cached metadata if it's up to date"""
+        size, mtime = self.stat(file)
+        if size == None:
+            return None
+        row = self._db().execute("SELECT size, mtime, branches, metadata FROM files WHERE path=?",
+                                 (self.local_path(file),)).fetchone()
+        if row == None or row[0] != size or row[1] != mtime:
+            return None
+        info = json.loads(row[3])
+        info['branches'] = self._get_branch_list(row[2])
+        return info
+
+    def _get_branch_list(self, id):
+        if id not in self.branch_lists:
+            row = self._db().execute("SELECT branches FROM branch_lists WHERE id=?", (id,)).fetchone()
+            self.branch_lists[id] = json.loads(row[0])
+        return self.branch_lists[id]
+
+    def put(self, file, size, mtime, metadata):
+        metadata = dict(metadata)
+        branches = json.dumps(metadata.pop('branches', []))
+        id = hashlib.md5(branches.encode("utf-8")).hexdigest()
+        with self._db():
+            self.connection.execute("INSERT OR IGNORE INTO branch_lists (id, branches) VALUES (?, ?)",
+                                    (id, branches))
+            self.connection.execute("INSERT OR REPLACE INTO files (path, size, mtime, branches, metadata) "
+                                    "VALUES (?, ?, ?, ?, ?)",
+                                    (self.local_path(file), size, mtime, id, json.dumps(metadata)))
+
+    def metadata(self, file):
+        """Get metadata from the cache or the file itself"""
+        info = self.get(file)
+        if info == None:
+            size, mtime = self.stat(file)
+            info = read_file_metadata(file)
+            if size != None and info['readable']:
+                self.put(file, size, mtime, info)
+        return info
+
+    def n_events(self, file):
+        entries = self.metadata(file)['entries']
+        if entries == None:
+            return 0
+        return entries
+
+    def n_bytes(self, file):
+        return self.metadata(file)['bytes']
+
+    def is_good_file(self, file):
+        """Check that a file is readable and has the Events tree"""
+        info = self.metadata(file)
+        return info['readable'] and info['entries'] != None
+
+
+def _declare_read_code():
+    """Declare the C++ helper reading integer columns of a tree"""
+    import ROOT
+    if hasattr(ROOT, 'file_metadata'):
+        return ROOT.file_metadata
+    ROOT.gInterpreter.Declare("""
+    #include <string>
+    #include <vector>
+    #include "TBranch.h"
+    #include "TLeaf.h"
+    #include "TTree.h"
+
+    namespace file_metadata {
+        // values of all entries, entry by entry, whatever the integer types
+        void read_columns(TTree *tree, const std::vector<std::string> &names, Long64_t *values) {
+            std::vector<TBranch*> branches;
+            std::vector<TLeaf*> leaves;
+            for (const auto &name: names) {
+                branches.push_back(tree->GetBranch(name.c_str()));
+                leaves.push_back(branches.back()->GetLeaf(name.c_str()));
+            }
+            const Long64_t n = tree->GetEntries();
+            for (Long64_t i = 0; i < n; ++i)
+                for (size_t j = 0; j < names.size(); ++j) {
+                    branches[j]->GetEntry(i);
+                    values[i * names.size() + j] = leaves[j]->GetValueLong64();
+                }
+        }
+    }
+    """)
+    return ROOT.file_metadata
+
+def read_file_metadata(file):
+    """Read metadata from a ROOT file"""
+    import ROOT
+    import numpy as np
+    info = {'readable':False, 'bytes':0, 'entries':None, 'branches':[],
+            'lumis':None, 'gen_filter':None, 'info':None}
+
+    f = ROOT.TFile.Open(file)
+    if not f:
+        return info
+    if f.IsZombie() or f.TestBit(ROOT.TFile.kRecovered):
+        f.Close()
+        return info
+    info['readable'] = True
+    info['bytes'] = f.GetSize()
+
+    events = f.Get("Events")
+    if events:
+        info['entries'] = events.GetEntries()
+        branches = events.GetListOfBranches()
+        for i in range(branches.GetEntries()):
+            branch = branches.At(i)
+            leaf = branch.GetListOfLeaves().At(0)
+            info['branches'].append([branch.GetName(), leaf.GetTypeName() if leaf else ""])
+
+    lumis = f.Get("LuminosityBlocks")
+    if lumis:
+        columns = ['run', 'luminosityBlock']
+        gen_filter = lumis.GetBranch('GenFilter_numEventsPassed') != None
+        if gen_filter:
+            columns += ['GenFilter_numEventsPassed', 'GenFilter_numEventsTotal']
+        # Long64_t is long long
+        data = np.zeros(lumis.GetEntries() * len(columns), dtype=np.longlong)
+        if len(data) > 0:
+            _declare_read_code().read_columns(lumis, columns, data)
+        data = data.reshape(-1, len(columns))
+        info['lumis'] = data[:, 0:2].tolist()
+        if gen_filter:
+            info['gen_filter'] = data[:, 2:4].tolist()
+
+    info_tree = f.Get("info")
+    if info_tree:
+        info['info'] = dict()
+        for entry in info_tree:
+            for branch in info_tree.GetListOfBranches():
+                name = branch.GetName()
+                value = getattr(entry, name)
+                if isinstance(value, (int, float)):
+                    info['info'][name] = info['info'].get(name, 0) + value
+
+    f.Close()
+    return info
+
+def open_file_metadata_cache():
+    """Open the file metadata cache defined in the configuration
+
+    Without configuration the cache is kept in memory. Caches on
+    network file systems are refused, since SQLite locking doesn't
+    work reliably there.
+    """
+    import postprocessing_cfg as cfg
+    if not hasattr(cfg, 'file_metadata_cache') or cfg.file_metadata_cache == None:
+        return FileMetadataCache(":memory:")
+    path = os.path.realpath(cfg.file_metadata_cache)
+    for prefix in network_file_systems:
+        if path.startswith(prefix):
+            raise Exception("File metadata cache %s is on a network file system. Use a local disk." % \
+                            cfg.file_metadata_cache)
+    return FileMetadataCache(cfg.file_metadata_cache)
+
+def _make_test_files(path, n_files, n_events=1000, n_lumis=20):
+    """Create NanoAOD-like files with Events, LuminosityBlocks and GenFilter counts"""
+    import ROOT
+    files = []
+    for i in range(n_files):
+        file_name = "%s/%04u.root" % (path, i)
+        opts = ROOT.RDF.RSnapshotOptions()
+        opts.fMode = "UPDATE"
+        df = ROOT.RDataFrame(n_events)
+        df = df.Define("run", "1u").Define("luminosityBlock", "(unsigned int)(rdfentry_ / %u + %u)" % (n_events // n_lumis, i * n_lumis))
+        df = df.Define("event", "(ULong64_t)rdfentry_")
+        for j in range(100):
+            df = df.Define("mm_var%u" % j, "float(rdfentry_ * %u)" % j)
+        df.Snapshot("Events", file_name)
+        lumis = ROOT.RDataFrame(n_lumis)
+        lumis = lumis.Define("run", "1u").Define("luminosityBlock", "(unsigned int)(rdfentry_ + %u)" % (i * n_lumis))
+        lumis = lumis.Define("GenFilter_numEventsPassed", "%uu" % (n_events // n_lumis))
+        lumis = lumis.Define("GenFilter_numEventsTotal", "%uu" % (10 * n_events // n_lumis))
+        lumis.Snapshot("LuminosityBlocks", file_name, "", opts)
+        files.append(file_name)
+    return files
+
+def benchmark(n_files=1000):
+    """Time metadata collection for a task on a cold and a warm cache"""
+    import tempfile, shutil
+
+    tmp_dir = tempfile.mkdtemp()
+    t0 = time.perf_counter()
+    files = _make_test_files(tmp_dir, n_files)
+    print("Created %u test files in %.1f sec" % (n_files, time.perf_counter() - t0))
+
+    cache = FileMetadataCache("%s/file_metadata.db" % tmp_dir)
+    results = []
+    for mode in ['cold', 'warm']:
+        t0 = time.perf_counter()
+        results.append([cache.metadata(f) for f in files])
+        print("%s cache: %8.3f sec for %u files" % (mode, time.perf_counter() - t0, n_files))
+    if results[0] != results[1]:
+        raise Exception("Cached metadata differs from the files")
+
+    # modified files are read again
+    os.utime(files[0], (time.time(), time.time() + 10))
+    if cache.get(files[0]) != None:
+        raise Exception("Modified file is not detected")
+
+    shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    benchmark()
@@ -46,7 +46,7 @@ class FlatNtupleForDstarFit(FlatNtupleBase):
     def _process_events(self):
         """Event loop"""
 
-        parsed_cut = self.get_cut()
+        compiled_cut = self.get_compiled_cut('ndstar')
                     
         for event_index, event in enumerate(self.input_tree):
             self.event = event           
@@ -76,11 +76,7 @@ class FlatNtupleForDstarFit(FlatNtupleBase):
                 #            self.event.mm_kin_mass[cand] > 5.10:
                 #             continue
                 
-                # cut = self.job_info['cut'].format(cand=cand, tree="self.event")
-                format_dict = { 'ndstar' : cand,
-                                'tree' : 'self.event'}
-                cut = parsed_cut.format(**format_dict)
-                if not eval(cut):
+                if not compiled_cut.passes(self.event, cand):
                     continue
 
                 candidates.append(cand)
@@ -165,7 +165,7 @@ class FlatNtupleForKsmm(FlatNtupleBase):
     def _process_events(self):
         """Event loop"""
 
-        parsed_cut = self.get_cut()
+        compiled_cut = self.get_compiled_cut(self.leaf_counts[self.job_info['final_state']])
 
         for event_index, event in enumerate(self.input_tree):
             self.event = event           
@@ -183,17 +183,7 @@ class FlatNtupleForKsmm(FlatNtupleBase):
                     continue
 
             # Find candidates the satisfy the selection requirements
-            n = getattr(self.event, self.leaf_counts[self.job_info['final_state']])
-            for cand in range(n):
-
-                # cut = self.job_info['cut'].format(cand=cand, tree="self.event")
-                format_dict = { self.leaf_counts[self.job_info['final_state']] : cand,
-                                'tree' : 'self.event'}
-                cut = parsed_cut.format(**format_dict)
-                if not eval(cut):
-                    continue
-
-                candidates.append(cand)
+            candidates = compiled_cut.select(self.event)
 
             # Find canidates to be stored
             cands = self.__select_candidates(candidates)
@@ -1,9 +1,25 @@
 from PostProcessingBase import FlatNtupleBase
+from CutEngine import CompiledCut, get_branch_counters
+from mtree import MTree
+from BmmScout.NanoAOD import gen_ancestry
 
 import os, re, sys, time, subprocess, math, json
 import multiprocessing
 from datetime import datetime
 import hashlib
+import tempfile
+import ROOT
+from ROOT import TFile, RDataFrame
+import numpy as np
+
+class _BranchRecorder(object):
+    """Collect output tree configuration without booking a TTree"""
+
+    def __init__(self):
+        self.branches = []
+
+    def addBranch(self, branch_name, branch_type, default_value, title = None):
+        self.branches.append((branch_name, branch_type, default_value, title))
 
 class FlatNtupleForMLFit(FlatNtupleBase):
     """Flat ROOT ntuple producer for BmmScout UML fit"""
@@ -83,7 +99,7 @@ class FlatNtupleForMLFit(FlatNtupleBase):
         max_value = None
         values = getattr(self.event, self.job_info['best_candidate'])
         for i in candidates:
-            if not best_candidate or max_value < values[i]:
+            if best_candidate is None or max_value < values[i]:
                 best_candidate = i
                 max_value = values[i]
 
@@ -93,10 +109,11 @@ class FlatNtupleForMLFit(FlatNtupleBase):
     def _process_events(self):
         """Event loop"""
 
-        parsed_cut = self.get_cut()
+        compiled_cut = self.get_compiled_cut(self.leaf_counts[self.job_info['final_state']])
 
         for event_index, event in enumerate(self.input_tree):
             self.event = event           
+            self.bhh_tag = None
             candidates = []
 
             # Trigger requirements
@@ -123,11 +140,7 @@ class FlatNtupleForMLFit(FlatNtupleBase):
                            self.event.mm_kin_mass[cand] > 5.10:
                             continue
 
-                # cut = self.job_info['cut'].format(cand=cand, tree="self.event")
-                format_dict = { self.leaf_counts[self.job_info['final_state']] : cand,
-                                'tree' : 'self.event'}
-                cut = parsed_cut.format(**format_dict)
-                if not eval(cut):
+                if not compiled_cut.passes(self.event, cand):
                     continue
 
                 candidates.append(cand)
@@ -230,22 +243,15 @@ class FlatNtupleForMLFit(FlatNtupleBase):
             self.tree.addBranch("%s_matched" % trigger, 'Int_t', 0,  "matched to the trigger objets")
 
     def _tag_bhh(self):
-        """Determine B meson pdgId for Btohh mixed samples"""
-        if not hasattr(self.event, "GenPart_pdgId"): return 0
-        for i, id in enumerate(self.event.GenPart_pdgId):
-            if abs(id) != 13: continue
-
-            mother_idx = self.event.GenPart_genPartIdxMother[i]
-            if mother_idx < 0: continue
-            if abs(self.event.GenPart_pdgId[mother_idx]) not in (211, 321): continue
+        """Determine B meson pdgId for Btohh mixed samples
 
-            grandmother_idx = self.event.GenPart_genPartIdxMother[mother_idx]
-            if grandmother_idx < 0: continue
-
-            grandmother_pdgId = self.event.GenPart_pdgId[grandmother_idx]
-            if abs(grandmother_pdgId) not in (511, 531): continue
-            return grandmother_pdgId
-        return 0
+        The tag is computed once per event and reused for all candidates"""
+        if not hasattr(self.event, "GenPart_pdgId"): return 0
+        if self.bhh_tag == None:
+            self.bhh_tag = gen_ancestry.tag_bhh(self.event.GenPart_pdgId,
+                                                self.event.GenPart_genPartIdxMother,
+                                                self.event.nGenPart)
+        return self.bhh_tag
 
 
     def _fill_tree(self, cand, ncands):
@@ -532,8 +538,405 @@ class FlatNtupleForMLFit(FlatNtupleBase):
 
         self.tree.fill()
 
+    ### RDataFrame engine
+
+    # numpy types of the output branches
+    numpy_types = {
+        'Int_t':     np.int32,
+        'UInt_t':    np.uint32,
+        'Float_t':   np.float32,
+        'ULong64_t': np.uint64,
+        'Long64_t':  np.int64,
+    }
+
+    # C++ types of the output branches
+    cpp_types = {
+        'Int_t':     'int',
+        'UInt_t':    'unsigned int',
+        'Float_t':   'float',
+        'ULong64_t': 'ULong64_t',
+        'Long64_t':  'Long64_t',
+    }
+
+    def process_file(self, input_file):
+        """Process input file with the engine requested by the job"""
+        if 'engine' in self.job_info and self.job_info['engine'] == 'rdataframe':
+            return self._process_file_rdataframe(input_file)
+        return super(FlatNtupleForMLFit, self).process_file(input_file)
+
+    def _declare_rdataframe_helpers(self):
+        """Declare C++ helpers used in the RDataFrame graph"""
+        if hasattr(ROOT, 'bmm_certified_muon'):
+            return
+        gen_ancestry.declare()
+        self._declare_lumi_mask_code()
+        code = ""
+        for type in ['muon', 'golden']:
+            code += '''
+            bool bmm_certified_%s(unsigned int run, unsigned int lumi) {
+               static LumiMask lumi_mask = LumiMask::fromCustomString("%s");
+               return lumi_mask.accept(run, lumi);
+            }
+            ''' % (type, self._get_lumi_mask(type))
+        ROOT.gInterpreter.Declare(code)
+
+    def _rdataframe_expressions(self, columns):
+        """C++ expressions for the output branches
+
+        Returns two maps: event level expressions and candidate level
+        expressions written in terms of the candidate index i. The
+        logic follows _fill_tree. Branches without an expression keep
+        their default values.
+        """
+        final_state = self.job_info['final_state']
+        event = dict()
+        cand = dict()
+
+        def has(*names):
+            return all(name in columns for name in names)
+
+        ## event info
+        event['run'] = 'run'
+        event['ls']  = 'luminosityBlock'
+        event['evt'] = 'event'
+        event['npv'] = 'PV_npvsGood'
+        event['certified_muon']   = 'bmm_certified_muon(run, luminosityBlock)'
+        event['certified_golden'] = 'bmm_certified_golden(run, luminosityBlock)'
+        event['n']   = 'bmm_candidates.size()'
+
+        ## MC info
+        if has('Pileup_nTrueInt'):
+            event['npu']      = 'Pileup_nPU'
+            event['npu_mean'] = 'Pileup_nTrueInt'
+            if has('GenPart_pdgId'):
+                event['mc_bhh'] = 'gen_ancestry::tag_bhh(GenPart_pdgId, GenPart_genPartIdxMother)'
+
+        mu1 = mu2 = None
+        if final_state in ['mm', 'hh', 'em']:
+            # candidate variables with common naming
+            prefix = final_state + '_kin_'
+            for var, name in [('bdt', final_state + '_mva'), ('pt', prefix + 'pt'),
+                              ('eta', prefix + 'eta'), ('phi', prefix + 'phi'),
+                              ('m', prefix + 'mass'), ('me', prefix + 'massErr'),
+                              ('tau', prefix + 'tau'), ('taue', prefix + 'taue'),
+                              ('tauxy', prefix + 'tauxy'), ('tauxye', prefix + 'tauxye')]:
+                cand[var] = '%s[i]' % name
+            if has('%s_gen_tau' % final_state):
+                cand['gtau'] = '%s_gen_tau[i]' % final_state
+                cand['mc_match'] = '%s_gen_pdgId[i]' % final_state
+
+        if final_state == 'mm':
+            # B to mm
+            cand['m_raw'] = 'mm_mass[i]'
+            if "mm_extra_info" in self.job_info and \
+               self.job_info["mm_extra_info"] == True:
+                for var in self.mm_extra_floats + self.mm_extra_ints:
+                    cand[var] = '%s[i]' % var
+
+            mu1 = 'mm_mu1_index[i]'
+            mu2 = 'mm_mu2_index[i]'
+            for muon in ['mu1', 'mu2']:
+                m = 'm1' if muon == 'mu1' else 'm2'
+                idx = mu1 if muon == 'mu1' else mu2
+                for var in ['pt', 'eta', 'phi']:
+                    cand[m + var] = 'mm_%s_%s[i]' % (muon, var)
+                if has('Muon_charge'):
+                    cand[m + 'q'] = '(%s >= 0 ? Muon_charge[%s] : 0)' % (idx, idx)
+                if has('mm_gen_%s_mpdgId' % muon):
+                    cand[m + 'mc'] = '(%s >= 0 ? mm_gen_%s_mpdgId[i] : 0)' % (idx, muon)
+                if has('Muon_softMva'):
+                    cand[m + 'bdt'] = '(%s >= 0 ? Muon_softMva[%s] : 1.f)' % (idx, idx)
+                else:
+                    cand[m + 'bdt'] = '(%s >= 0 ? 0.f : 1.f)' % idx
+
+        elif final_state == 'hh':
+            # B to hh
+            for had in ['1', '2']:
+                for var in ['pt', 'eta', 'phi']:
+                    cand['h%s%s' % (had, var)] = 'hh_had%s_%s[i]' % (had, var)
+                cand['h%sq' % had] = '(hh_had%s_pdgId[i] > 0 ? 1 : 0)' % had
+
+        elif final_state in ['bkmm', 'bkkmm']:
+            if final_state == 'bkmm':
+                # B to Jpsi K
+                prefix = 'bkmm_jpsimc_'
+                cand['m_raw'] = 'bkmm_nomc_mass[i]'
+                if has('bkmm_gen_tau'):
+                    cand['gtau'] = 'bkmm_gen_tau[i]'
+                    cand['mc_match'] = 'bkmm_gen_pdgId[i]'
+            else:
+                # B to Jpsi Phi
+                prefix = 'bkkmm_jpsikk_'
+                cand['kk_mass'] = 'bkkmm_kk_mass[i]'
+                if has('bkmm_gen_tau', 'bkkmm_gen_tau'):
+                    cand['gtau'] = 'bkkmm_gen_tau[i]'
+                    cand['mc_match'] = 'bkkmm_gen_pdgId[i]'
+            for var, name in [('pt', 'pt'), ('eta', 'eta'), ('phi', 'phi'), ('m', 'mass'),
+                              ('me', 'massErr'), ('tau', 'tau'), ('taue', 'taue'),
+                              ('tauxy', 'tauxy'), ('tauxye', 'tauxye')]:
+                cand[var] = '%s%s[i]' % (prefix, name)
+
+            mm_index = '%s_mm_index[i]' % final_state
+            mu1 = 'mm_mu1_index[%s]' % mm_index
+            mu2 = 'mm_mu2_index[%s]' % mm_index
+            for muon in ['mu1', 'mu2']:
+                m = 'm1' if muon == 'mu1' else 'm2'
+                idx = mu1 if muon == 'mu1' else mu2
+                for var in ['pt', 'eta', 'phi']:
+                    if final_state == 'bkmm':
+                        cand[m + var] = '(%s >= 0 ? mm_%s_%s[%s] : 0.f)' % (idx, muon, var, mm_index)
+                    else:
+                        cand[m + var] = 'mm_%s_%s[%s]' % (muon, var, mm_index)
+                if has('Muon_charge'):
+                    cand[m + 'q'] = '(%s >= 0 ? Muon_charge[%s] : 0)' % (idx, idx)
+                if has('Muon_softMva'):
+                    cand[m + 'bdt'] = '(%s >= 0 ? Muon_softMva[%s] : 0.f)' % (idx, idx)
+                if has('mm_gen_%s_mpdgId' % muon):
+                    cand[m + 'mc'] = '(%s >= 0 ? mm_gen_%s_mpdgId[%s] : 0)' % (idx, muon, mm_index)
+
+        elif final_state == 'em':
+            # B to em
+            el = 'em_el_index[i]'
+            mu = 'em_mu_index[i]'
+            for var in ['pt', 'eta', 'phi']:
+                cand['el' + var] = '(%s >= 0 ? Electron_%s[%s] : em_el_%s[i])' % (el, var, el, var)
+                cand['mu' + var] = '(%s >= 0 ? Muon_%s[%s] : em_mu_%s[i])' % (mu, var, mu, var)
+            cand['elq'] = '(%s >= 0 ? Electron_charge[%s] : 0)' % (el, el)
+            cand['muq'] = '(%s >= 0 ? Muon_charge[%s] : 0)' % (mu, mu)
+            if has('em_gen_el_mpdgId'):
+                cand['elmc'] = '(%s >= 0 ? em_gen_el_mpdgId[i] : 0)' % el
+            if has('em_gen_mu_mpdgId'):
+                cand['mumc'] = '(%s >= 0 ? em_gen_mu_mpdgId[i] : 0)' % mu
+            cand['id'] = '(%s >= 0 && %s >= 0 ? Electron_mvaNoIso_WP90[%s] && Muon_softMvaId[%s] : 0)' % \
+                         (el, mu, el, mu)
+            cand['chan'] = '(std::abs(%s) < 0.7 && std::abs(%s) < 0.7 ? 0 : 1)' % \
+                           (cand['eleta'], cand['mueta'])
+        else:
+            raise Exception("Unsupported final state: %s" % final_state)
+
+        if mu1 is not None:
+            if has('Muon_softMvaId'):
+                cand['muid'] = '(%s >= 0 && %s >= 0 ? Muon_softMvaId[%s] && Muon_softMvaId[%s] : 0)' % \
+                               (mu1, mu2, mu1, mu2)
+            if final_state != 'hh':
+                cand['chan'] = '(std::abs(%s) < 0.7 && std::abs(%s) < 0.7 ? 0 : 1)' % \
+                               (cand['m1eta'], cand['m2eta'])
+
+        for trigger in self.triggers_to_store:
+            if has(trigger):
+                event[trigger] = trigger
+            if has("prescale_" + trigger):
+                event[trigger + "_ps"] = "prescale_" + trigger
+            if mu1 is not None and has("MuonId_" + trigger):
+                cand[trigger + "_matched"] = '(%s >= 0 && %s >= 0 ? MuonId_%s[%s] && MuonId_%s[%s] : 0)' % \
+                                             (mu1, mu2, trigger, mu1, trigger, mu2)
+
+        return event, cand
+
+    def _rdataframe_selection(self, branches):
+        """C++ code selecting candidates to be stored"""
+        final_state = self.job_info['final_state']
+        counter = self.leaf_counts[final_state]
+        cut = CompiledCut(self.job_info['cut'], branches, counter)
+
+        blinding = ""
+        if self.job_info['blind']:
+            if final_state == 'mm':
+                blinding = "if (mm_kin_mass[i] < 5.50 && mm_kin_mass[i] > 5.15) continue;"
+            if final_state == 'em':
+                # the event loop uses the dimuon mass for em as well
+                blinding = "if (i < (int)mm_kin_mass.size() && mm_kin_mass[i] < 5.70 && mm_kin_mass[i] > 5.10) continue;"
+
+        best_candidate = ""
+        if self.job_info['best_candidate'] != "":
+            best_candidate = '''
+            if (candidates.size() > 1) {
+               int best = candidates[0];
+               for (auto i: candidates)
+                  if (%s[best] < %s[i]) best = i;
+               candidates = {best};
+            }''' % (self.job_info['best_candidate'], self.job_info['best_candidate'])
+
+        return '''
+            ROOT::RVec<int> candidates;
+            for (int i = 0; i < (int)%s; ++i) {
+               %s
+               if (!(%s)) continue;
+               candidates.push_back(i);
+            }
+            %s
+            return candidates;
+        ''' % (counter, blinding, cut.cpp_expression('i'), best_candidate)
+
+    def _process_file_rdataframe(self, input_file):
+        """Produce the flat ntuple with RDataFrame
+
+        Selection and output variables are expressed as a columnar
+        graph. Events are processed in parallel with ImplicitMT and
+        the order of the output entries is not preserved.
+        """
+        print("Processing file: %s" % input_file)
+        match = re.search("([^\/]+)\.root$", input_file)
+        if match:
+            output_filename = "%s/%s_processed.root" % (self.tmp_dir, match.group(1))
+        else:
+            raise Exception("Unexpected input ROOT file name:\n%s" % input_file)
+
+        if not ROOT.IsImplicitMTEnabled():
+            if 'nthreads' in self.job_info:
+                ROOT.EnableImplicitMT(self.job_info['nthreads'])
+            else:
+                ROOT.EnableImplicitMT()
+        self._declare_rdataframe_helpers()
+
+        # output tree layout
+        recorder = _BranchRecorder()
+        self.tree = recorder
+        self._configure_output_tree()
+
+        self._update_gen_filter_info(input_file)
+        local_file = self._local_input(input_file)
+        fin = TFile.Open(local_file)
+        input_tree = fin.Get("Events")
+        nevents = input_tree.GetEntries()
+
+        data = None
+        if nevents > 0:
+            branches = get_branch_counters(input_tree)
+            df = RDataFrame("Events", local_file)
+            columns = set(str(c) for c in df.GetColumnNames())
+
+            if 'pre-selection' in self.job_info:
+                df = df.Define("bmm_preselection", self.job_info['pre-selection'])
+                df = df.Filter("Sum(bmm_preselection) > 0", "Event has good candidates")
+
+            # Trigger requirements
+            if 'triggers' in self.job_info and len(self.job_info['triggers']) > 0:
+                triggers = [trigger for trigger in self.job_info['triggers'] if trigger in columns]
+                df = df.Filter(" || ".join(triggers) if len(triggers) > 0 else "false", "Passed triggers")
+
+            df = df.Define("bmm_candidates", self._rdataframe_selection(branches))
+            df = df.Filter("bmm_candidates.size() > 0", "Event has selected candidates")
+
+            event_exprs, cand_exprs = self._rdataframe_expressions(columns)
+            types = dict((name, type) for name, type, default, title in recorder.branches)
+            read = {'bmm_candidates': 'bmm_candidates'}
+            for name, expr in event_exprs.items():
+                if expr in columns:
+                    read[name] = expr
+                else:
+                    df = df.Define("bmm_out_" + name, expr)
+                    read[name] = "bmm_out_" + name
+            for name, expr in cand_exprs.items():
+                df = df.Define("bmm_out_" + name, '''
+                ROOT::RVec<%s> values(bmm_candidates.size());
+                for (size_t k = 0; k < bmm_candidates.size(); ++k) {
+                   const int i = bmm_candidates[k];
+                   values[k] = %s;
+                }
+                return values;''' % (self.cpp_types[types[name]], expr))
+                read[name] = "bmm_out_" + name
+
+            values = df.AsNumpy(sorted(set(read.values())))
+            counts = np.array([len(c) for c in values['bmm_candidates']], dtype=np.int64)
+            n_total = int(counts.sum())
+
+            if n_total > 0:
+                data = dict()
+                for name, type, default, title in recorder.branches:
+                    dtype = self.numpy_types[type]
+                    if name in cand_exprs:
+                        data[name] = np.concatenate([np.asarray(v) for v in values[read[name]]]).astype(dtype)
+                    elif name in event_exprs:
+                        data[name] = np.repeat(np.asarray(values[read[name]]).astype(dtype), counts)
+                    else:
+                        data[name] = np.full(n_total, default, dtype=dtype)
+
+        if data is not None:
+            if hasattr(ROOT.RDF, 'FromNumpy'):
+                df_out = ROOT.RDF.FromNumpy(data)
+            else:
+                df_out = ROOT.RDF.MakeNumpyDataFrame(data)
+            names = ROOT.std.vector('string')()
+            for name, type, default, title in recorder.branches:
+                names.push_back(name)
+            df_out.Snapshot(self.job_info['tree_name'], output_filename, names)
+
+            # branch documentation
+            fout = TFile(output_filename, 'update')
+            tree = fout.Get(self.job_info['tree_name'])
+            for name, type, default, title in recorder.branches:
+                if title:
+                    tree.GetBranch(name).SetTitle(title)
+            tree.Write("", ROOT.TObject.kOverwrite)
+            nout = tree.GetEntries()
+            fout.Close()
+        else:
+            # nothing selected - store empty tree
+            fout = TFile(output_filename, 'recreate')
+            self.tree = MTree(self.job_info['tree_name'], '')
+            self._configure_output_tree()
+            nout = 0
+            fout.Write()
+            fout.Close()
+
+        print('Selected %d / %d entries from %s (%.2f%%)' % (nout, nevents, input_file, 100.*nout/nevents if nevents else 0))
+        fin.Close()
+
+        return output_filename, nevents
+
+
+def compare_engines(input_file, final_state='mm', cut=None, best_candidate=""):
+    """Process a local NanoAOD file with both engines and compare the output"""
+    import postprocessing_cfg as cfg
+
+    if cut is None:
+        cut = {'mm': cfg.cuts['fit'], 'em': cfg.cuts['fit-em'], 'bkmm': cfg.cuts['fit-bkmm']}[final_state]
+
+    workdir = tempfile.mkdtemp(prefix=cfg.tmp_prefix)
+    fin = TFile.Open(input_file)
+    n_events = fin.Get("Events").GetEntries()
+    fin.Close()
+    outputs = dict()
+    for engine in ['pyroot', 'rdataframe']:
+        job = {
+            "input": [input_file],
+            "tree_name" : "test",
+            "blind" : False,
+            "cut" : cut,
+            "final_state" : final_state,
+            "best_candidate": best_candidate,
+            "engine": engine,
+        }
+        file_name = "%s/%s.job" % (workdir, engine)
+        json.dump(job, open(file_name, "w"))
+
+        p = FlatNtupleForMLFit(file_name)
+        t0 = time.perf_counter()
+        p.process()
+        duration = time.perf_counter() - t0
+        print("%s engine: %u events in %.1f sec, %.1f Hz" % (engine, n_events, duration, n_events / duration))
+        outputs[engine] = RDataFrame("test", "%s/%s.root" % (workdir, engine)).AsNumpy()
+
+    # the order of entries is not preserved by the rdataframe engine
+    keys = sorted(outputs['pyroot'])
+    results = dict()
+    for engine, data in outputs.items():
+        order = np.lexsort([data[key] for key in reversed(keys)])
+        results[engine] = dict((key, data[key][order]) for key in keys)
+    differences = [key for key in keys if not np.array_equal(results['pyroot'][key], results['rdataframe'][key])]
+    if len(differences) > 0:
+        print("Branches with differences: %s" % ", ".join(differences))
+    else:
+        print("Outputs are identical")
+
 if __name__ == "__main__":
 
+    if len(sys.argv) > 1:
+        # python3 FlatNtupleForMLFit.py [local NanoAOD file] [final state]
+        compare_engines(*sys.argv[1:3])
+        sys.exit()
+
     ### create a test job
 
     common_branches = "PV_npvs|PV_npvsGood|Pileup_nTrueInt|Pileup_nPU|run|event|luminosityBlock"
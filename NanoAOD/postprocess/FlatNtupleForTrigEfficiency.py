@@ -66,7 +66,7 @@ class FlatNtupleForTrigEfficiency(FlatNtupleBase):
     def _process_events(self):
         """Event loop"""
 
-        parsed_cut = self.get_cut()
+        compiled_cut = self.get_compiled_cut('nMuon')
                     
         for event in self.input_tree:
             self.event = event           
@@ -98,10 +98,7 @@ class FlatNtupleForTrigEfficiency(FlatNtupleBase):
                     if iprobe in probes:
                         continue
                 
-                    # cut = self.job_info['cut'].format(cand=cand, tree="self.event")
-                    format_dict = { 'nMuon' : iprobe, 'tree' : 'self.event'}
-                    cut = parsed_cut.format(**format_dict)
-                    if not eval(cut):
+                    if not compiled_cut.passes(self.event, iprobe):
                         continue
 
                     probes.append(iprobe)
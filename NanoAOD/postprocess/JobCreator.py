@@ -1,14 +1,23 @@
 import postprocessing_cfg as cfg
 import subprocess, re, json, hashlib, os
+from JobStore import open_job_store
+from FileMetadata import open_file_metadata_cache
 
 class JobCreator(object):
     """Create jobs according to the specifications in the config file"""
     def __init__(self):
         self.all_inputs_by_datasets = dict()
         self.files_in_use_by_task_and_dataset = dict()
+        self.job_store = open_job_store()
+        self.metadata = None
 
     def load_existing_jobs(self):
         """Find existings jobs and store their input"""
+        if self.job_store is not None and len(self.job_store) > 0:
+            self.files_in_use_by_task_and_dataset = self.job_store.get_files_in_use(cfg.version)
+            print("Loaded input files of existing jobs from the job store %s" % self.job_store.path)
+            return
+
         # command = 'find -L %s -type f -name "*job" -path "*/%u/*"' % (cfg.output_location, cfg.version)
         command = "eos find -f -name 'job$' %s|grep '/%s/'" % (cfg.output_location, cfg.version)
         all_jobs = []
@@ -37,6 +46,12 @@ class JobCreator(object):
                     self.files_in_use_by_task_and_dataset[task_id][dataset] = dict()
                 job_info = json.load(open(job))
                 njobs += 1
+                # grouped skims are written for the member tasks, so
+                # their inputs are in use by the member tasks as well
+                member_ids = []
+                if 'skims' in job_info:
+                    for name in job_info['skims']:
+                        member_ids.append("%s-%s" % (match.group(1), name))
                 for file in job_info['input']:
                     # get eos file name without xrootd prefix
                     file = re.sub("^.*?\/eos\/cms\/store\/", "/eos/cms/store/", file)
@@ -45,7 +60,15 @@ class JobCreator(object):
                                         "Task: %s\nDataset: %s\nFile: %s" % (task_id, dataset, file))
                     else:
                         self.files_in_use_by_task_and_dataset[task_id][dataset][file] = 1
+                    for member_id in member_ids:
+                        if member_id not in self.files_in_use_by_task_and_dataset:
+                            self.files_in_use_by_task_and_dataset[member_id] = dict()
+                        if dataset not in self.files_in_use_by_task_and_dataset[member_id]:
+                            self.files_in_use_by_task_and_dataset[member_id][dataset] = dict()
+                        self.files_in_use_by_task_and_dataset[member_id][dataset][file] = 1
         print("Number of processed valid jobs: %u" % njobs)
+        if self.job_store is not None:
+            self.job_store.rebuild(all_jobs, cfg.version, cfg.require_log_for_success)
         # exit()
 
     def find_all_inputs(self):
@@ -72,14 +95,147 @@ class JobCreator(object):
         """Generate unique file name based on the hash of input file names"""
         return hashlib.md5((",".join(input_files)).encode("utf-8")).hexdigest()
 
+    def get_active_tasks(self):
+        """Get active tasks with skims sharing a skim_group merged
+
+        SimpleSkimmer tasks with the same skim_group are combined into
+        a single MultiSkimmer task, which reads each input file once
+        and writes all skims. The members must have the same
+        input_pattern, type and lumi_mask.
+        """
+        tasks = []
+        groups = dict()
+        for task in cfg.tasks:
+            if task['name'] not in cfg.active_tasks[task['type']]:
+                continue
+            if 'skim_group' not in task:
+                tasks.append(task)
+                continue
+            if task['processor'] != 'SimpleSkimmer':
+                raise Exception("Only SimpleSkimmer tasks can be grouped. Task: %s" % task['name'])
+
+            group_name = task['skim_group']
+            if group_name not in groups:
+                groups[group_name] = {
+                    'input_pattern':task['input_pattern'],
+                    'processor':'MultiSkimmer',
+                    'name':group_name,
+                    'type':task['type'],
+                    'files_per_job':task['files_per_job'],
+                    'skims':dict(),
+                }
+                if 'lumi_mask' in task:
+                    groups[group_name]['lumi_mask'] = task['lumi_mask']
+                tasks.append(groups[group_name])
+            group = groups[group_name]
+
+            for key in ['input_pattern', 'type', 'lumi_mask']:
+                if group.get(key) != task.get(key):
+                    raise Exception("Task %s doesn't match %s of skim group %s" % (task['name'], key, group_name))
+            group['files_per_job'] = min(group['files_per_job'], task['files_per_job'])
+            for key in ['events_per_job', 'bytes_per_job']:
+                if key in task:
+                    group[key] = min(group.get(key, task[key]), task[key])
+
+            skim_info = dict()
+            for key, value in list(task.items()):
+                if key in ['files_per_job', 'events_per_job', 'bytes_per_job', 'type', 'name',
+                           'input_pattern', 'processor', 'skim_group', 'lumi_mask']:
+                    continue
+                skim_info[key] = value
+            group['skims'][task['name']] = skim_info
+        return tasks
+
+    def get_metadata(self):
+        """Open the file metadata cache on first use"""
+        if self.metadata == None:
+            self.metadata = open_file_metadata_cache()
+        return self.metadata
+
+    def split_inputs(self, task, inputs, allow_small_jobs=False):
+        """Split input files in groups for jobs
+
+        By default each job gets files_per_job files. With events_per_job
+        or bytes_per_job files are added to a job until the target is
+        reached, using entries and sizes from the file metadata cache.
+        Files are taken in the order they are given, so the same inputs
+        always make the same jobs with the same ids. The last incomplete
+        group is skipped unless allow_small_jobs is set. Files that
+        cannot be read are reported and left for the next run.
+        """
+        if 'events_per_job' in task:
+            target = task['events_per_job']
+            weight = self.get_metadata().n_events
+        elif 'bytes_per_job' in task:
+            target = task['bytes_per_job']
+            weight = self.get_metadata().n_bytes
+        else:
+            n_elements = len(inputs)
+            n = task['files_per_job']
+            groups = []
+            for i in range(0, n_elements, n):
+                if not allow_small_jobs and i + n >= n_elements:
+                    break
+                groups.append(inputs[i : i + n])
+            return groups
+
+        groups = []
+        group = []
+        total = 0
+        for input in inputs:
+            try:
+                if not self.get_metadata().metadata(input)['readable']:
+                    print("WARNING: skip input file that cannot be opened %s" % input)
+                    continue
+                input_weight = weight(input)
+            except Exception as e:
+                print("WARNING: skip input file %s: %s" % (input, e))
+                continue
+            group.append(input)
+            total += input_weight
+            if total >= target:
+                groups.append(group)
+                group = []
+                total = 0
+        if allow_small_jobs and len(group) > 0:
+            groups.append(group)
+        return groups
+
+    def is_in_use(self, task_id, dataset, input):
+        """Check if an input file is used by an existing job of the task"""
+        if task_id not in self.files_in_use_by_task_and_dataset:
+            return False
+        if dataset not in self.files_in_use_by_task_and_dataset[task_id]:
+            return False
+        return input in self.files_in_use_by_task_and_dataset[task_id][dataset]
+
+    def is_in_use_by_skims(self, task, dataset, input):
+        """Check if an input file is already processed by the members of a skim group
+
+        Grouped skims write into the output areas of their tasks, so
+        a file processed by a member task on its own must not go into a
+        group job again. A file processed by some members but not by
+        the others cannot be grouped without duplicating events, so it
+        is skipped for the group with a warning.
+        """
+        used_by = []
+        for name in task['skims']:
+            if self.is_in_use("%s-%s" % (task['type'], name), dataset, input):
+                used_by.append(name)
+        if len(used_by) == 0:
+            return False
+        if len(used_by) != len(task['skims']):
+            print("WARNING: skip input file %s for skim group %s. It is already used by the jobs of %s, "
+                  "but not by the other tasks of the group. Process it without the skim group." % \
+                  (input, task['name'], ", ".join(sorted(used_by))))
+        return True
+
     def create_new_jobs(self, allow_small_jobs=False):
         """Find new files and create jobs"""
 
         report = dict()
         
-        for task in cfg.tasks:
-            if task['name'] not in cfg.active_tasks[task['type']]:
-                continue
+        for task in self.get_active_tasks():
             task_id = "%s-%s" % (task['type'], task['name'])
             print("Processing task %s" % task_id)
 
@@ -89,21 +245,16 @@ class JobCreator(object):
                 # find new inputs
                 new_inputs = []
                 for input in ds_inputs:
-                    if task_id in self.files_in_use_by_task_and_dataset:
-                        if dataset in self.files_in_use_by_task_and_dataset[task_id]:
-                            if input in self.files_in_use_by_task_and_dataset[task_id][dataset]:
-                                continue
+                    if self.is_in_use(task_id, dataset, input):
+                        continue
+                    if 'skims' in task and self.is_in_use_by_skims(task, dataset, input):
+                        continue
                     new_inputs.append(input)
 
                 # create jobs
-                n_elements = len(new_inputs)
-                n = task['files_per_job']
                 njobs = 0
-                for i in range(0, n_elements, n):
-                    if not allow_small_jobs and i + n >= n_elements:
-                        break
-                    # get input
-                    inputs = new_inputs[i : i + n]
+                new_jobs = dict()
+                for inputs in self.split_inputs(task, new_inputs, allow_small_jobs):
                     inputs.sort()
 
                     # create job unique id
@@ -112,7 +263,7 @@ class JobCreator(object):
                     # prepare job information
                     job_info = dict()
                     for key, value in list(task.items()):
-                        if key in ['files_per_job', 'type', 'name', 'input_pattern']:
+                        if key in ['files_per_job', 'events_per_job', 'bytes_per_job', 'type', 'name', 'input_pattern']:
                             continue
                         job_info[key] = value
                     job_info['input'] = []
@@ -126,10 +277,24 @@ class JobCreator(object):
                         # os.makedirs(job_dir)
                         subprocess.call("mkdir -p %s" % job_dir, shell=True)
                     job_filename = "%s/%s.job" % (job_dir, job_id)
+
+                    # grouped skims are stored in the areas of their tasks
+                    if 'skims' in job_info:
+                        job_info['skims'] = dict()
+                        for name, skim_info in list(task['skims'].items()):
+                            skim_dir = "%s/%s/%s/%s/%s" % (cfg.output_location, task['type'], cfg.version,
+                                                           name, dataset)
+                            if not os.path.exists(skim_dir):
+                                subprocess.call("mkdir -p %s" % skim_dir, shell=True)
+                            job_info['skims'][name] = dict(skim_info)
+                            job_info['skims'][name]['output'] = "%s/%s.root" % (skim_dir, job_id)
                     
                     # save job
                     json.dump(job_info, open(job_filename, "w"))
+                    new_jobs[job_filename] = job_info
                     njobs += 1
+                if self.job_store is not None and len(new_jobs) > 0:
+                    self.job_store.add_jobs(new_jobs)
                 if len(new_inputs) > 0:
                     print("  Dataset %s" % dataset)
                     print("    Number of new input files %u" % len(new_inputs))
@@ -138,8 +303,77 @@ class JobCreator(object):
         print("Number of new job created:")
         for task_id in sorted(report, key=report.get, reverse=True):
             print("\t%4u %s" % (report[task_id], task_id))
-                            
+
+def _job_runtimes(jobs, entries, rate, file_overhead):
+    """Runtime model: event processing plus opening files"""
+    return [sum(entries[f] for f in job) / rate + file_overhead * len(job) for job in jobs]
+
+def _makespan(runtimes, n_slots):
+    """Time to process jobs in order on n_slots parallel slots"""
+    import heapq
+    slots = [0.] * n_slots
+    for runtime in runtimes:
+        heapq.heappush(slots, heapq.heappop(slots) + runtime)
+    return max(slots)
+
+def benchmark(n_files=5000, files_per_job=20, rate=1000., file_overhead=2., n_slots=50):
+    """Compare job runtime spread for file and event based splitting
+
+    Synthetic dataset with a log-normal distribution of file entries.
+    The event target is chosen to give the same number of jobs.
+    """
+    import tempfile, shutil, time, statistics
+    import numpy as np
+
+    rng = np.random.default_rng(1)
+    tmp_dir = tempfile.mkdtemp()
+    entries = dict()
+    for i, n in enumerate(rng.lognormal(np.log(20000), 1.0, n_files).astype(int)):
+        entries["%s/Dataset/%06u.root" % (tmp_dir, i)] = int(n)
+    inputs = sorted(entries)
+    os.makedirs("%s/Dataset" % tmp_dir)
+    for file in inputs:
+        open(file, "w").close()
+
+    cfg.job_store = None
+    cfg.file_metadata_cache = "%s/file_metadata.db" % tmp_dir
+    jc = JobCreator()
+    metadata = jc.get_metadata()
+    for file, n in entries.items():
+        size, mtime = metadata.stat(file)
+        metadata.put(file, size, mtime, {'entries':n, 'bytes':n * 1000})
+
+    n_jobs = n_files // files_per_job
+    tasks = [
+        ("files_per_job=%u" % files_per_job, {'files_per_job':files_per_job}),
+        ("events_per_job=%u" % (sum(entries.values()) // n_jobs),
+         {'files_per_job':files_per_job, 'events_per_job':sum(entries.values()) // n_jobs}),
+    ]
+    print("%u files, %u events" % (n_files, sum(entries.values())))
+    print("%-22s %5s %8s %8s %8s %8s %9s %9s" % ("splitting", "jobs", "min", "median", "max",
+                                                 "std/mean", "max/mean", "makespan"))
+    for name, task in tasks:
+        t0 = time.perf_counter()
+        jobs = jc.split_inputs(task, inputs, allow_small_jobs=True)
+        dt = time.perf_counter() - t0
+        if sorted(f for job in jobs for f in job) != inputs:
+            raise Exception("Input files are lost or duplicated")
+        if [jc.filename(job) for job in jc.split_inputs(task, inputs, True)] != [jc.filename(job) for job in jobs]:
+            raise Exception("Job ids are not stable")
+        runtimes = _job_runtimes(jobs, entries, rate, file_overhead)
+        mean = statistics.mean(runtimes)
+        print("%-22s %5u %7.0fs %7.0fs %7.0fs %8.2f %9.2f %8.0fs   (split in %.2f sec)" % \
+              (name, len(jobs), min(runtimes), statistics.median(runtimes), max(runtimes),
+               statistics.pstdev(runtimes) / mean, max(runtimes) / mean,
+               _makespan(runtimes, n_slots), dt))
+
+    shutil.rmtree(tmp_dir)
+
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+        sys.exit()
 
     jc = JobCreator()
     jc.find_all_inputs()
@@ -1,10 +1,12 @@
 import postprocessing_cfg as cfg
-import time, subprocess, re, os, shutil, json
+import time, subprocess, re, os, shutil, json, sys, glob
 from LocalResourceHandler import LocalResourceHandler
 from SSHResourceHandler import SSHResourceHandler
 from Skimmer import Skimmer
 from FlatNtupleForBmmMva import FlatNtupleForBmmMva
 from FlatNtupleForMLFit import FlatNtupleForMLFit
+from JobStore import open_job_store
+from JobEvents import JobEvents, JobFileWatcher, AdaptiveInterval
 from pprint import pprint
 
 def eos_remove(file):
@@ -22,6 +24,7 @@ class JobDispatcher(object):
         self.jobs_by_status = None
         self.submitted_jobs = dict()
         self.running_jobs = []
+        self.job_store = open_job_store()
 
         self._load_existing_jobs()
 
@@ -76,8 +79,19 @@ class JobDispatcher(object):
                 self.submitted_jobs[resource_name].remove(job)
         return finished_jobs
         
-    def get_job_status(self, job):
-        """Determine job status based on existance of associated files and running information"""
+    def get_job_status(self, job, stored_status=None):
+        """Determine job status based on existance of associated files and running information
+
+        Final states from the job store (Done and Failed) are taken as
+        they are, since they change only when failures are reset. Jobs
+        reported as running by the resources are not checked either.
+        Files are checked only for the other jobs.
+        """
+        if stored_status in ["Done", "Failed"]:
+            return stored_status
+        if stored_status in ["Running", "Submitted"] and job in self.running_jobs:
+            return "Running"
+
         job_info = self._job_info(job)
         if os.path.exists(job_info['lock']):
             if job not in self.running_jobs:
@@ -100,20 +114,35 @@ class JobDispatcher(object):
     def _load_existing_jobs(self):
         """Find existings jobs and store their input"""
         print("Loading existing jobs...")
+        if self.job_store is not None and len(self.job_store) > 0:
+            self.all_jobs = self.job_store.get_jobs(cfg.version)
+            print("Found %u jobs in the job store %s" % (len(self.all_jobs), self.job_store.path))
+            return
         # command = 'find -L %s -type f -name "*job" -path "*/%u/*"' % (cfg.output_location, cfg.version)
         command = "eos find -f -name 'job$' %s|grep '/%s/'" % (cfg.output_location, cfg.version)
         self.all_jobs = subprocess.check_output(command, shell=True, encoding='utf8').splitlines()
         print("Found %u jobs" % len(self.all_jobs))
+        if self.job_store is not None:
+            self.job_store.rebuild(self.all_jobs, cfg.version, cfg.require_log_for_success)
 
     def update_status_of_jobs(self):
         """Classify jobs by status and store in corresponding lists"""
         self.jobs_by_status = {}
         self.update_running_jobs()
+        stored_statuses = dict()
+        if self.job_store is not None:
+            stored_statuses = self.job_store.get_statuses(cfg.version)
+        changed_statuses = dict()
         for job in self.all_jobs:
-            status = self.get_job_status(job)
+            status = self.get_job_status(job, stored_statuses.get(job))
             if status not in self.jobs_by_status:
                 self.jobs_by_status[status] = []
             self.jobs_by_status[status].append(job)
+            if self.job_store is not None and status != stored_statuses.get(job):
+                if status != "New" or stored_statuses.get(job) != "Submitted":
+                    changed_statuses[job] = status
+        if len(changed_statuses) > 0:
+            self.job_store.update_statuses(changed_statuses)
 
         for status in self.jobs_by_status:
             print("\t%s: %u" % (status, len(self.jobs_by_status[status])))
@@ -125,6 +154,39 @@ class JobDispatcher(object):
             n_running += resource.number_of_running_jobs(owned)
         return n_running
             
+    def _submit_to_free_slots(self):
+        """Fill free slots of all resources with new jobs"""
+        submitted = set()
+        for jobs in self.submitted_jobs.values():
+            submitted.update(jobs)
+        n_submitted = 0
+        for resource in self.resources():
+            finished_jobs = self.get_finished_jobs(resource.name())
+            for job in finished_jobs:
+                print("\t%s finished" % job)
+            n_slots = resource.number_of_free_slots()
+            print("%s has %u free slots" % (resource.name(), n_slots))
+            jobs_to_submit = []
+            for i in range(n_slots):
+                # skip jobs that are submitted, but not started yet
+                while len(self.jobs_by_status['New']) > 0 and self.jobs_by_status['New'][-1] in submitted:
+                    self.jobs_by_status['New'].pop()
+                if len(self.jobs_by_status['New']) > 0:
+                    jobs_to_submit.append(self.jobs_by_status['New'].pop())
+                else:
+                    break
+            if len(jobs_to_submit) == 0:
+                continue
+            if resource.name() not in self.submitted_jobs:
+                self.submitted_jobs[resource.name()] = set()
+            self.submitted_jobs[resource.name()].update(jobs_to_submit)
+            resource.submit_jobs(jobs_to_submit)
+            if self.job_store is not None:
+                for job in jobs_to_submit:
+                    self.job_store.set_status(job, "Submitted", resource.name())
+            n_submitted += len(jobs_to_submit)
+        return n_submitted
+
     def process_jobs(self):
         """Process available jobs"""
 
@@ -139,22 +201,62 @@ class JobDispatcher(object):
                 if 'New' not in self.jobs_by_status or self.jobs_by_status['New'] == 0:
                     print("No new jobs is found.")
                     break
-            for resource in self.resources():
-                finished_jobs = self.get_finished_jobs(resource.name())
-                for job in finished_jobs:
-                    print("\t%s finished" % job)
-                n_slots = resource.number_of_free_slots()
-                print("%s has %u free slots" % (resource.name(), n_slots))
-                for i in range(n_slots):
-                    if len(self.jobs_by_status['New']) > 0:
-                        job_to_submit = self.jobs_by_status['New'].pop()
-                        if resource.name() not in self.submitted_jobs:
-                            self.submitted_jobs[resource.name()] = set()
-                        self.submitted_jobs[resource.name()].add(job_to_submit)
-                        resource.submit_job(job_to_submit)
-                    else:
-                        break
-            time.sleep(60)
+            self._submit_to_free_slots()
+            time.sleep(self.sleep)
+
+        # finalize running jobs
+        print("Finalizing running jobs")
+        while True:
+            n_running = self.number_of_running_jobs(owned=True)
+            print("Number of running jobs: %u" % n_running)
+            if n_running == 0:
+                break
+            time.sleep(self.sleep)
+
+    def process_jobs_on_events(self, min_rescan_interval=60, max_rescan_interval=900, poll_interval=30):
+        """Process available jobs reacting on job completion events
+
+        Free slots are refilled as soon as a resource handler reports a
+        finished job or the files of a submitted job change. The full
+        list of jobs is rescanned on an adaptive interval, which grows
+        while no new jobs appear and resets when they do.
+        """
+        events = JobEvents()
+        watcher = JobFileWatcher(events, poll_interval)
+        for resource in self.resources():
+            resource.set_event_queue(events)
+        rescan = AdaptiveInterval(min_rescan_interval, max_rescan_interval)
+
+        # submit jobs
+        print("Submitting new jobs")
+        self.update_status_of_jobs()
+        last_rescan = time.time()
+        while time.time() < self.end_time:
+            n_new = len(self.jobs_by_status.get('New', []))
+            if n_new == 0 or time.time() - last_rescan > rescan.interval:
+                if n_new == 0:
+                    print("No new jobs to submit. Reloading to check if new jobs where injected")
+                self._load_existing_jobs()
+                self.update_status_of_jobs()
+                last_rescan = time.time()
+                if len(self.jobs_by_status.get('New', [])) > n_new:
+                    rescan.reset()
+                else:
+                    rescan.grow()
+                if 'New' not in self.jobs_by_status:
+                    print("No new jobs is found.")
+                    break
+            else:
+                self.update_running_jobs()
+
+            self._submit_to_free_slots()
+            submitted = set()
+            for jobs in self.submitted_jobs.values():
+                submitted.update(jobs)
+            watcher.set_jobs(submitted)
+
+            # any event is a reason to check for free slots
+            events.wait(max(0, last_rescan + rescan.interval - time.time()))
 
         # finalize running jobs
         print("Finalizing running jobs")
@@ -163,7 +265,8 @@ class JobDispatcher(object):
             print("Number of running jobs: %u" % n_running)
             if n_running == 0:
                 break
-            time.sleep(60)
+            events.wait(poll_interval)
+        watcher.stop()
             
     def show_failures(self):
         self.update_status_of_jobs()
@@ -218,6 +321,12 @@ class JobDispatcher(object):
 
         # back up existing output
         for job in jobs_to_reset:
+            # the state may have changed since it was stored
+            status = self.get_job_status(job)
+            if status != "Failed":
+                if self.job_store is not None:
+                    self.job_store.set_status(job, status)
+                continue
             job_info = self._job_info(job)
     
             for f in [job_info['output'], job_info['lock'], job_info['log']]:
@@ -228,6 +337,8 @@ class JobDispatcher(object):
                 # backup latest failure
                 if os.path.exists(f):
                     shutil.move(f, f + ".failed")
+            if self.job_store is not None:
+                self.job_store.set_status(job, "New")
 
     def kill_all_jobs(self):
         for resource in self.resources():
@@ -371,7 +482,134 @@ class JobDispatcher(object):
                     with open("%s/%s.html" % (path, task_name), "w") as f:
                         f.write(report_template % (task_name + ".json"))
                             
+_synthetic_job_code = """
+import sys, os, re, time
+job, duration = sys.argv[1], float(sys.argv[2])
+fname = re.sub('\\.job$', '', job)
+open(fname + '.lock', 'w').close()
+time.sleep(duration)
+open(fname + '.root', 'w').close()
+os.remove(fname + '.lock')
+open(fname + '.log', 'w').close()
+"""
+
+class _SyntheticResourceHandler(LocalResourceHandler):
+    """Local resource running sleeping jobs with durations from their job files"""
+    def __init__(self, max_number_of_jobs_running):
+        super(_SyntheticResourceHandler, self).__init__(max_number_of_jobs_running)
+        self.runtimes = []
+
+    def _job_command(self, job):
+        return [sys.executable, "-c", _synthetic_job_code, job, str(json.load(open(job))['duration'])]
+
+    def _wait_for_job(self, job, proc):
+        t0 = time.time()
+        super(_SyntheticResourceHandler, self)._wait_for_job(job, proc)
+        self.runtimes.append(time.time() - t0)
+
+    def _get_running_jobs(self):
+        return list(self.processes)
+
+class _SyntheticDispatcher(JobDispatcher):
+    """Dispatcher for synthetic jobs in a local directory"""
+    def __init__(self, job_dir, n_slots):
+        self.job_dir = job_dir
+        self.n_slots = n_slots
+        super(_SyntheticDispatcher, self).__init__()
+
+    def _init_resources(self):
+        self._resources = [_SyntheticResourceHandler(self.n_slots)]
+
+    def _load_existing_jobs(self):
+        self.all_jobs = sorted(glob.glob("%s/*/*/*/*/*.job" % self.job_dir))
+
+def benchmark_status(n_jobs=100000, n_cycles=3):
+    """Time of update_status_of_jobs with and without the job store
+
+    80% of the jobs are done, 5% failed and the rest are new. The jobs
+    are on a local disk, where a file check is much cheaper than on EOS,
+    so the number of file checks is reported as well.
+    """
+    import random, tempfile
+    random.seed(1)
+    job_dir = tempfile.mkdtemp()
+    path = "%s/Synthetic/%s/test/Dataset" % (job_dir, cfg.version)
+    os.makedirs(path)
+    for i in range(n_jobs):
+        job = "%s/%032x.job" % (path, i)
+        json.dump({'processor':'Synthetic', 'input':['/eos/cms/store/%u.root' % i]}, open(job, "w"))
+        fname = re.sub("\.job$", "", job)
+        r = random.random()
+        if r < 0.8:
+            open(fname + ".root", "w").close()
+            open(fname + ".log", "w").close()
+        elif r < 0.85:
+            open(fname + ".log", "w").close()
+
+    n_checks = [0]
+    exists = os.path.exists
+    def counting_exists(path):
+        n_checks[0] += 1
+        return exists(path)
+
+    for job_store in [None, "%s/jobs.db" % job_dir]:
+        cfg.job_store = job_store
+        jd = _SyntheticDispatcher(job_dir, 1)
+        if jd.job_store is not None:
+            jd.job_store.rebuild(jd.all_jobs, cfg.version, cfg.require_log_for_success)
+        for cycle in range(n_cycles):
+            n_checks[0] = 0
+            os.path.exists = counting_exists
+            t0 = time.perf_counter()
+            try:
+                jd.update_status_of_jobs()
+            finally:
+                os.path.exists = exists
+            print("%s, cycle %u: %.2f sec, %u file checks for %u jobs" % \
+                  ("store" if job_store else "files", cycle, time.perf_counter() - t0,
+                   n_checks[0], len(jd.all_jobs)))
+    shutil.rmtree(job_dir)
+
+def benchmark(n_jobs=200, n_slots=8, sleep=5):
+    """Compare slot utilisation and makespan of the dispatch loops
+
+    Synthetic jobs sleep for 0.2-3 sec. The legacy loop wakes up every
+    sleep seconds. The event driven loop uses it as the minimal rescan
+    and polling interval.
+    """
+    import random, tempfile
+    cfg.job_store = None
+    for mode in ["sleep", "events"]:
+        random.seed(1)
+        job_dir = tempfile.mkdtemp()
+        path = "%s/Synthetic/%s/test/Dataset" % (job_dir, cfg.version)
+        os.makedirs(path)
+        for i in range(n_jobs):
+            json.dump({'processor':'Synthetic', 'input':[], 'duration':random.uniform(0.2, 3)},
+                      open("%s/%032x.job" % (path, i), "w"))
+
+        jd = _SyntheticDispatcher(job_dir, n_slots)
+        jd.sleep = sleep
+        t0 = time.time()
+        if mode == "sleep":
+            jd.process_jobs()
+        else:
+            jd.process_jobs_on_events(min_rescan_interval=sleep, max_rescan_interval=10 * sleep,
+                                      poll_interval=sleep)
+        makespan = time.time() - t0
+        runtimes = jd.resources()[0].runtimes
+        shutil.rmtree(job_dir)
+        print("%s: %u jobs, makespan %.1f sec, slot utilisation %.1f%%" % \
+              (mode, len(runtimes), makespan, 100. * sum(runtimes) / (n_slots * makespan)))
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark_status":
+        benchmark_status()
+        sys.exit()
+
     jd = JobDispatcher()
     # jd.kill_all_jobs()
     jd.show_resource_availability()
@@ -379,7 +617,8 @@ if __name__ == "__main__":
     # jd.job_report()
     
     # jd.reset_failures()
-    jd.process_jobs()
+    # jd.process_jobs()
+    jd.process_jobs_on_events()
     jd.show_failures()
     # jd.reset_failures()
     # jd.show_failures()
@@ -0,0 +1,164 @@
+#
+# Job completion events for the event-driven JobDispatcher
+#
+# Resource handlers post an event when they see a job finishing, for
+# example when a child process exits. JobFileWatcher posts events when
+# the lock, log, summary or output files of watched jobs change. It uses
+# inotify for immediate notifications on local file systems and always
+# polls watched jobs, since changes made on other nodes of a network
+# file system are not reported by inotify.
+#
+import ctypes
+import ctypes.util
+import os
+import queue
+import re
+import struct
+import threading
+
+class JobEvents(object):
+    """Thread-safe queue of job events"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def post(self, kind, job, source=None):
+        self.queue.put((kind, job, source))
+
+    def wait(self, timeout):
+        """Wait for events up to timeout seconds. Returns all pending events"""
+        events = []
+        try:
+            events.append(self.queue.get(timeout=timeout))
+            while True:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+class AdaptiveInterval(object):
+    """Interval that grows while nothing happens and resets on activity"""
+
+    def __init__(self, min_interval, max_interval, factor=2.):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+
+    def reset(self):
+        self.interval = self.min_interval
+
+    def grow(self):
+        self.interval = min(self.interval * self.factor, self.max_interval)
+
+class JobFileWatcher(object):
+    """Watch sidecar files of jobs and post events on changes"""
+
+    sidecars = ['.lock', '.log', '.summary', '.root']
+
+    # inotify constants from sys/inotify.h
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_CLOEXEC     = 0x00080000
+
+    def __init__(self, events, poll_interval=10):
+        self.events = events
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.jobs = dict()      # job -> state of its files
+        self.watches = dict()   # watch descriptor -> directory
+        self.directories = dict()
+        self.stopped = threading.Event()
+
+        self.inotify_fd = self._init_inotify()
+        if self.inotify_fd != None:
+            threading.Thread(target=self._read_inotify_events, daemon=True).start()
+        threading.Thread(target=self._poll, daemon=True).start()
+
+    def _init_inotify(self):
+        """Initialize inotify if it's available"""
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+            if fd < 0:
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def _state(self, job):
+        fname = re.sub("\.job$", "", job)
+        return tuple(os.path.exists(fname + sidecar) for sidecar in self.sidecars)
+
+    def watch(self, job):
+        """Start watching a job"""
+        directory = os.path.dirname(job)
+        with self.lock:
+            self.jobs[job] = self._state(job)
+            if self.inotify_fd != None and directory not in self.directories:
+                mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | \
+                       self.IN_CREATE | self.IN_DELETE
+                wd = self.libc.inotify_add_watch(self.inotify_fd, directory.encode(), mask)
+                if wd >= 0:
+                    self.watches[wd] = directory
+                    self.directories[directory] = wd
+
+    def unwatch(self, job):
+        with self.lock:
+            self.jobs.pop(job, None)
+
+    def set_jobs(self, jobs):
+        """Watch only the given jobs"""
+        with self.lock:
+            watched = set(self.jobs)
+        for job in watched - set(jobs):
+            self.unwatch(job)
+        for job in set(jobs) - watched:
+            self.watch(job)
+
+    def stop(self):
+        self.stopped.set()
+        if self.inotify_fd != None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def _check(self, job):
+        """Post an event if the files of a watched job changed"""
+        with self.lock:
+            if job not in self.jobs:
+                return
+            state = self._state(job)
+            if state == self.jobs[job]:
+                return
+            self.jobs[job] = state
+        self.events.post('files', job, 'watcher')
+
+    def _read_inotify_events(self):
+        header = struct.calcsize('iIII')
+        while not self.stopped.is_set():
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except (OSError, TypeError):
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + header : offset + header + length].rstrip(b'\0').decode()
+                offset += header + length
+                directory = self.watches.get(wd)
+                if directory == None:
+                    continue
+                for sidecar in self.sidecars:
+                    if name.endswith(sidecar):
+                        self._check(os.path.join(directory, name[:-len(sidecar)] + ".job"))
+                        break
+
+    def _poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            with self.lock:
+                jobs = list(self.jobs)
+            for job in jobs:
+                self._check(job)
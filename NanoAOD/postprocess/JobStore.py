@@ -0,0 +1,310 @@
+#
+# Job state store for the post-processing
+#
+# Job definitions, state transitions, lock owners and output information
+# are kept in a SQLite database, so that the status of all jobs can be
+# obtained with a single query instead of checking the sidecar files
+# (.lock, .log, .root) of each job on EOS. The files are still produced
+# as before and the store can be rebuilt from them at any time. Done and
+# Failed states are final, so the files of such jobs are not checked
+# again until failures are reset.
+#
+import sqlite3
+import json
+import os
+import re
+import time
+import platform
+
+class JobStore(object):
+    """SQLite based index of jobs and their states
+
+    Stored states:
+      New       - job is created
+      Submitted - job is sent to a resource
+      Running   - job is locked by a processor
+      Done      - output is produced
+      Failed    - processor failed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=600)
+        with self.connection:
+            self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job TEXT PRIMARY KEY,
+                task_type TEXT,
+                version TEXT,
+                task_name TEXT,
+                dataset TEXT,
+                definition TEXT,
+                status TEXT,
+                owner TEXT,
+                updated REAL,
+                output_size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status);
+            CREATE TABLE IF NOT EXISTS inputs (
+                task_id TEXT,
+                dataset TEXT,
+                file TEXT,
+                job TEXT,
+                PRIMARY KEY (task_id, dataset, file)
+            );
+            CREATE TABLE IF NOT EXISTS transitions (
+                job TEXT,
+                status TEXT,
+                owner TEXT,
+                time REAL
+            );
+            CREATE INDEX IF NOT EXISTS transitions_by_job ON transitions (job);
+            """)
+
+    @staticmethod
+    def parse_job_name(job):
+        """Get task type, version, task name and dataset from job name"""
+        match = re.search("([^\/]+)\/([^\/]+)\/([^\/]+)\/([^\/]+)\/[^\/]*?.job$", job)
+        if match:
+            return match.groups()
+        raise Exception("Incorrect job name:\n%s" % job)
+
+    @staticmethod
+    def owner():
+        return "%s:%u" % (platform.node(), os.getpid())
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def _add_job(self, job, job_info, status):
+        task_type, version, task_name, dataset = self.parse_job_name(job)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO jobs (job, task_type, version, task_name, dataset, definition, status, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job, task_type, version, task_name, dataset, json.dumps(job_info), status, time.time()))
+        task_id = "%s-%s" % (task_type, task_name)
+        # grouped skims are written for the member tasks, so their
+        # inputs are in use by the member tasks as well
+        member_ids = []
+        if 'skims' in job_info:
+            for name in job_info['skims']:
+                member_ids.append("%s-%s" % (task_type, name))
+        for file in job_info['input']:
+            # get eos file name without xrootd prefix
+            file = re.sub("^.*?\/eos\/cms\/store\/", "/eos/cms/store/", file)
+            self.connection.execute("INSERT INTO inputs (task_id, dataset, file, job) VALUES (?, ?, ?, ?)",
+                                    (task_id, dataset, file, job))
+            for member_id in member_ids:
+                self.connection.execute("INSERT OR IGNORE INTO inputs (task_id, dataset, file, job) VALUES (?, ?, ?, ?)",
+                                        (member_id, dataset, file, job))
+        self.connection.execute("INSERT INTO transitions (job, status, owner, time) VALUES (?, ?, ?, ?)",
+                                (job, status, self.owner(), time.time()))
+
+    def add_jobs(self, jobs):
+        """Register new jobs in one transaction. jobs is a map between job names and job information"""
+        try:
+            with self.connection:
+                for job, job_info in jobs.items():
+                    self._add_job(job, job_info, "New")
+        except sqlite3.IntegrityError:
+            raise Exception("Found the same input file in different jobs")
+
+    def set_status(self, job, status, owner=None, output_size=None):
+        """Record a state transition"""
+        if owner == None:
+            owner = self.owner()
+        now = time.time()
+        with self.connection:
+            if output_size != None:
+                self.connection.execute("UPDATE jobs SET status=?, owner=?, updated=?, output_size=? WHERE job=?",
+                                        (status, owner, now, output_size, job))
+            else:
+                self.connection.execute("UPDATE jobs SET status=?, owner=?, updated=? WHERE job=?",
+                                        (status, owner, now, job))
+            self.connection.execute("INSERT INTO transitions (job, status, owner, time) VALUES (?, ?, ?, ?)",
+                                    (job, status, owner, now))
+
+    def get_status(self, job):
+        """Stored status of a job or None if job is unknown"""
+        row = self.connection.execute("SELECT status FROM jobs WHERE job=?", (job,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def get_jobs(self, version=None):
+        """All job names, optionally for a given version"""
+        if version == None:
+            rows = self.connection.execute("SELECT job FROM jobs")
+        else:
+            rows = self.connection.execute("SELECT job FROM jobs WHERE version=?", (str(version),))
+        return [row[0] for row in rows]
+
+    def get_statuses(self, version=None):
+        """Map between job names and their stored status"""
+        if version == None:
+            rows = self.connection.execute("SELECT job, status FROM jobs")
+        else:
+            rows = self.connection.execute("SELECT job, status FROM jobs WHERE version=?", (str(version),))
+        return dict(rows)
+
+    def get_files_in_use(self, version=None):
+        """Input files of existing jobs by task and dataset"""
+        files_in_use = dict()
+        query = "SELECT i.task_id, i.dataset, i.file FROM inputs i"
+        if version == None:
+            rows = self.connection.execute(query)
+        else:
+            rows = self.connection.execute(query + " JOIN jobs j ON i.job = j.job WHERE j.version=?",
+                                           (str(version),))
+        for task_id, dataset, file in rows:
+            if task_id not in files_in_use:
+                files_in_use[task_id] = dict()
+            if dataset not in files_in_use[task_id]:
+                files_in_use[task_id][dataset] = dict()
+            files_in_use[task_id][dataset][file] = 1
+        return files_in_use
+
+    def update_statuses(self, statuses):
+        """Record state transitions of many jobs in one transaction"""
+        owner = self.owner()
+        now = time.time()
+        with self.connection:
+            for job, status in statuses.items():
+                self.connection.execute("UPDATE jobs SET status=?, owner=?, updated=? WHERE job=?",
+                                        (status, owner, now, job))
+                self.connection.execute("INSERT INTO transitions (job, status, owner, time) VALUES (?, ?, ?, ?)",
+                                        (job, status, owner, now))
+
+    def get_history(self, job):
+        """State transitions of a job"""
+        return self.connection.execute("SELECT status, owner, time FROM transitions WHERE job=? ORDER BY time",
+                                       (job,)).fetchall()
+
+    @staticmethod
+    def status_from_files(job, require_log_for_success=True):
+        """Get stored status equivalent based on the files of a job
+
+        The information about running jobs is not available, so locked
+        jobs and jobs with only a log are considered as Running.
+        """
+        fname = re.sub("\.job$", "", job)
+        if os.path.exists(fname + ".lock"):
+            return "Running"
+        elif os.path.exists(fname + ".root"):
+            if require_log_for_success and not os.path.exists(fname + ".log"):
+                return "Failed"
+            return "Done"
+        elif os.path.exists(fname + ".log"):
+            return "Running"
+        else:
+            return "New"
+
+    def rebuild(self, jobs, version=None, require_log_for_success=True):
+        """Rebuild the store from job files
+
+        If version is given only jobs of this version are replaced.
+        """
+        with self.connection:
+            if version == None:
+                self.connection.execute("DELETE FROM inputs")
+                self.connection.execute("DELETE FROM transitions")
+                self.connection.execute("DELETE FROM jobs")
+            else:
+                selection = "job IN (SELECT job FROM jobs WHERE version=?)"
+                self.connection.execute("DELETE FROM inputs WHERE " + selection, (str(version),))
+                self.connection.execute("DELETE FROM transitions WHERE " + selection, (str(version),))
+                self.connection.execute("DELETE FROM jobs WHERE version=?", (str(version),))
+            for job in jobs:
+                job_info = json.load(open(job))
+                self._add_job(job, job_info, self.status_from_files(job, require_log_for_success))
+        print("Job store %s is rebuilt from %u jobs" % (self.path, len(jobs)))
+
+
+network_file_systems = ['/afs/', '/eos/', '/cvmfs/']
+
+def open_job_store():
+    """Open the job store defined in the configuration if any
+
+    SQLite locking doesn't work reliably on network file systems, so
+    stores on them are refused.
+    """
+    import postprocessing_cfg as cfg
+    if not hasattr(cfg, 'job_store') or cfg.job_store == None:
+        return None
+    path = os.path.realpath(cfg.job_store)
+    for prefix in network_file_systems:
+        if path.startswith(prefix):
+            raise Exception("Job store %s is on a network file system. Use a local disk." % cfg.job_store)
+    return JobStore(cfg.job_store)
+
+def benchmark(n_jobs=100000, n_lookups=10000):
+    """Compare status queries based on the job files and the store"""
+    import tempfile, shutil, random
+
+    random.seed(1)
+    tmp_dir = tempfile.mkdtemp()
+    jobs = dict()
+    for i in range(n_jobs):
+        dataset = "Dataset%u" % (i % 100)
+        job = "%s/Skims/529/task%u/%s/%032x.job" % (tmp_dir, i % 7, dataset, i)
+        jobs[job] = {'processor':'SimpleSkimmer', 'cut':'mm_mass>0', 'keep':'^(mm_.*)$',
+                     'input':['root://eoscms.cern.ch://eos/cms/store/%s/%u.root' % (dataset, i)]}
+
+    t0 = time.perf_counter()
+    for job, job_info in jobs.items():
+        os.makedirs(os.path.dirname(job), exist_ok=True)
+        json.dump(job_info, open(job, "w"))
+        # random job states
+        fname = re.sub("\.job$", "", job)
+        r = random.random()
+        if r < 0.5:
+            open(fname + ".root", "w").close()
+            open(fname + ".log", "w").close()
+        elif r < 0.6:
+            open(fname + ".lock", "w").close()
+        elif r < 0.7:
+            open(fname + ".log", "w").close()
+    print("Created %u job files in %.1f sec" % (n_jobs, time.perf_counter() - t0))
+
+    store = JobStore("%s/jobs.db" % tmp_dir)
+
+    t0 = time.perf_counter()
+    store.add_jobs(jobs)
+    print("Registered %u jobs in %.2f sec" % (n_jobs, time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    store.rebuild(list(jobs))
+    print("Rebuilt store from files in %.2f sec" % (time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    from_files = dict((job, JobStore.status_from_files(job)) for job in jobs)
+    dt_files = time.perf_counter() - t0
+    print("Status of all jobs from files:     %8.3f sec" % dt_files)
+
+    t0 = time.perf_counter()
+    from_store = store.get_statuses()
+    dt_store = time.perf_counter() - t0
+    print("Status of all jobs from the store: %8.3f sec (x%.0f)" % (dt_store, dt_files / dt_store))
+
+    if from_files != from_store:
+        raise Exception("Store content differs from the job files")
+
+    t0 = time.perf_counter()
+    store.get_files_in_use()
+    print("Input files of all jobs:           %8.3f sec" % (time.perf_counter() - t0))
+
+    sample = random.sample(list(jobs), n_lookups)
+    t0 = time.perf_counter()
+    for job in sample:
+        store.get_status(job)
+    print("Single job status lookups:         %8.0f Hz" % (n_lookups / (time.perf_counter() - t0)))
+
+    t0 = time.perf_counter()
+    for job in sample:
+        store.set_status(job, "Running")
+    print("State transitions:                 %8.0f Hz" % (n_lookups / (time.perf_counter() - t0)))
+
+    shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    benchmark()
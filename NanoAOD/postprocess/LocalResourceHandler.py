@@ -1,27 +1,98 @@
 from PostProcessingBase import ResourceHandler
-import sys, os, subprocess, re, fcntl, time, tempfile
+import sys, os, subprocess, re, time, tempfile, threading, resource, signal
 import postprocessing_cfg as cfg
 
 class LocalResourceHandler(ResourceHandler):
-    """Resource handler for local job execution"""
-    def __init__(self, max_number_of_jobs_running):
+    """Resource handler for local job execution
+
+    Jobs are started as tracked child processes, so running jobs are
+    known without scanning the process table and finished jobs are
+    reaped immediately. Optional per job limits on CPU time (seconds)
+    and address space (MB) are applied with prlimit after the process
+    is spawned and before the job command is started. Jobs started by
+    other dispatchers are found once at start up and followed by their
+    process ids and start times, so that reused process ids are not
+    taken for them.
+    """
+    def __init__(self, max_number_of_jobs_running, cpu_limit=None, memory_limit=None):
         super(LocalResourceHandler, self).__init__()
         self.max_njobs = max_number_of_jobs_running
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.processes = dict()
+        self.foreign_jobs = self._scan_process_table()
+
+    def _job_command(self, job):
+        return ["nice", "bash", "job_starter.sh", self._processor_name(job), job]
+
+    def _set_limits(self, pid):
+        """Apply resource limits to a spawned job process"""
+        if self.cpu_limit != None:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (self.cpu_limit, self.cpu_limit))
+        if self.memory_limit != None:
+            limit = int(self.memory_limit * 1024 * 1024)
+            resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
 
     def _submit_job(self, job):
-        log = re.sub('\.job$', '\.log', job)
-        command = "nice bash job_starter.sh %s %s >& /dev/null &" % (self._processor_name(job), job)
         print("submitting %s" % job)
-        subprocess.call(command, shell=True)
+        # jobs run in their own session to survive the dispatcher like
+        # background shell jobs
+        command = self._job_command(job)
+        has_limits = self.cpu_limit != None or self.memory_limit != None
+        if has_limits:
+            # the shell waits for the end of its input before starting the
+            # job, so the limits are inherited by all job processes
+            command = ["sh", "-c", 'read start; exec "$@"', "sh"] + command
+        proc = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, start_new_session=True,
+                                stdin=subprocess.PIPE if has_limits else subprocess.DEVNULL)
+        if has_limits:
+            try:
+                self._set_limits(proc.pid)
+            except:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+                raise
+            proc.stdin.close()
+        self.processes[job] = proc
+        threading.Thread(target=self._wait_for_job, args=(job, proc), daemon=True).start()
+
+    def _wait_for_job(self, job, proc):
+        """Reap finished job and report it"""
+        proc.wait()
+        if self.processes.get(job) is proc:
+            del self.processes[job]
+        self._job_finished(job)
         
     def _get_running_jobs(self):
-        jobs = []
+        for job, (pid, start_time) in list(self.foreign_jobs.items()):
+            if self._process_start_time(pid) != start_time:
+                del self.foreign_jobs[job]
+        return list(self.processes) + list(self.foreign_jobs)
+
+    @staticmethod
+    def _process_start_time(pid):
+        """Process start time in clock ticks since boot or None if there is no such process"""
+        try:
+            with open("/proc/%u/stat" % pid) as f:
+                stat = f.read()
+        except (FileNotFoundError, ProcessLookupError):
+            return None
+        # the command name may contain spaces and brackets
+        return int(stat[stat.rindex(')') + 2:].split()[19])
+
+    def _scan_process_table(self):
+        """Find jobs and their process ids and start times in the process table"""
+        jobs = dict()
         response = subprocess.check_output("ps -Af", shell=True, encoding='utf8', env={})
         for line in response.splitlines():
             if not re.search('job_starter.sh', line): continue
-            match = re.search('job_starter.sh.*?(\S+\.job)', line)
+            match = re.search('^\S+\s+(\d+).*?job_starter.sh.*?(\S+\.job)', line)
             if match:
-                jobs.append(match.group(1))
+                pid = int(match.group(1))
+                start_time = self._process_start_time(pid)
+                if start_time != None:
+                    jobs[match.group(2)] = (pid, start_time)
         return jobs
 
     def name(self):
@@ -29,6 +100,11 @@ class LocalResourceHandler(ResourceHandler):
 
     def kill_all_jobs(self):
         print("Killing jobs at %s" % self.name())
+        for job, proc in list(self.processes.items()):
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
         response = subprocess.check_output("ps -Af", shell=True, encoding='utf8')
         for line in response.splitlines():
             match = re.search('^\S+\s+(\S+).*?job_starter', line)
@@ -40,6 +116,68 @@ class LocalResourceHandler(ResourceHandler):
         command = "find /tmp/ -type d -name '*%s*' -exec rm -rfv {} \;" % (cfg.tmp_prefix)
         subprocess.call(command, shell=True)
                             
+class _SleepingJobHandler(LocalResourceHandler):
+    """Handler running a sleeping job_starter.sh from a temporary directory"""
+    def __init__(self, max_number_of_jobs_running, starter):
+        super(_SleepingJobHandler, self).__init__(max_number_of_jobs_running)
+        self.starter = starter
+
+    def _job_command(self, job):
+        return ["nice", "bash", self.starter, "Synthetic", job]
+
+def _own_jobs(jobs, path):
+    return dict((job, pid) for job, pid in jobs.items() if job.startswith(path))
+
+def benchmark(n_jobs=64, n_queries=100):
+    """Compare dispatch overhead and running job queries with ps parsing"""
+    import io, contextlib, shutil
+    tmp_dir = tempfile.mkdtemp()
+    starter = "%s/job_starter.sh" % tmp_dir
+    with open(starter, "w") as f:
+        f.write("sleep 600\n")
+    jobs = ["%s/%032x.job" % (tmp_dir, i) for i in range(n_jobs)]
+
+    # background shell jobs found by parsing the process table
+    handler = _SleepingJobHandler(n_jobs, starter)
+    t0 = time.perf_counter()
+    for job in jobs:
+        subprocess.call("nice bash %s Synthetic %s > /dev/null 2>&1 &" % (starter, job), shell=True)
+    dt_submit = time.perf_counter() - t0
+    while len(_own_jobs(handler._scan_process_table(), tmp_dir)) < n_jobs:
+        time.sleep(0.1)
+    t0 = time.perf_counter()
+    for i in range(n_queries):
+        running = _own_jobs(handler._scan_process_table(), tmp_dir)
+    dt_query = time.perf_counter() - t0
+    print("ps parsing:    submission %6.2f ms/job, get_running_jobs %7.3f ms (%u jobs)" % \
+          (1e3 * dt_submit / n_jobs, 1e3 * dt_query / n_queries, len(running)))
+    for pid, start_time in running.values():
+        os.kill(pid, signal.SIGTERM)
+    while len(_own_jobs(handler._scan_process_table(), tmp_dir)) > 0:
+        time.sleep(0.1)
+
+    # tracked child processes
+    handler = _SleepingJobHandler(n_jobs, starter)
+    handler.foreign_jobs = dict()
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        for job in jobs:
+            handler.submit_job(job)
+        dt_submit = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i in range(n_queries):
+        running = handler.get_running_jobs()
+    dt_query = time.perf_counter() - t0
+    print("tracked jobs:  submission %6.2f ms/job, get_running_jobs %7.3f ms (%u jobs)" % \
+          (1e3 * dt_submit / n_jobs, 1e3 * dt_query / n_queries, len(running)))
+    t0 = time.perf_counter()
+    for proc in list(handler.processes.values()):
+        os.killpg(proc.pid, signal.SIGTERM)
+    while len(handler.get_running_jobs()) > 0:
+        time.sleep(0.001)
+    print("tracked jobs:  all jobs killed and reaped in %.1f ms" % (1e3 * (time.perf_counter() - t0)))
+    shutil.rmtree(tmp_dir)
+
 def unit_test():
     lh = LocalResourceHandler(16)
     lh.submit_job("/eos/cms/store/group/phys_muon/dmytro/tmp/skim-test/1960fd1c81fb0d8371a3899fcf5cd36a.job")
@@ -48,4 +186,7 @@ def unit_test():
     print(lh.number_of_free_slots())
             
 if __name__ == "__main__":
-    unit_test()
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+    else:
+        unit_test()
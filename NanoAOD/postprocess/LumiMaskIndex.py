@@ -0,0 +1,158 @@
+#
+# Certification index for run and lumi section lookups
+#
+# Certification JSON files map run numbers to lists of certified lumi
+# section ranges. LumiMaskIndex merges them into sorted non-overlapping
+# intervals of (run, lumi) keys, so that a lookup is a single
+# bisection. Whole arrays of (run, lumi) pairs can be checked at once.
+#
+import bisect
+import json
+import os
+import time
+
+import numpy as np
+
+class LumiMaskIndex(object):
+    """Sorted interval index of certified run and lumi section ranges"""
+
+    def __init__(self, mask):
+        """Build index from certification information
+
+        mask is a map between run numbers (as strings like in the
+        certification JSON files) and lists of [min_lumi, max_lumi]
+        ranges.
+        """
+        self.mask = mask
+
+        intervals = []
+        for run, ranges in mask.items():
+            for min_lumi, max_lumi in ranges:
+                intervals.append((self.key(int(run), min_lumi), self.key(int(run), max_lumi)))
+        intervals.sort()
+
+        # merge overlapping ranges so that bisection finds the only
+        # interval that may contain the key
+        starts = []
+        ends = []
+        for start, end in intervals:
+            if len(ends) > 0 and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+        self.starts = starts
+        self.ends = ends
+        self.starts_array = np.array(starts, dtype=np.uint64)
+        self.ends_array = np.array(ends, dtype=np.uint64)
+
+        # per run lumi ranges for scalar lookups
+        self.lumi_ranges = dict()
+        for start, end in zip(starts, ends):
+            run = start >> 32
+            if run not in self.lumi_ranges:
+                self.lumi_ranges[run] = ([], [])
+            self.lumi_ranges[run][0].append(start & 0xffffffff)
+            self.lumi_ranges[run][1].append(end & 0xffffffff)
+        self.runs = set(int(run) for run in mask)
+
+    @staticmethod
+    def key(run, lumi):
+        """Combined sortable key of a run and lumi section"""
+        return (run << 32) | lumi
+
+    @classmethod
+    def from_files(cls, file_names):
+        """Build index from certification JSON files
+
+        Later files override runs defined in earlier ones.
+        """
+        mask = dict()
+        for file_name in file_names:
+            with open(file_name) as f:
+                mask.update(json.load(f))
+        return cls(mask)
+
+    @classmethod
+    def from_directory(cls, path):
+        """Build index from all certification files in a directory"""
+        return cls.from_files(['%s/%s' % (path, f) for f in os.listdir(path)])
+
+    def __len__(self):
+        return len(self.runs)
+
+    def is_certified_run(self, run):
+        """Check if run has certified lumi sections"""
+        return int(run) in self.runs
+
+    def is_certified(self, run, lumi):
+        """Check if run,lumi pair is certified"""
+        ranges = self.lumi_ranges.get(run)
+        if ranges is None:
+            return False
+        i = bisect.bisect_right(ranges[0], lumi) - 1
+        return i >= 0 and lumi <= ranges[1][i]
+
+    def is_certified_array(self, runs, lumis):
+        """Check a batch of run,lumi pairs. Returns a boolean array"""
+        keys = (np.asarray(runs, dtype=np.uint64) << np.uint64(32)) | np.asarray(lumis, dtype=np.uint64)
+        if len(self.starts) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        i = np.searchsorted(self.starts_array, keys, side='right') - 1
+        return (i >= 0) & (keys <= self.ends_array[np.maximum(i, 0)])
+
+
+def _scan_is_certified(mask, run, lumi):
+    """Linear scan used by Processor before the index was introduced"""
+    run = str(run)
+
+    if run not in mask:
+        return False
+
+    for min_lumi, max_lumi in mask[run]:
+        if lumi >= min_lumi and lumi <= max_lumi:
+            return True
+    return False
+
+def benchmark(n_lookups=1000000):
+    """Compare lookup rates of the linear scan and the index"""
+    rng = np.random.default_rng(1)
+    for type in ['golden', 'muon']:
+        # the same files as loaded by Processor
+        t0 = time.perf_counter()
+        index = LumiMaskIndex.from_directory('certification/%s' % type)
+        print("%s: %u runs, %u intervals, index built in %.3f sec" % \
+              (type, len(index), len(index.starts), time.perf_counter() - t0))
+
+        # random lookups in the range of certified runs
+        run_list = np.array(sorted(index.runs), dtype=np.int64)
+        runs = rng.integers(run_list[0], run_list[-1] + 1, n_lookups)
+        # half of the lookups use certified runs
+        certified = rng.random(n_lookups) < 0.5
+        runs[certified] = rng.choice(run_list, int(certified.sum()))
+        lumis = rng.integers(1, 1500, n_lookups)
+        run_values = runs.tolist()
+        lumi_values = lumis.tolist()
+
+        t0 = time.perf_counter()
+        scan = [_scan_is_certified(index.mask, run, lumi) for run, lumi in zip(run_values, lumi_values)]
+        dt_scan = time.perf_counter() - t0
+        print("\tscan:   %12.0f lookups/s" % (n_lookups / dt_scan))
+
+        t0 = time.perf_counter()
+        scalar = [index.is_certified(run, lumi) for run, lumi in zip(run_values, lumi_values)]
+        dt_scalar = time.perf_counter() - t0
+        print("\tindex:  %12.0f lookups/s (x%.1f)" % (n_lookups / dt_scalar, dt_scan / dt_scalar))
+
+        t0 = time.perf_counter()
+        vectorized = index.is_certified_array(runs, lumis)
+        dt_array = time.perf_counter() - t0
+        print("\tarray:  %12.0f lookups/s (x%.1f)" % (n_lookups / dt_array, dt_scan / dt_array))
+
+        if scan != scalar or scan != vectorized.tolist():
+            raise Exception("Index lookups differ from the linear scan")
+        print("\t%u certified lookups. All methods agree." % sum(scan))
+
+if __name__ == "__main__":
+    benchmark()
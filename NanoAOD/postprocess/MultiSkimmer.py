@@ -0,0 +1,95 @@
+from SimpleSkimmer import SimpleSkimmer
+import time
+import json
+import ROOT
+from ROOT import TFile
+import sys
+import os
+import subprocess
+
+class MultiSkimmer(SimpleSkimmer):
+    """Processor to produce several skims from the same input in one pass.
+
+    The job contains a map of skims with their own cut, keep and
+    output file. All Snapshots are booked in the same RDataFrame graph,
+    so each input file is read once for the whole group. The job output
+    itself contains only the selection information.
+    """
+
+    def _process(self):
+        t0 = time.time()
+
+        # check for missing information
+        for parameter in ['input', 'skims']:
+            if parameter not in self.job_info:
+                raise Exception("Missing input '%s'" % parameter)
+        for name, skim_info in self.job_info['skims'].items():
+            # set default value to keep old jobs functional
+            if 'candidate_loop' not in skim_info:
+                skim_info['candidate_loop'] = True
+            for parameter in ['cut', 'keep', 'candidate_loop', 'output']:
+                if parameter not in skim_info:
+                    raise Exception("Missing input '%s' for skim %s" % (parameter, name))
+
+        # preprocess
+        self._preprocess()
+        if len(self.valid_files) == 0:
+            print("No valid input selected. Write empty ROOT files.")
+            for name in self.job_info['skims']:
+                f = TFile.Open(self._skim_output_tmp(name), "recreate")
+                f.Close()
+            f = TFile.Open(self.job_output_tmp, "recreate")
+            f.Close()
+            return
+
+        df, n_total, n_certified = self._get_input_dataframe()
+
+        results = dict()
+        for name, skim_info in self.job_info['skims'].items():
+            print("Booking skim %s" % name)
+            results[name] = self._book_skim(df, skim_info, self._skim_output_tmp(name), lazy=True)
+
+        # single event loop for all skims
+        n_events = n_certified.GetValue()
+        print("Number of events to process: %d" % n_events)
+        if 'lumi_mask' in self.job_info:
+            print("Number of certified events: %d / %d" % (n_events, n_total.GetValue()))
+        for name, (snapshot, report, n_selected) in results.items():
+            print("Skim %s" % name)
+            print("Number of selected events: %d" % n_selected.GetValue())
+            report.Print()
+
+        # reports
+
+        print("Total time %.1f sec. to process %i events. Rate = %.1f Hz." % ((time.time() - t0), n_events, n_events / (time.time() - t0)))
+
+        if 'verbose' in self.job_info and self.job_info['verbose']:
+            print("Number of event loops: %d" % df.GetNRuns())
+            print("Input data size: %0.3f MB" % (self.file_size_input / 1e6))
+            for name in self.job_info['skims']:
+                file_size_output = os.path.getsize(self._skim_output_tmp(name))
+                print("Output data size for %s: %0.3f MB" % (name, file_size_output / 1e6))
+
+        sys.stdout.flush()
+
+        # Update accounting information
+        for name in self.job_info['skims']:
+            self._store_meta_data(self._skim_output_tmp(name), n_events)
+        self._store_meta_data(self.job_output_tmp, n_events)
+
+    def _skim_output_tmp(self, name):
+        return "%s/%s_%s.root" % (self.tmp_dir, self.job_name, name)
+
+    def _finalize(self):
+        """Move skim outputs to their task areas and finish processing"""
+        info = json.load(open(self.job_lock))
+
+        # check if we own the lock
+        if info['pid'] != os.getpid():
+            raise Exception("The job is locked. Ownership information:\n" + str(info))
+
+        sys.stdout.flush()
+        for name, skim_info in self.job_info['skims'].items():
+            subprocess.call("mv -v %s %s" % (self._skim_output_tmp(name), skim_info['output']), shell=True)
+
+        super(MultiSkimmer, self)._finalize()
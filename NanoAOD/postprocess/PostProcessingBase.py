@@ -11,9 +11,15 @@ from pprint import pprint
 import hashlib
 import fcntl
 import sys
-import shutil
+import multiprocessing
+import multiprocessing.connection
+import traceback
 
 from mtree import MTree
+from CutEngine import CompiledCut, parse_cut, get_branch_counters
+from LumiMaskIndex import LumiMaskIndex
+from JobStore import open_job_store
+from FileMetadata import open_file_metadata_cache
 import ROOT
 from ROOT import TFile, TTree, RDataFrame
 import numpy as np
@@ -22,6 +28,7 @@ class Processor(object):
     """Base class for processors"""
     
     lumi_masks = dict()
+    file_metadata = None
 
     def __init__(self, job_filename, take_ownership=False):
         """Set up job"""
@@ -119,9 +126,7 @@ class Processor(object):
         """Check if certification information is loaded and if not do it"""
         
         if type not in self.lumi_masks:
-            self.lumi_masks[type] = dict()
-            for f in os.listdir('certification/%s' % type):
-                self.lumi_masks[type].update(json.load(open('certification/%s/%s' % (type, f))))
+            self.lumi_masks[type] = LumiMaskIndex.from_directory('certification/%s' % type)
             print("Number of runs in the %s certification: %u" % (type, len(self.lumi_masks[type])))
 
 
@@ -132,9 +137,9 @@ class Processor(object):
         self._load_lumi_mask(type)
         
         parts = []
-        for run in self.lumi_masks[type]:
+        for run in self.lumi_masks[type].mask:
             lumi_parts = []
-            for min_lumi, max_lumi in self.lumi_masks[type][run]:
+            for min_lumi, max_lumi in self.lumi_masks[type].mask[run]:
                 lumi_parts.append(f"{min_lumi}-{max_lumi}")
             if len(lumi_parts) > 0:
                 parts.append(f"{run}:{','.join(lumi_parts)}")
@@ -148,13 +153,7 @@ class Processor(object):
         # load certification information
         self._load_lumi_mask(type)
 
-        # run number is a string in the lumi mask
-        run = str(run)
-
-        if run in self.lumi_masks[type]:
-            return True
-        else:
-            return False
+        return self.lumi_masks[type].is_certified_run(run)
 
 
     def _is_certified_run_lumi(self, run, lumi, type):
@@ -163,33 +162,58 @@ class Processor(object):
         # load certification information
         self._load_lumi_mask(type)
 
-        # run number is a string in the lumi mask
-        run = str(run)
+        return self.lumi_masks[type].is_certified(int(run), int(lumi))
 
-        if run not in self.lumi_masks[type]:
-            return False
+    def _is_certified_run_lumi_array(self, runs, lumis, type):
+        """Check arrays of run,lumi pairs. Returns a boolean array"""
         
-        for min_lumi, max_lumi in self.lumi_masks[type][run]:
-            if lumi >= min_lumi and lumi <= max_lumi:
-                return True
-        return False
+        # load certification information
+        self._load_lumi_mask(type)
+
+        return self.lumi_masks[type].is_certified_array(runs, lumis)
+
+    def _get_file_metadata(self, file_name):
+        """Get input file metadata from the cache or the file itself"""
+        if Processor.file_metadata == None:
+            Processor.file_metadata = open_file_metadata_cache()
+        return Processor.file_metadata.metadata(file_name)
 
     def _is_certified_event(self, event, type):
         """Check if event is certified"""
 
         return self._is_certified_run_lumi(event.run, event.luminosityBlock, type)
 
+    def _is_certified(self, event, type):
+        """Check if event is certified"""
+
+        return self._is_certified_event(event, type)
+
 
     def _process(self):
         """Abstract interface to implement specific processing actions in derived classes"""
         pass
 
+    def _update_job_store(self, status):
+        """Record job state in the job store if it is configured"""
+        store = open_job_store()
+        if store is not None:
+            output_size = None
+            if status == "Done" and os.path.exists(self.job_ouput):
+                output_size = os.path.getsize(self.job_ouput)
+            store.set_status(self.job_filename, status, output_size=output_size)
+
     def process(self):
         """Process job and clean up"""
         self._prepare()
-        self._process()
-        self._finalize()
+        self._update_job_store("Running")
+        try:
+            self._process()
+            self._finalize()
+        except:
+            self._update_job_store("Failed")
+            raise
         self._release_lock()
+        self._update_job_store("Done")
 
 class FlatNtupleBase(Processor):
     """Flat ROOT ntuple producer for BmmScout analysis"""
@@ -197,6 +221,7 @@ class FlatNtupleBase(Processor):
     def __init__(self, job_filename, take_ownership=False):
         self.n_gen_all = None
         self.n_gen_passed = None
+        self.prefetcher = None
         super(FlatNtupleBase, self).__init__(job_filename, take_ownership)
     
 
@@ -214,10 +239,27 @@ class FlatNtupleBase(Processor):
         results = []
         t0 = time.perf_counter()
         n_events = 0
-        for f in self.job_info['input']:
-            result, n = self.process_file(f)
-            n_events += n
-            results.append(result)
+        n_workers = 1
+        if 'workers' in self.job_info:
+            n_workers = min(self.job_info['workers'], len(self.job_info['input']))
+        if n_workers > 1 and 'prefetch' in self.job_info:
+            raise Exception("prefetch is not supported with workers, use one of them")
+        if n_workers > 1:
+            for result, n in self._process_files_in_parallel(n_workers):
+                n_events += n
+                results.append(result)
+        else:
+            if 'prefetch' in self.job_info:
+                self._start_prefetching()
+            try:
+                for f in self.job_info['input']:
+                    result, n = self.process_file(f)
+                    n_events += n
+                    results.append(result)
+                    if self.prefetcher != None:
+                        self.prefetcher.release(f)
+            finally:
+                self._stop_prefetching()
         print(n_events//(time.perf_counter() - t0), "Hz")
 
         print("Merging output.")
@@ -225,10 +267,13 @@ class FlatNtupleBase(Processor):
         good_files = []
         for rfile in results:
             if rfile: good_files.append(rfile)
-        command = "hadd -f %s %s" % (self.job_output_tmp, " ".join(good_files))
-        status = subprocess.call(command, shell=True)
+        merger = ROOT.TFileMerger(False)
+        merger.OutputFile(self.job_output_tmp, "RECREATE")
+        for rfile in good_files:
+            merger.AddFile(rfile)
+        status = merger.Merge()
 
-        if status==0:
+        if status:
             print("Merged output.")
             for file in good_files:
                 os.remove(file)
@@ -255,6 +300,92 @@ class FlatNtupleBase(Processor):
         else:
             raise Exception("Merge failed")
 
+    def _start_prefetching(self):
+        """Copy the next input files to local scratch in the background
+
+        Files are kept in the shared cache prefetch_cache if it's
+        defined and in the job temporary directory otherwise.
+        """
+        from BmmScout.NanoAOD.postprocessing.prefetch import PrefetchCache, FilePrefetcher
+        cache_size = 20e9
+        if 'prefetch_cache_size' in self.job_info:
+            cache_size = self.job_info['prefetch_cache_size']
+        if 'prefetch_cache' in self.job_info:
+            cache = PrefetchCache(self.job_info['prefetch_cache'], maxSize=cache_size)
+        else:
+            cache = PrefetchCache("%s/prefetch" % self.tmp_dir, maxSize=cache_size, keepFiles=False)
+        self.prefetcher = FilePrefetcher(self.job_info['input'], cache, depth=self.job_info['prefetch'])
+
+    def _stop_prefetching(self):
+        if self.prefetcher == None:
+            return
+        self.prefetcher.close()
+        if 'prefetch_cache' not in self.job_info:
+            self.prefetcher.cache.clear()
+        self.prefetcher = None
+
+    def _local_input(self, input_file):
+        """Local copy of an input file if it's prefetched"""
+        if self.prefetcher == None:
+            return input_file
+        return self.prefetcher.get(input_file)
+
+    def _process_files_in_parallel(self, n_workers):
+        """Process input files concurrently in worker processes
+
+        Each file is processed in a fresh forked process producing a
+        partial output. GenFilterInfo counters of the workers are
+        summed in the main process. A worker that fails or dies (ex.
+        segfault or killed) stops the job with an exception.
+        """
+        print("Processing %u files with %u workers" % (len(self.job_info['input']), n_workers))
+        sys.stdout.flush()
+
+        context = multiprocessing.get_context('fork')
+        pending = list(self.job_info['input'])
+        running = dict()
+        worker_results = dict()
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < n_workers:
+                    input_file = pending.pop(0)
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(target=_process_file_in_worker,
+                                              args=(self, input_file, sender))
+                    process.start()
+                    sender.close()
+                    running[receiver] = (process, input_file)
+                for receiver in multiprocessing.connection.wait(list(running)):
+                    process, input_file = running.pop(receiver)
+                    try:
+                        status, value = receiver.recv()
+                    except EOFError:
+                        status, value = False, None
+                    receiver.close()
+                    process.join()
+                    if not status:
+                        if value == None:
+                            raise Exception("Worker processing %s died with exit code %s" %
+                                            (input_file, process.exitcode))
+                        raise Exception("Worker failed to process %s:\n%s" % (input_file, value))
+                    worker_results[input_file] = value
+        finally:
+            for process, input_file in running.values():
+                process.terminate()
+                process.join()
+        results = [worker_results[f] for f in self.job_info['input']]
+
+        outputs = []
+        for result, n, n_gen_all, n_gen_passed in results:
+            if n_gen_all != None:
+                if self.n_gen_all == None:
+                    self.n_gen_all = 0
+                    self.n_gen_passed = 0
+                self.n_gen_all    += n_gen_all
+                self.n_gen_passed += n_gen_passed
+            outputs.append((result, n))
+        return outputs
+
     def _process_events(self):
         raise Exception("Not implemented")
     
@@ -265,6 +396,25 @@ class FlatNtupleBase(Processor):
         dfFinal = df2.Filter("Sum(goodCandidates) > 0", "Event has good candidates")
         dfFinal.Snapshot("Events", file_out, keep)
 
+    def _update_gen_filter_info(self, input_file):
+        """Accumulate GenFilterInfo of an input file"""
+        metadata = self._get_file_metadata(input_file)
+        if metadata['lumis'] != None:
+            if metadata['gen_filter']:
+                if self.n_gen_all == None:
+                    self.n_gen_all = 0
+                    self.n_gen_passed = 0
+                for passed, total in metadata['gen_filter']:
+                    self.n_gen_passed += passed
+                    self.n_gen_all    += total
+        elif metadata['info'] != None:
+            if 'n_gen_all' in metadata['info']:
+                if self.n_gen_all == None:
+                    self.n_gen_all = 0
+                    self.n_gen_passed = 0
+                self.n_gen_passed += metadata['info']['n_gen_passed']
+                self.n_gen_all    += metadata['info']['n_gen_all']
+
     def process_file(self, input_file):
         """Initialize input and output trees and initiate the event loop"""
         print("Processing file: %s" % input_file)
@@ -281,27 +431,8 @@ class FlatNtupleBase(Processor):
         self.tree = MTree(self.job_info['tree_name'], '')
         self._configure_output_tree()
 
-        fin = TFile.Open(input_file)
-
-        # GenFilterInfo
-        lumis = fin.Get("LuminosityBlocks")
-        info = fin.Get("info")
-        if lumis:
-            for lumi in lumis:
-                if hasattr(lumi, 'GenFilter_numEventsPassed'):
-                    if self.n_gen_all == None:
-                        self.n_gen_all = 0
-                        self.n_gen_passed = 0
-                    self.n_gen_passed += lumi.GenFilter_numEventsPassed
-                    self.n_gen_all    += lumi.GenFilter_numEventsTotal
-        elif info:
-            for entry in info:
-                if hasattr(entry, 'n_gen_all'):
-                    if self.n_gen_all == None:
-                        self.n_gen_all = 0
-                        self.n_gen_passed = 0
-                    self.n_gen_passed += entry.n_gen_passed
-                    self.n_gen_all    += entry.n_gen_all
+        self._update_gen_filter_info(input_file)
+        fin = TFile.Open(self._local_input(input_file))
         
         input_tree = fin.Get("Events")
         nevents = input_tree.GetEntries()
@@ -333,54 +464,42 @@ class FlatNtupleBase(Processor):
     def get_cut(self):
         """Parse cut for keywords and add placeholders for tree and index"""
 
-        # load branch info
-        branches = dict()
+        return parse_cut(self.job_info['cut'], get_branch_counters(self.input_tree))
 
-        # collect branch names, corresponding leafs and their event
-        # counter for arrays
-        for br in self.input_tree.GetListOfBranches():
-            name = br.GetName()
-            leaf = br.GetLeaf(name)
-            if leaf.GetLeafCount():
-                branches[name] = leaf.GetLeafCount().GetName()
-            else:
-                branches[name] = ""
+    def get_compiled_cut(self, index):
+        """Compile the task cut for candidates counted by the index branch"""
 
-        # process cut
+        return CompiledCut(self.job_info['cut'], get_branch_counters(self.input_tree), index)
 
-        cut = self.job_info['cut']
 
-        # replace ROOT style AND with the one that is acceptable for python
-        cut = re.sub('\&\&', ' and ', cut)
-
-        # tokenize the cut string into elements so that we can add the tree and element index
-        cut_list = re.split('([^\w\_]+)', cut)
-
-        parsed_cut = ""
-        for i in range(len(cut_list)):
-            if not re.search('^[\w\_]+$', cut_list[i]) or cut_list[i] not in branches:
-                # element is not a branch name, store and move on
-                parsed_cut += cut_list[i]
-            else:
-                # element is a branch name
-
-                # make an index formater for arrays
-                index = branches[cut_list[i]]
-                if index != "":
-                    index = "[{" + index + "}]"
-
-                if i < len(cut_list)-1 and re.search('^\[', cut_list[i+1]):
-                    parsed_cut += "{tree}." + cut_list[i]
-                else:
-                    parsed_cut += "{tree}." + cut_list[i] + index
-        return parsed_cut
+def _process_file_in_worker(processor, input_file, connection):
+    """Process a single input file in a worker process and send back the result"""
+    try:
+        processor.n_gen_all = None
+        processor.n_gen_passed = None
+        result, n = processor.process_file(input_file)
+        sys.stdout.flush()
+        connection.send((True, (result, n, processor.n_gen_all, processor.n_gen_passed)))
+    except BaseException:
+        connection.send((False, traceback.format_exc()))
+    finally:
+        connection.close()
 
 
 class ResourceHandler(object):
     """Base class for resource handlers"""
     def __init__(self):
         self.active_jobs = set() # keep track of submitted jobs by the handler
+        self.events = None
         
+    def set_event_queue(self, events):
+        """Post job completion events to the queue if the handler can detect them"""
+        self.events = events
+
+    def _job_finished(self, job):
+        if self.events is not None:
+            self.events.post('finished', job, self.name())
+
     def _processor_name(self, job):
         job_info = json.load(open(job))
         return job_info['processor']
@@ -390,6 +509,11 @@ class ResourceHandler(object):
         self.active_jobs.add(job)
         self._submit_job(job)
 
+    def submit_jobs(self, jobs):
+        """Submit several jobs. Handlers may submit them in parallel"""
+        for job in jobs:
+            self.submit_job(job)
+
     def _submit_job(self, job):
         raise Exception("Not implemented")
 
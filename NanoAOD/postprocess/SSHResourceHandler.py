@@ -1,18 +1,68 @@
 from PostProcessingBase import ResourceHandler
-import sys, os, subprocess, re, fcntl, time, tempfile
+import sys, os, subprocess, re, time, tempfile, selectors
 import postprocessing_cfg as cfg
 
+class SSHSession(object):
+    """Shell session with non-blocking command execution
+
+    Commands are followed by an echo of a unique end of transmission
+    marker. Output is read only when the session is reported ready by
+    a selector, so waiting for responses doesn't use CPU.
+    """
+    end_of_transmission = "end_of_transmission"
+
+    def __init__(self, shell):
+        self.proc = subprocess.Popen(shell, shell=True,
+                                     stdin  = subprocess.PIPE,
+                                     stdout = subprocess.PIPE
+                                     )
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.counter = 0
+        self.marker = None
+        self.buffer = b""
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def send(self, command):
+        """Send command with the end of transmission echo"""
+        self.counter += 1
+        self.marker = ("%s_%u" % (self.end_of_transmission, self.counter)).encode()
+        self.buffer = b""
+        self.proc.stdin.write((command + "\n").encode())
+        self.proc.stdin.write(b"echo '" + self.marker + b"'\n")
+        self.proc.stdin.flush()
+
+    def read(self):
+        """Read available output. Returns the response once it's complete and None otherwise"""
+        data = os.read(self.fileno(), 65536)
+        if not data:
+            raise Exception("Shell session is closed")
+        self.buffer += data
+        position = self.buffer.find(self.marker)
+        if position < 0:
+            return None
+        # remove end_of_transmission_pattern
+        return self.buffer[:position].decode('utf8').rstrip()
+
 class SSHResourceHandler(ResourceHandler):
-    """Resource handler for ssh-based job execution"""
-    def __init__(self, site, max_number_of_jobs_running, arch=""):
+    """Resource handler for ssh-based job execution
+
+    A pool of n_sessions shell sessions is kept open for the site.
+    Independent commands, like submissions of several jobs, run in
+    parallel in different sessions. shell can replace the ssh command,
+    for example with a local bash for testing.
+    """
+    def __init__(self, site, max_number_of_jobs_running, arch="", n_sessions=1, shell=None, timeout=600):
         super(SSHResourceHandler, self).__init__()
         self.site = site
         self.max_njobs = max_number_of_jobs_running
-        self.proc = subprocess.Popen("ssh -T -x %s 'bash -l'" % site,
-                                     shell=True, encoding='utf8',
-                                     stdin  = subprocess.PIPE,
-                                     stdout = subprocess.PIPE
-                                     )
+        self.timeout = timeout
+        if shell == None:
+            shell = "ssh -T -x %s 'bash -l'" % site
+        self.sessions = [SSHSession(shell) for i in range(n_sessions)]
+        self.selector = selectors.DefaultSelector()
+
         # prepare working area
         workdir = os.getcwd()
         command = f"cd {workdir}\n" 
@@ -20,47 +70,57 @@ class SSHResourceHandler(ResourceHandler):
             command += "cmssw-env --cmsos %s\n" % arch
         command += "eval `scramv1 runtime -sh`"
 
-        self._send_command_and_get_response(command)
+        self._run_commands([command] * n_sessions)
+
+    def _run_commands(self, commands):
+        """Run commands in parallel using all sessions. Returns their responses"""
+        responses = [None] * len(commands)
+        pending = list(enumerate(commands))
+        pending.reverse()
+        idle = list(self.sessions)
+        busy = dict()
+        while len(pending) > 0 or len(busy) > 0:
+            while len(pending) > 0 and len(idle) > 0:
+                index, command = pending.pop()
+                session = idle.pop()
+                session.send(command)
+                busy[session] = index
+                self.selector.register(session, selectors.EVENT_READ)
+            ready = self.selector.select(self.timeout)
+            if len(ready) == 0:
+                raise Exception("No response from %s in %u seconds" % (self.name(), self.timeout))
+            for key, mask in ready:
+                session = key.fileobj
+                response = session.read()
+                if response != None:
+                    self.selector.unregister(session)
+                    responses[busy.pop(session)] = response
+                    idle.append(session)
+        return responses
 
-    def _non_block_read(self):
-        fd = self.proc.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-        try:
-            return self.proc.stdout.read()
-        except:
-            return ""
-        
     def _send_command_and_get_response(self, command):
         # print "%s %s " % (self.name(), command)
-        end_of_transmission = "end_of_transmission"
-
-        # send command with the end of transimission echo
-        self.proc.stdin.write(command + "\n")
-        self.proc.stdin.write("echo '%s'\n" % end_of_transmission)
-        self.proc.stdin.flush()
-
-        response = ""
-        while True:
-            line = self._non_block_read()
-            if line:
-                response += line
-                if re.search(end_of_transmission, line):
-                    break
-        # remove end_of_transmission_pattern
-        response = re.sub("%s.*$" % end_of_transmission, "", response) 
-        return response.rstrip()
+        return self._run_commands([command])[0]
         
     def check_server_status(self):
         # need to check if the server is responding properly within given amount of time
         pass
             
+    def _submit_command(self, job):
+        return "nice bash job_starter.sh %s %s &> /dev/null &" % (self._processor_name(job), job)
+
     def _submit_job(self, job):
-        log = re.sub('\.job$', '\.log', job)
-        command = "nice bash job_starter.sh %s %s &> /dev/null &" % (self._processor_name(job), job)
         print("submitting %s" % job)
             
-        print(self._send_command_and_get_response(command), end=' ')
+        print(self._send_command_and_get_response(self._submit_command(job)), end=' ')
+
+    def submit_jobs(self, jobs):
+        """Submit jobs in parallel using all sessions"""
+        self.active_jobs.update(jobs)
+        for job in jobs:
+            print("submitting %s" % job)
+        for response in self._run_commands([self._submit_command(job) for job in jobs]):
+            print(response, end=' ')
 
     def _get_running_jobs(self):
         jobs = []
@@ -92,6 +152,69 @@ class SSHResourceHandler(ResourceHandler):
         command = "find /tmp/ -type d -name '*%s*' -exec rm -rfv {} \;" % (cfg.tmp_prefix)
         self._send_command_and_get_response(command)
 
+def _busy_wait_command(proc, command):
+    """Command execution with busy waiting used before the session pool"""
+    import fcntl
+    end_of_transmission = "end_of_transmission"
+    proc.stdin.write(command + "\n")
+    proc.stdin.write("echo '%s'\n" % end_of_transmission)
+    proc.stdin.flush()
+
+    fd = proc.stdout.fileno()
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+    response = ""
+    while True:
+        try:
+            line = proc.stdout.read()
+        except:
+            line = ""
+        if line:
+            response += line
+            if re.search(end_of_transmission, line):
+                break
+    response = re.sub("%s.*$" % end_of_transmission, "", response) 
+    return response.rstrip()
+
+class _FakeSubmissionHandler(SSHResourceHandler):
+    """Handler for a local shell with submissions emulating remote work"""
+    delay = 0.002
+
+    def _submit_command(self, job):
+        return "sleep %s; echo %s" % (self.delay, job)
+
+def benchmark(n_submissions=1000, batch_size=32):
+    """Measure submission latency and dispatcher CPU usage with a local fake shell"""
+    import io, contextlib
+    jobs = ["/tmp/fake/%032x.job" % i for i in range(n_submissions)]
+
+    def report(label, t0, cpu0):
+        dt = time.perf_counter() - t0
+        print("%-28s latency %6.2f ms/job, dispatcher CPU %6.2f sec, wall time %6.2f sec" % \
+              (label, 1e3 * dt / n_submissions, time.process_time() - cpu0, dt))
+
+    proc = subprocess.Popen("bash", shell=True, encoding='utf8',
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    t0, cpu0 = time.perf_counter(), time.process_time()
+    for job in jobs:
+        _busy_wait_command(proc, "sleep %s; echo %s" % (_FakeSubmissionHandler.delay, job))
+    report("busy wait, 1 session:", t0, cpu0)
+    proc.kill()
+
+    for n_sessions in [1, 4, 16]:
+        handler = _FakeSubmissionHandler('localhost', n_submissions, n_sessions=n_sessions, shell="bash")
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0, cpu0 = time.perf_counter(), time.process_time()
+            for job in jobs:
+                handler.submit_job(job)
+        report("selector, %u sessions:" % n_sessions, t0, cpu0)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0, cpu0 = time.perf_counter(), time.process_time()
+            for i in range(0, n_submissions, batch_size):
+                handler.submit_jobs(jobs[i : i + batch_size])
+        report("  batches of %u:" % batch_size, t0, cpu0)
+
 def unit_test():
     test_job = "/eos/cms/store/group/phys_muon/dmytro/tmp/skim-test/1960fd1c81fb0d8371a3899fcf5cd36a.job"
     res = SSHResourceHandler('vocms0314.cern.ch', 16)
@@ -99,4 +222,7 @@ def unit_test():
     res.wait_for_jobs_to_finish()
 
 if __name__ == "__main__":
-    unit_test()
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+    else:
+        unit_test()
@@ -16,19 +16,9 @@ class SimpleSkimmer(Processor):
         self.n_gen_passed = None
         self.common_branches = None
         self.valid_files = []
+        self.file_size_input = 0
         super(SimpleSkimmer, self).__init__(job_filename, take_ownership)
 
-    @staticmethod
-    def __get_branches(root_file):
-        tree = root_file.Get("Events")
-        branches = tree.GetListOfBranches()
-
-        branch_names = []
-        for j in range(branches.GetEntries()):
-            branch_names.append(branches.At(j).GetName())
-
-        return branch_names
-
     def _preprocess(self):
         input_files = self.job_info['input']
 
@@ -37,29 +27,38 @@ class SimpleSkimmer(Processor):
             lumi_mask_type = self.job_info['lumi_mask']
 
         for file_name in input_files:
-            root_file = TFile.Open(file_name)
+            metadata = self._get_file_metadata(file_name)
+            if not metadata['readable']:
+                raise Exception("Failed to open %s" % file_name)
+            if metadata['entries'] == None:
+                raise Exception("Events tree is missing in %s" % file_name)
             skip_file = False
             if lumi_mask_type:
                 skip_file = True
 
             # GenFilterInfo
-            lumis = root_file.Get("LuminosityBlocks")
+            lumis = metadata['lumis']
             if lumis:
-                for lumi in lumis:
-                    if lumi_mask_type:
-                        if not self._is_certified_run_lumi(lumi.run, lumi.luminosityBlock, lumi_mask_type):
-                            continue
+                gen_filter = metadata['gen_filter']
+                certified = None
+                if lumi_mask_type:
+                    runs, lumi_blocks = zip(*lumis)
+                    certified = self._is_certified_run_lumi_array(runs, lumi_blocks, lumi_mask_type)
+                    if certified.any():
                         skip_file = False
-                    if hasattr(lumi, 'GenFilter_numEventsPassed'):
+                if gen_filter:
+                    for i, (passed, total) in enumerate(gen_filter):
+                        if certified is not None and not certified[i]:
+                            continue
                         if self.n_gen_all == None:
                             self.n_gen_all = 0
                             self.n_gen_passed = 0
-                        self.n_gen_passed += lumi.GenFilter_numEventsPassed
-                        self.n_gen_all    += lumi.GenFilter_numEventsTotal
+                        self.n_gen_passed += passed
+                        self.n_gen_all    += total
 
             if not skip_file:
                 # Find common branches preserving their order
-                current_branches = self.__get_branches(root_file)
+                current_branches = [name for name, type in metadata['branches']]
 
                 if self.common_branches == None:
                     self.common_branches = current_branches
@@ -70,18 +69,17 @@ class SimpleSkimmer(Processor):
                         if branch in current_branches
                     ]
                 self.valid_files.append(file_name)
+                self.file_size_input += metadata['bytes']
             else:
                 print(f"Ignore {file_name} - not certified")
 
             if 'save_branches' in self.job_info and self.job_info['save_branches'] == True:
                 branch_info_file_name = re.sub(r'\.root$', '.branches', file_name)
                 branch_info_file_name = re.sub(r'^.*?\/eos\/cms', '/eos/cms', branch_info_file_name)
-                branch_names = self.__get_branches(root_file)
+                branch_names = [name for name, type in metadata['branches']]
                 branch_names.sort()
                 with open(branch_info_file_name, 'w') as file:
                     json.dump(branch_names, file, indent=4)
-                    
-            root_file.Close()
 
 
     def _process(self):
@@ -104,74 +102,98 @@ class SimpleSkimmer(Processor):
             f.Close()
             return
         
-        ## get a list of common branches
-        filtered_list = std.vector('string')()
-        for column in self.common_branches:
-            if re.search(self.job_info['keep'], str(column)):
-                filtered_list.push_back(column)
-        print(filtered_list)
+        # all results are booked lazily and filled in the event loop
+        # of the Snapshot
+        df, n_total, n_certified = self._get_input_dataframe()
+        snapshot, report, n_selected = self._book_skim(df, self.job_info, self.job_output_tmp)
+
+        n_events = n_certified.GetValue()
+        print("Number of events to process: %d" % n_events)
+        if 'lumi_mask' in self.job_info:
+            print("Number of certified events: %d / %d" % (n_events, n_total.GetValue()))
+        print("Number of selected events: %d" % n_selected.GetValue())
+        report.Print()
+
+        # reports
+
+        print("Total time %.1f sec. to process %i events. Rate = %.1f Hz." % ((time.time() - t0), n_events, n_events / (time.time() - t0)))
+
+        if 'verbose' in self.job_info and self.job_info['verbose']:
+            file_size_input = self.file_size_input
+            file_size_output = os.path.getsize(self.job_output_tmp)
+
+            print("Number of event loops: %d" % df.GetNRuns())
+
+            print("Input data size: %0.3f MB" % (file_size_input / 1e6))
+            print("Output data size: %0.3f MB" % (file_size_output / 1e6))
+            if file_size_output > 0:
+                print("Reduction is size: %0.1f" % (float(file_size_input) / file_size_output))
+
+        sys.stdout.flush()
+
+        # Update accounting information
+        self._store_meta_data(self.job_output_tmp, n_events)
 
+    def _get_input_dataframe(self):
+        """Set up RDataFrame for valid input files with data certification
+
+        Returns the dataframe and lazy counts of all and certified events.
+        """
         # setup input TChain
-        chain = TChain("Events")
+        self.chain = TChain("Events")
         for file in self.valid_files:
-            chain.Add(file)
+            self.chain.Add(file)
 
         sys.stdout.flush()
 
-        df = RDataFrame(chain)
+        df = RDataFrame(self.chain)
+        n_total = df.Count()
         if 'lumi_mask' in self.job_info:
             self._declare_lumi_mask_code()
             lumi_mask = self._get_lumi_mask(self.job_info['lumi_mask'])
             ROOT.gInterpreter.ProcessLine(f'lumi_mask_string = "{lumi_mask}";')
             df = df.Define("certified", "passed_lumi_mask(run, luminosityBlock)")
             df = df.Filter("certified == 1", "Passed data certification")
-        n_events = df.Count().GetValue()
-        print("Number of events to process: %d" % n_events)
+        n_certified = df.Count()
+
+        return df, n_total, n_certified
+
+    def _book_skim(self, df, skim_info, output_file, lazy=False):
+        """Book selection and Snapshot for a skim definition
 
-        if self.job_info['candidate_loop'] == True:
-            df2 = df.Define("goodCandidates", self.job_info['cut'])
+        skim_info provides cut, keep, candidate_loop and optionally
+        keep_only_common_branches. Returns the Snapshot, the cut-flow
+        report and the lazy count of selected events.
+        """
+        ## get a list of common branches
+        filtered_list = std.vector('string')()
+        for column in self.common_branches:
+            if re.search(skim_info['keep'], str(column)):
+                filtered_list.push_back(column)
+        print(filtered_list)
+
+        if skim_info['candidate_loop'] == True:
+            df2 = df.Define("goodCandidates", skim_info['cut'])
             dfFinal = df2.Filter("Sum(goodCandidates) > 0", "Event has good candidates")
         else:
-            dfFinal = df.Filter(self.job_info['cut'], "Passed selection")
+            dfFinal = df.Filter(skim_info['cut'], "Passed selection")
             
         report = dfFinal.Report()
+        n_selected = dfFinal.Count()
 
-        if 'keep_only_common_branches' in self.job_info and self.job_info['keep_only_common_branches']:
+        options = ROOT.RDF.RSnapshotOptions()
+        options.fLazy = lazy
+        if 'keep_only_common_branches' in skim_info and skim_info['keep_only_common_branches']:
             print("WARNING: keeping only common branches in the output. May lead to data loss")
-            dfFinal.Snapshot("Events", self.job_output_tmp, filtered_list)
+            snapshot = dfFinal.Snapshot("Events", output_file, filtered_list, options)
         else:
-            dfFinal.Snapshot("Events", self.job_output_tmp, self.job_info['keep'])
-            
-        report.Print()
+            snapshot = dfFinal.Snapshot("Events", output_file, skim_info['keep'], options)
 
-        # reports
-
-        print("Total time %.1f sec. to process %i events. Rate = %.1f Hz." % ((time.time() - t0), n_events, n_events / (time.time() - t0)))
-
-        if 'verbose' in self.job_info and self.job_info['verbose']:
-            file_size_input = 0
-            file_size_output = 0
-
-            for file in input_files:
-                f = TFile.Open(file)
-                file_size_input += f.GetSize()
-                f.Close()
-
-            f = TFile.Open(self.job_output_tmp)
-            file_size_output += f.GetSize()
-            f.Close()
-
-            print("Input data size: %0.3f MB" % (file_size_input / 1e6))
-            print("Output data size: %0.3f MB" % (file_size_output / 1e6))
-            if file_size_output > 0:
-                print("Reduction is size: %0.1f" % (float(file_size_input) / file_size_output))
-
-        sys.stdout.flush()
-
-        # Update accounting information
+        return snapshot, report, n_selected
 
-        # Store meta data
-        f = TFile(self.job_output_tmp, "UPDATE")
+    def _store_meta_data(self, file_name, n_events):
+        """Store selection information in the output file"""
+        f = TFile(file_name, "UPDATE")
         t = TTree("info","Selection information")
 
         n_processed = np.empty((1), dtype="i")
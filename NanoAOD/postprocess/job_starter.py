@@ -14,6 +14,7 @@ from FlatNtupleForTrigEfficiency import FlatNtupleForTrigEfficiency
 from FlatNtupleForTrigInfo import FlatNtupleForTrigInfo
 from Skimmer import Skimmer
 from SimpleSkimmer import SimpleSkimmer
+from MultiSkimmer import MultiSkimmer
 import sys
 
 if len(sys.argv)==3:
@@ -17,6 +17,7 @@ class MTree:
         }
         self.defaults = dict()
         self.variables = dict()
+        self.reset_lists = dict()
 
     def addBranch(self, branch_name, branch_type, default_value, title = None):
         """Register new branch.
@@ -33,6 +34,7 @@ class MTree:
         root_type = self.known_types[branch_type]['root']
         self.defaults[branch_name] = default_value
         self.variables[branch_name] = array(array_type,[default_value])
+        self.reset_lists = dict()
         # setattr(self, branch_name, self.variables[branch_name][0])
         self.tree.Branch(branch_name, self.variables[branch_name], "%s/%s"%(branch_name,root_type))
         if title:
@@ -52,10 +54,17 @@ class MTree:
         restrict for branches to reset using branch_list or regular
         expressions.
         """
-        for branch_name,value in self.defaults.items():
-            if branch_list == None or branch_name in branch_list:
-                if regexp == None or re.search(regexp,branch_name):
-                    self.variables[branch_name][0] = value
+        # branch selection is done once per set of restrictions
+        key = (tuple(branch_list) if branch_list != None else None, regexp)
+        if key not in self.reset_lists:
+            self.reset_lists[key] = []
+            for branch_name,value in self.defaults.items():
+                if branch_list == None or branch_name in branch_list:
+                    if regexp == None or re.search(regexp,branch_name):
+                        self.reset_lists[key].append((self.variables[branch_name], value))
+
+        for variable, value in self.reset_lists[key]:
+            variable[0] = value
 
     def fill(self):
         """Store current branch values"""
@@ -99,6 +108,72 @@ def main():
     t.tree.Scan()
     
 
+def _fill_test_file(file_name, n_rows, queue):
+    """Fill a test tree with a mix of branch types and report performance"""
+    import resource, time
+    import numpy as np
+    from ROOT import TFile
+
+    rng = np.random.default_rng(1)
+    values = {
+        'Int_t':     rng.integers(-1000, 1000, n_rows).tolist(),
+        'UInt_t':    rng.integers(0, 1000, n_rows).tolist(),
+        'Float_t':   rng.normal(5, 2, n_rows).tolist(),
+        'ULong64_t': rng.integers(0, 2**40, n_rows).tolist(),
+        'Long64_t':  rng.integers(-2**40, 2**40, n_rows).tolist(),
+    }
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    fout = TFile(file_name, 'recreate')
+    t = MTree("test", "")
+    branches = []
+    for i in range(6):
+        for type in values:
+            name = "%s_%u" % (type, i)
+            t.addBranch(name, type, 0, "%s branch %u" % (type, i))
+            branches.append((name, values[type]))
+
+    t0 = time.perf_counter()
+    for i in range(n_rows):
+        t.reset()
+        for name, column in branches:
+            # leave some branches at their default values
+            if i % 3 != 0 or not name.endswith('_0'):
+                t[name] = column[i]
+        t.fill()
+    dt = time.perf_counter() - t0
+    fout.Write()
+    fout.Close()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    t0 = time.perf_counter()
+    for i in range(n_rows):
+        t.reset()
+    dt_reset = time.perf_counter() - t0
+
+    queue.put((dt / n_rows, dt_reset / n_rows, (rss - rss0) / 1024.))
+
+def benchmark(n_rows=200000):
+    """Fill cost per row and peak memory of a tree with 30 branches"""
+    import multiprocessing, tempfile, os
+
+    tmp_dir = tempfile.mkdtemp()
+    file_name = "%s/mtree.root" % tmp_dir
+    # separate process to measure peak memory
+    queue = multiprocessing.get_context('fork').Queue()
+    p = multiprocessing.get_context('fork').Process(target=_fill_test_file, args=(file_name, n_rows, queue))
+    p.start()
+    cost, reset_cost, memory = queue.get()
+    p.join()
+    os.remove(file_name)
+    os.rmdir(tmp_dir)
+    print("%u rows: %6.2f us/row including %5.2f us/row for reset, peak memory increase %7.1f MB" % \
+          (n_rows, cost * 1e6, reset_cost * 1e6, memory))
+
 if __name__ == "__main__":
     # help(MTree)
-    main()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+    else:
+        main()
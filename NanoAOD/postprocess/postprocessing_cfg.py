@@ -1,5 +1,6 @@
 # Config file for the postprocessor
 from resources_cfg import resources
+import getpass
 
 workdir = "/afs/cern.ch/work/d/dmytro/projects/Run3-Bmm-NanoAODv12/src/BmmScout/NanoAOD/postprocess/"
 # version = 'crab-140x-mm'
@@ -14,6 +15,24 @@ output_location = "/eos/cms/store/group/phys_bphys/bmm/bmm6/PostProcessing"
 xrootd_prefix = "root://eoscms.cern.ch:/"
 web_report_path = "/afs/cern.ch/user/d/dmytro/www/public_html/BmmScout/postprocessing/"
 
+# SQLite job state store shared by JobCreator, JobDispatcher and
+# processors. SQLite locking is not reliable on network file systems,
+# so the store must be on a local disk of the node running all of them.
+# Done and Failed states in the store are final, the files of other jobs
+# are checked on every status update. If job files are changed by hand,
+# remove the store and it will be rebuilt from the job files. Set to None
+# to rely only on job files
+job_store = "/tmp/%s-job_store.db" % getpass.getuser()
+
+# SQLite cache of input file metadata (entries, size, branches, lumis,
+# GenFilter counts) used by JobCreator and processors to avoid opening
+# the same files again. Records are refreshed when the size or
+# modification time of a file changes. Files that cannot be read are
+# not cached. SQLite locking is not reliable on network file systems, so
+# each user keeps the cache on a local disk. Set to None for a per
+# process cache in memory
+file_metadata_cache = "/tmp/%s-file_metadata.db" % getpass.getuser()
+
 debug = False
 tmp_prefix = "tmpPPNA"
 require_log_for_success = True
@@ -276,6 +295,26 @@ cuts["bkmm"] = (
 
 common_branches = "PV_npvs|PV_npvsGood|Pileup_nTrueInt|Pileup_nPU|run|event|luminosityBlock"
 
+# Optional task parameters for FlatNtuples
+#   "workers": N         - process input files of a job with N worker processes
+#   "engine":"rdataframe" - columnar engine (FlatNtupleForMLFit only)
+#   "nthreads": N        - number of ImplicitMT threads for the rdataframe engine
+#   "prefetch": N        - copy the next N input files to local scratch while
+#                          the current one is processed (cannot be combined
+#                          with workers)
+#   "prefetch_cache": path - keep copies in a shared LRU cache at this path
+#   "prefetch_cache_size": N - cache size limit in bytes (default 20 GB)
+
+# Optional task parameters for SimpleSkimmer
+#   "skim_group": name   - skims with the same group name, input_pattern,
+#                          type and lumi_mask are produced by one
+#                          MultiSkimmer job reading the input once
+
+# Optional job splitting parameters for all tasks
+#   "events_per_job": N  - add input files to a job until it has N events
+#   "bytes_per_job": N   - add input files to a job until it has N bytes
+#   Without them jobs have files_per_job input files
+
 tasks = [
 
     ############################
@@ -1,9 +1,13 @@
-import ROOT, copy, subprocess, re
+import copy, subprocess, re, glob
+from FileMetadata import open_file_metadata_cache
 
 path = "/eos/cms/store/group/phys_bphys/bmm/BmmScout/PostProcessing/FlatNtuples/518"
 
 datasets = {}
 
+# sums of the info trees are cached, so only new files are read
+file_metadata = open_file_metadata_cache()
+
 command = 'find -L %s -maxdepth 2 -type d' % (path)
 all_folders = subprocess.check_output(command, shell=True, encoding='utf8').splitlines()
 
@@ -26,10 +30,10 @@ for ds in sorted(datasets):
     print(ds)
     for type in sorted(datasets[ds]):
         print("\t%-30s " % type, end=' ')
-        chain = ROOT.TChain("info")
-        chain.Add("%s/%s/%s/*.root" % (path, type, ds))
         n_processed = 0
-        for entry in chain:
-            n_processed += entry.n_processed
+        for file in glob.glob("%s/%s/%s/*.root" % (path, type, ds)):
+            info = file_metadata.metadata(file)['info']
+            if info != None:
+                n_processed += info.get('n_processed', 0)
         print(" \t:", n_processed)
     
@@ -1,3 +1,8 @@
+# LocalResourceHandler(max_jobs, cpu_limit=None, memory_limit=None)
+# limits CPU time (sec) and address space (MB) of each job
+# SSHResourceHandler(site, max_jobs, arch="", n_sessions=1) keeps
+# n_sessions shell sessions per site to submit jobs in parallel
+
 resources = [
     # 16
     "LocalResourceHandler(16)", # vocms0118.cern.ch
@@ -10,6 +10,7 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import Pos
 import hashlib
 from functools import partial
 import shutil
+from FileMetadata import open_file_metadata_cache
 
 
 version = 510
@@ -280,12 +281,13 @@ def chunks(input_list, n, m):
         result.append(sub_range)
     return result
 
+file_metadata = None
+
 def _is_good_file(f):
-    tf = TFile.Open(f)
-    if not tf: return False
-    if tf.IsZombie() or tf.TestBit(TFile.kRecovered): return False
-    if not tf.Get("Events"): return False
-    return True
+    global file_metadata
+    if file_metadata == None:
+        file_metadata = open_file_metadata_cache()
+    return file_metadata.is_good_file(f)
 
 def output_is_already_available(filename):
     if os.path.exists(filename):
@@ -0,0 +1,511 @@
+"""Generator level ancestry of GenPart collections
+
+Background composition studies and ntuple production need the decay
+history of generator particles: daughters of a common ancestor, the
+closest heavy flavour ancestor, semileptonic decays and decays in
+flight. Walking GenPart_genPartIdxMother in Python for every question
+scans the whole collection each time.
+
+Ancestry (C++) indexes an event once: the daughters of each particle
+are stored in a flat array and all derived quantities are computed for
+all particles in one step
+- hf_ancestor: index of the closest b- or c-hadron ancestor, -1 if none
+- signature: product of the pdgIds of the daughters
+- semileptonic: the daughters include mu and nu_mu of opposite charge
+- charm_semileptonic: c-hadron decaying to mu nu X, possibly through
+  other c-hadrons
+- decay_in_flight: a pion or kaon in the decay chain decays to mu nu
+The index -1 refers to the particles without mother.
+
+The helpers can be used in RDataFrame, ex.
+    gen_ancestry.declare()
+    df.Define("mm_gen_process", "gen_ancestry::classify(GenPart_pdgId, "
+              "GenPart_genPartIdxMother, mm_gen_cpdgId, mm_gen_cindex)")
+or from Python with GenAncestry for a single event.
+
+To compare the rate and the results with the Python loops on a local
+NanoAOD file use
+    python3 gen_ancestry.py file.root
+"""
+import sys
+import time
+import numpy
+import ROOT
+
+# classification of common ancestors of two muons (gen_ancestry::Process)
+processes = [
+    "No common ancestor",
+    "KsToPiPi",
+    "H_b to H_c mu nu, H_c to mu nu X",
+    "H_b to X mu nu, X contains decay in flight",
+    "H_b to H_c X, H_c to mu nu X'",
+    "H_b to H_c H_c', H_c to mu nu X",
+    "H_c to mu nu X",
+    "Unclassified",
+]
+
+_declared = False
+
+def declare():
+    """Declare C++ code of the ancestry engine"""
+    global _declared
+    if _declared:
+        return
+    ROOT.gInterpreter.Declare("""
+    #include <cstdlib>
+    #include "ROOT/RVec.hxx"
+    namespace gen_ancestry {
+        using ROOT::RVec;
+
+        enum Process {
+            kNoCommonAncestor, kKsToPiPi, kHbToHcMuNu, kHbToXMuNuDecayInFlight,
+            kHbToHcX, kHbToHcHc, kHcToMuNuX, kUnclassified
+        };
+
+        // 5 - b-hadron, 4 - c-hadron (single heavy quark), 0 - other
+        inline int hadron_flavour(int pdgId) {
+            int id = std::abs(pdgId);
+            if (id < 100) return 0;
+            if (id >= 1000 && (id / 1000) % 10 != 0) return 0;
+            int q = (id / 100) % 10;
+            return (q == 5 || q == 4) ? q : 0;
+        }
+
+        class Ancestry {
+        public:
+            RVec<int> pdgId, mother;
+            RVec<int> flavour, hf_ancestor, charm_semileptonic, decay_in_flight;
+            // per particle plus the last element for particles without mother
+            RVec<double> signature;
+            RVec<int> semileptonic, n_charm_semileptonic, n_decay_in_flight;
+
+            Ancestry() {}
+
+            Ancestry(const RVec<int>& pdgId_, const RVec<int>& mother_):
+                pdgId(pdgId_), mother(mother_)
+            {
+                const int n = pdgId.size();
+                // daughters of each particle in index order
+                offsets_.assign(n + 2, 0);
+                for (int i = 0; i < n; ++i) {
+                    int s = slot(mother[i]);
+                    if (s >= 0) offsets_[s + 1]++;
+                }
+                for (int s = 0; s <= n; ++s) offsets_[s + 1] += offsets_[s];
+                daughters_.resize(offsets_[n + 1]);
+                RVec<int> fill(offsets_.begin(), offsets_.end() - 1);
+                for (int i = 0; i < n; ++i) {
+                    int s = slot(mother[i]);
+                    if (s >= 0) daughters_[fill[s]++] = i;
+                }
+
+                flavour.resize(n);
+                for (int i = 0; i < n; ++i) flavour[i] = hadron_flavour(pdgId[i]);
+
+                signature.assign(n + 1, 1.);
+                semileptonic.assign(n + 1, 0);
+                for (int s = 0; s <= n; ++s) {
+                    int mu = 0, nu = 0;
+                    for (int k = offsets_[s]; k < offsets_[s + 1]; ++k) {
+                        int id = pdgId[daughters_[k]];
+                        signature[s] *= id;
+                        if (std::abs(id) == 13) mu = id;
+                        if (std::abs(id) == 14) nu = id;
+                    }
+                    semileptonic[s] = mu * nu == -13 * 14;
+                }
+
+                charm_semileptonic_body_.assign(n + 1, kUnknown);
+                for (int s = 0; s <= n; ++s) compute_charm_semileptonic_body(s);
+                decay_in_flight_state_.assign(n, kUnknown);
+                hf_state_.assign(n, kUnknown);
+                hf_ancestor.assign(n, -1);
+                charm_semileptonic.resize(n);
+                decay_in_flight.resize(n);
+                for (int i = 0; i < n; ++i) {
+                    charm_semileptonic[i] = is_charm_semileptonic(i);
+                    decay_in_flight[i] = has_decay_in_flight(i);
+                    find_hf_ancestor(i);
+                }
+                n_charm_semileptonic.assign(n + 1, 0);
+                n_decay_in_flight.assign(n + 1, 0);
+                for (int s = 0; s <= n; ++s) {
+                    for (int k = offsets_[s]; k < offsets_[s + 1]; ++k) {
+                        n_charm_semileptonic[s] += charm_semileptonic[daughters_[k]];
+                        n_decay_in_flight[s] += decay_in_flight[daughters_[k]];
+                    }
+                }
+            }
+
+            // daughters of a particle, -1 for particles without mother
+            RVec<int> daughters(int i) const {
+                int s = slot(i);
+                if (s < 0) return RVec<int>();
+                return RVec<int>(daughters_.begin() + offsets_[s], daughters_.begin() + offsets_[s + 1]);
+            }
+
+            // mother, grandmother, ... of a particle
+            RVec<int> ancestors(int i) const {
+                RVec<int> result;
+                const int n = pdgId.size();
+                while (i >= 0 && i < n && mother[i] >= 0 && mother[i] < n && (int)result.size() < n) {
+                    i = mother[i];
+                    result.push_back(i);
+                }
+                return result;
+            }
+
+            // classify the common ancestor of two muons
+            int classify(int ancestor, int ancestor_index) const {
+                if (ancestor == 0) return kNoCommonAncestor;
+                int s = slot(ancestor_index);
+                int type = hadron_flavour(ancestor);
+                double sig = s >= 0 ? signature[s] : 1.;
+                bool sl = s >= 0 && semileptonic[s];
+                int n_csl = s >= 0 ? n_charm_semileptonic[s] : 0;
+                int n_dif = s >= 0 ? n_decay_in_flight[s] : 0;
+
+                if (std::abs(ancestor) == 310 && sig == -211. * 211.)
+                    return kKsToPiPi;
+                if (type == 5) {
+                    if (sl) {
+                        if (n_csl == 1) return kHbToHcMuNu;
+                        if (n_dif == 1) return kHbToXMuNuDecayInFlight;
+                    } else if (n_csl == 1) {
+                        return kHbToHcX;
+                    } else if (n_csl == 2) {
+                        return kHbToHcHc;
+                    }
+                }
+                if (type == 4 && s >= 0 && charm_semileptonic_body_[s])
+                    return kHcToMuNuX;
+                return kUnclassified;
+            }
+
+        private:
+            enum State { kUnknown = -1, kInProgress = -2 };
+            RVec<int> offsets_, daughters_;
+            RVec<int> charm_semileptonic_body_, decay_in_flight_state_, hf_state_;
+
+            int slot(int i) const {
+                const int n = pdgId.size();
+                if (i == -1) return n;
+                if (i >= 0 && i < n) return i;
+                return -1;
+            }
+
+            // decay to mu nu X, following the first c-hadron daughter
+            bool compute_charm_semileptonic_body(int s) {
+                int& state = charm_semileptonic_body_[s];
+                if (state == kInProgress) return false;
+                if (state != kUnknown) return state;
+                state = kInProgress;
+                int result = semileptonic[s];
+                for (int k = offsets_[s]; k < offsets_[s + 1]; ++k) {
+                    int d = daughters_[k];
+                    if (flavour[d] == 4) {
+                        result = compute_charm_semileptonic_body(d);
+                        break;
+                    }
+                }
+                state = result;
+                return result;
+            }
+
+            bool is_charm_semileptonic(int i) {
+                return flavour[i] == 4 && compute_charm_semileptonic_body(i);
+            }
+
+            // pion or kaon decaying to mu nu in the decay chain
+            bool has_decay_in_flight(int i) {
+                int& state = decay_in_flight_state_[i];
+                if (state == kInProgress) return false;
+                if (state != kUnknown) return state;
+                state = kInProgress;
+                int result = -1;
+                for (int k = offsets_[i]; k < offsets_[i + 1]; ++k) {
+                    int d = daughters_[k];
+                    int id = std::abs(pdgId[d]);
+                    if (id != 13 && id != 14 && has_decay_in_flight(d)) {
+                        result = 1;
+                        break;
+                    }
+                }
+                if (result < 0) {
+                    int id = std::abs(pdgId[i]);
+                    result = semileptonic[i] && (id == 211 || id == 321);
+                }
+                state = result;
+                return result;
+            }
+
+            int find_hf_ancestor(int i) {
+                const int n = pdgId.size();
+                if (hf_state_[i] == kInProgress) return -1;
+                if (hf_state_[i] != kUnknown) return hf_ancestor[i];
+                hf_state_[i] = kInProgress;
+                int m = mother[i];
+                int result = -1;
+                if (m >= 0 && m < n)
+                    result = flavour[m] != 0 ? m : find_hf_ancestor(m);
+                hf_ancestor[i] = result;
+                hf_state_[i] = 0;
+                return result;
+            }
+        };
+
+        template <typename T1, typename T2>
+        Ancestry build(const RVec<T1>& pdgId, const RVec<T2>& mother) {
+            return Ancestry(RVec<int>(pdgId.begin(), pdgId.end()),
+                            RVec<int>(mother.begin(), mother.end()));
+        }
+
+        // from buffers of n values, ex. the array branches of a PyROOT event
+        Ancestry build(const int* pdgId, const int* mother, int n) {
+            return Ancestry(RVec<int>(pdgId, pdgId + n), RVec<int>(mother, mother + n));
+        }
+
+        template <typename T1, typename T2>
+        RVec<int> first_heavy_flavour_ancestor(const RVec<T1>& pdgId, const RVec<T2>& mother) {
+            return build(pdgId, mother).hf_ancestor;
+        }
+
+        // classification of candidates with given common ancestors
+        template <typename T1, typename T2, typename T3, typename T4>
+        RVec<int> classify(const RVec<T1>& pdgId, const RVec<T2>& mother,
+                           const RVec<T3>& ancestor, const RVec<T4>& ancestor_index) {
+            RVec<int> result(ancestor.size());
+            if (ancestor.size() == 0) return result;
+            Ancestry ancestry = build(pdgId, mother);
+            for (size_t i = 0; i < ancestor.size(); ++i)
+                result[i] = ancestry.classify(ancestor[i], ancestor_index[i]);
+            return result;
+        }
+
+        // B meson pdgId for Btohh mixed samples: B0/Bs -> pi/K -> mu
+        template <typename T1, typename T2>
+        int tag_bhh(const RVec<T1>& pdgId, const RVec<T2>& mother) {
+            const int n = pdgId.size();
+            for (int i = 0; i < n; ++i) {
+                if (std::abs(pdgId[i]) != 13) continue;
+                int mother_idx = mother[i];
+                if (mother_idx < 0 || mother_idx >= n) continue;
+                int mother_id = std::abs(pdgId[mother_idx]);
+                if (mother_id != 211 && mother_id != 321) continue;
+                int grandmother_idx = mother[mother_idx];
+                if (grandmother_idx < 0 || grandmother_idx >= n) continue;
+                int grandmother_id = std::abs(pdgId[grandmother_idx]);
+                if (grandmother_id != 511 && grandmother_id != 531) continue;
+                return pdgId[grandmother_idx];
+            }
+            return 0;
+        }
+
+        int tag_bhh(const int* pdgId, const int* mother, int n) {
+            return tag_bhh(RVec<int>(const_cast<int*>(pdgId), n),
+                           RVec<int>(const_cast<int*>(mother), n));
+        }
+    }
+    """)
+    _declared = True
+
+
+def _as_array(values, n=None):
+    """Contiguous int32 NumPy array of the first n values
+
+    Array branches of a PyROOT event expose their buffer, so they are
+    read without a Python loop. The array is passed to C++ as a
+    pointer, since making an RVec from Python costs more than the
+    tagging itself."""
+    array = numpy.asarray(values)
+    if n is not None:
+        array = array[:n]
+    return numpy.ascontiguousarray(array, dtype=numpy.int32)
+
+
+def _pointer(array):
+    """Argument for a const int* parameter, empty arrays have no buffer"""
+    return array if len(array) > 0 else ROOT.nullptr
+
+
+class GenAncestry(object):
+    """Ancestry of the GenPart collection of one event
+
+    pdgId and mother can be NumPy arrays or the branches of a PyROOT
+    event together with the number of particles n, ex.
+        GenAncestry(event.GenPart_pdgId, event.GenPart_genPartIdxMother, event.nGenPart)
+    """
+
+    def __init__(self, pdgId, mother, n=None):
+        declare()
+        self._pdgId = _as_array(pdgId, n)
+        mother = _as_array(mother, n)
+        self.ancestry = ROOT.gen_ancestry.build(_pointer(self._pdgId), _pointer(mother),
+                                                len(self._pdgId))
+
+    def _array(self, values):
+        return numpy.array([values[i] for i in range(len(self._pdgId))])
+
+    def first_heavy_flavour_ancestor(self):
+        return self._array(self.ancestry.hf_ancestor)
+
+    def signature(self):
+        return self._array(self.ancestry.signature)
+
+    def daughters(self, i):
+        return list(self.ancestry.daughters(i))
+
+    def ancestors(self, i):
+        return list(self.ancestry.ancestors(i))
+
+    def classify(self, ancestor, ancestor_index):
+        """Decay type of the common ancestor of two muons"""
+        return processes[self.ancestry.classify(int(ancestor), int(ancestor_index))]
+
+
+def tag_bhh(pdgId, mother, n=None):
+    """Determine B meson pdgId for Btohh mixed samples"""
+    declare()
+    pdgId = _as_array(pdgId, n)
+    mother = _as_array(mother, n)
+    return ROOT.gen_ancestry.tag_bhh(_pointer(pdgId), _pointer(mother), len(pdgId))
+
+
+## Reference implementation walking mother links in Python
+
+def _hadron_type(id):
+    digits = [int(digit) for digit in str(abs(id))]
+    if len(digits) >= 3 and digits[-3] == 5 and (len(digits) == 3 or digits[-4] == 0):
+        return "b-hadron"
+    if len(digits) >= 3 and digits[-3] == 4 and (len(digits) == 3 or digits[-4] == 0):
+        return "c-hadron"
+    return None
+
+def _is_DtoMuNuX_decay(event, p_id, p_index):
+    if _hadron_type(p_id) != 'c-hadron':
+        return False
+    mu = 0
+    nu = 0
+    for gen_index in range(event.nGenPart):
+        if event.GenPart_genPartIdxMother[gen_index] == p_index:
+            id = event.GenPart_pdgId[gen_index]
+            if _hadron_type(id) == 'c-hadron':
+                return _is_DtoMuNuX_decay(event, id, gen_index)
+            if abs(id) == 13:
+                mu = id
+            if abs(id) == 14:
+                nu = id
+    return mu * nu == -13 * 14
+
+def _has_fake_muon(event, p_id, p_index):
+    mu = 0
+    nu = 0
+    for gen_index in range(event.nGenPart):
+        if event.GenPart_genPartIdxMother[gen_index] == p_index:
+            id = event.GenPart_pdgId[gen_index]
+            if abs(id) not in [13, 14]:
+                if _has_fake_muon(event, id, gen_index):
+                    return True
+            if abs(id) == 13:
+                mu = id
+            if abs(id) == 14:
+                nu = id
+    return mu * nu == -13 * 14 and abs(p_id) in [211, 321]
+
+def classify_event_loop(event, ancestor, ancestor_index):
+    """Classification of the common ancestor scanning GenPart in Python"""
+    if ancestor == 0:
+        return "No common ancestor"
+    ancestor_type = _hadron_type(ancestor)
+    if abs(ancestor) == 310:
+        signature = 1
+        for gen_index in range(event.nGenPart):
+            if event.GenPart_genPartIdxMother[gen_index] == ancestor_index:
+                signature *= event.GenPart_pdgId[gen_index]
+        if signature == -211 * 211:
+            return "KsToPiPi"
+    if ancestor_type == "b-hadron":
+        mu = 0
+        nu = 0
+        n_charm_semileptonic = 0
+        n_fakes = 0
+        for gen_index in range(event.nGenPart):
+            if event.GenPart_genPartIdxMother[gen_index] == ancestor_index:
+                id = event.GenPart_pdgId[gen_index]
+                if abs(id) == 13:
+                    mu = id
+                if abs(id) == 14:
+                    nu = id
+                if _is_DtoMuNuX_decay(event, id, gen_index):
+                    n_charm_semileptonic += 1
+                if _has_fake_muon(event, id, gen_index):
+                    n_fakes += 1
+        if mu * nu == -13 * 14:
+            if n_charm_semileptonic == 1:
+                return "H_b to H_c mu nu, H_c to mu nu X"
+            if n_fakes == 1:
+                return "H_b to X mu nu, X contains decay in flight"
+        elif n_charm_semileptonic == 1:
+            return "H_b to H_c X, H_c to mu nu X'"
+        elif n_charm_semileptonic == 2:
+            return "H_b to H_c H_c', H_c to mu nu X"
+    if _is_DtoMuNuX_decay(event, ancestor, ancestor_index):
+        return "H_c to mu nu X"
+    return "Unclassified"
+
+
+def benchmark(files, max_events=None):
+    """Compare rates and results of the Python loops and the engine"""
+    declare()
+    chain = ROOT.TChain("Events")
+    for f in files:
+        chain.Add(f)
+    n_total = chain.GetEntries()
+    if max_events != None:
+        n_total = min(n_total, max_events)
+
+    results = dict()
+    for method in ["python", "engine"]:
+        t0 = time.time()
+        classification = []
+        for i in range(n_total):
+            chain.GetEntry(i)
+            ancestry = None
+            for mm_index in range(chain.nmm):
+                ancestor = int(chain.mm_gen_cpdgId[mm_index])
+                ancestor_index = int(chain.mm_gen_cindex[mm_index])
+                if method == "python":
+                    process = classify_event_loop(chain, ancestor, ancestor_index)
+                else:
+                    if ancestry is None:
+                        ancestry = GenAncestry(chain.GenPart_pdgId, chain.GenPart_genPartIdxMother, chain.nGenPart)
+                    process = ancestry.classify(ancestor, ancestor_index)
+                classification.append(process)
+        dt = time.time() - t0
+        results[method] = classification
+        print("%-10s: %0.1f sec, %0.0f events/s" % (method, dt, n_total / dt))
+
+    t0 = time.time()
+    df = ROOT.RDataFrame(chain).Range(n_total)
+    df = df.Define("mm_gen_process", "gen_ancestry::classify(GenPart_pdgId, "
+                   "GenPart_genPartIdxMother, mm_gen_cpdgId, mm_gen_cindex)")
+    values = df.Take["ROOT::VecOps::RVec<int>"]("mm_gen_process").GetValue()
+    results["rdataframe"] = [processes[code] for v in values for code in v]
+    dt = time.time() - t0
+    print("%-10s: %0.1f sec, %0.0f events/s" % ("rdataframe", dt, n_total / dt))
+
+    methods = ["python", "engine", "rdataframe"]
+    print("Candidates by process (%s):" % ", ".join(methods))
+    for process in processes:
+        print("\t%s: %s" % (process, " ".join("%u" % results[m].count(process) for m in methods)))
+    if results["python"] == results["engine"] == results["rdataframe"]:
+        print("Classification results are identical")
+    else:
+        print("Classification results differ")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: %s <NanoAOD files>" % sys.argv[0])
+        sys.exit(1)
+    benchmark(sys.argv[1:])
@@ -1,11 +1,16 @@
-from BmmScout.NanoAOD.postprocessing.datamodel import Event
-from BmmScout.NanoAOD.postprocessing.treeReaderArrayTools import clearExtraBranches
+from BmmScout.NanoAOD.postprocessing.datamodel import Event, Collection
+from BmmScout.NanoAOD.postprocessing.treeReaderArrayTools import clearExtraBranches, InputTree
+from BmmScout.NanoAOD.postprocessing import treeReaderArrayTools
 import sys
 import time
 import ROOT
 
 
 class Module(object):
+    # input branches (wildcards allowed) read by the module. Their
+    # readers are made before the event loop instead of on first use
+    declaredBranches = None
+
     def __init__(self):
         self.writeHistFile = False
 
@@ -61,6 +66,13 @@ def eventLoop(
     for m in modules:
         m.beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
 
+    declaredBranches = []
+    for m in modules:
+        if m.declaredBranches:
+            declaredBranches += m.declaredBranches
+    if declaredBranches and hasattr(inputTree, 'declareBranches'):
+        inputTree.declareBranches(declaredBranches)
+
     t0 = time.time()
     tlast = t0
     doneEvents = 0
@@ -99,3 +111,109 @@ def eventLoop(
     for m in modules:
         m.endFile(inputFile, outputFile, inputTree, wrappedOutputTree)
     return (doneEvents, acceptedEvents, time.time() - t0)
+
+
+class _LazySkimModule(Module):
+    """Candidate selection reading collections through Collection/Object"""
+
+    def __init__(self, collections, declare=False):
+        Module.__init__(self)
+        self.collections = collections
+        if declare:
+            self.declaredBranches = ["n%s" % c for c in collections] + ["%s_*" % c for c in collections]
+
+    def analyze(self, event):
+        selected = False
+        for prefix, variables in self.collections.items():
+            for obj in Collection(event, prefix):
+                # later variables are read only for candidates passing
+                # the earlier cuts, so branches are discovered over time
+                for variable in variables:
+                    if getattr(obj, variable) < 0.5:
+                        break
+                else:
+                    selected = True
+        return selected
+
+
+def _makeTestFile(fileName, nEntries, nCollections=8, nVariables=25):
+    """Write collections as NanoAOD does, variable size C arrays with a counter branch
+
+    The file is filled with a TTree, since recent RDataFrame versions
+    write RVec columns as objects instead of C arrays.
+    """
+    if not hasattr(ROOT, 'eventloop_makeTestFile'):
+        ROOT.gInterpreter.Declare("""
+        #include <vector>
+        #include "TFile.h"
+        #include "TRandom3.h"
+        #include "TTree.h"
+
+        void eventloop_makeTestFile(const char *fileName, Long64_t nEntries, int nCollections, int nVariables) {
+            TFile file(fileName, "RECREATE");
+            TTree tree("Events", "Events");
+            std::vector<int> n(nCollections);
+            std::vector<std::vector<float>> values(nCollections * nVariables, std::vector<float>(4));
+            for (int i = 0; i < nCollections; ++i) {
+                tree.Branch(Form("ncand%d", i), &n[i], Form("ncand%d/I", i));
+                for (int j = 0; j < nVariables; ++j)
+                    tree.Branch(Form("cand%d_var%d", i, j), values[i * nVariables + j].data(),
+                                Form("cand%d_var%d[ncand%d]/F", i, j, i));
+            }
+            TRandom3 random(1);
+            for (Long64_t entry = 0; entry < nEntries; ++entry) {
+                for (int i = 0; i < nCollections; ++i) {
+                    n[i] = (entry * (i + 1)) % 4;
+                    for (int j = 0; j < nVariables; ++j)
+                        for (auto &x: values[i * nVariables + j]) x = random.Rndm();
+                }
+                tree.Fill();
+            }
+            tree.Write();
+        }
+        """)
+    ROOT.eventloop_makeTestFile(fileName, nEntries, nCollections, nVariables)
+    collections = {}
+    for i in range(nCollections):
+        collections["cand%d" % i] = ["var%d" % j for j in range(nVariables)]
+    return collections
+
+
+def benchmark(nEntries=30000, nFirst=10000):
+    """Event loop rate of a lazy skim module over the first events and in steady state"""
+    import tempfile, os, gc
+    tmpdir = tempfile.mkdtemp()
+    fileName = os.path.join(tmpdir, "events.root")
+    collections = _makeTestFile(fileName, nEntries)
+
+    modes = [
+        ("remake", treeReaderArrayTools._remakeReadersForNewBranches, False),
+        ("registry", treeReaderArrayTools._readerForNewBranches, False),
+        ("declared", treeReaderArrayTools._readerForNewBranches, True),
+    ]
+    readerForNewBranches = treeReaderArrayTools._readerForNewBranches
+    for name, strategy, declare in modes:
+        treeReaderArrayTools._readerForNewBranches = strategy
+        inFile = ROOT.TFile.Open(fileName)
+        tree = InputTree(inFile.Get("Events"))
+        modules = [_LazySkimModule(collections, declare)]
+        first = eventLoop(modules, inFile, None, tree, None,
+                          eventRange=range(nFirst), progress=None)
+        steady = eventLoop(modules, inFile, None, tree, None,
+                           eventRange=range(nFirst, nEntries), progress=None)
+        print("%-9s first %d events: %8.0f Hz, steady state: %8.0f Hz, %d branch readers, %d rebuilds" % (
+            name, nFirst, first[0] / first[2], steady[0] / steady[2],
+            len(tree._ttras) + len(tree._ttrvs), tree._ttreereaderversion - 1))
+        # the next tree may get the same address and the same PyROOT
+        # proxy, so the readers of this one must not survive it. The
+        # methods attached by InputTree make a reference cycle
+        del tree, modules
+        gc.collect()
+        inFile.Close()
+    treeReaderArrayTools._readerForNewBranches = readerForNewBranches
+    os.remove(fileName)
+    os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    benchmark()
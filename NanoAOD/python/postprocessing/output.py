@@ -1,5 +1,7 @@
 from BmmScout.NanoAOD.postprocessing.treeReaderArrayTools import setExtraBranch
 from array import array
+import time
+import numpy as np
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
@@ -17,6 +19,17 @@ _rootBranchType2PythonArray = {
 }
 
 
+def _declareReduceMantissaArray():
+    """Apply ReduceMantissaToNbitsRounding to a whole float array in one call"""
+    if not hasattr(ROOT, 'reduceMantissaArray'):
+        ROOT.gInterpreter.Declare("""
+        void reduceMantissaArray(ReduceMantissaToNbitsRounding &reduce, float *values, size_t n) {
+            for (size_t i = 0; i < n; ++i) values[i] = reduce(values[i]);
+        }
+        """)
+    return ROOT.reduceMantissaArray
+
+
 class OutputBranch:
     def __init__(
             self, tree, name, rootBranchType, n=1,
@@ -25,10 +38,14 @@ class OutputBranch:
         n = int(n)
         self.buff = array(
             _rootBranchType2PythonArray[rootBranchType], n * [0. if rootBranchType in 'FD' else 0])
+        # NumPy view of the buffer for filling whole arrays at once
+        self.view = np.frombuffer(self.buff, dtype=self.buff.typecode)
         self.lenVar = lenVar
         self.n = n
-        self.precision = ROOT.ReduceMantissaToNbitsRounding(
-            limitedPrecision) if limitedPrecision and rootBranchType == 'F' else lambda x: x
+        self.reducer = ROOT.ReduceMantissaToNbitsRounding(
+            limitedPrecision) if limitedPrecision and rootBranchType == 'F' else None
+        self.precision = self.reducer if self.reducer is not None else lambda x: x
+        self.reduceArray = _declareReduceMantissaArray() if self.reducer is not None else None
         # check if a branch was already there
         existingBranch = tree.GetBranch(name)
         if (existingBranch):
@@ -48,19 +65,68 @@ class OutputBranch:
             self.branch.SetTitle(title)
 
     def fill(self, val):
+        """Fill a value or a sequence of values.
+
+        NumPy arrays and other buffer-protocol objects are copied to the
+        buffer at once. The mantissa reduction is applied to the whole
+        array in one call. Short Python lists without reduction are faster
+        to copy one by one. Values that don't fit an integer branch are
+        copied one by one too, so that non-integral, negative unsigned
+        and out of range values raise errors as before."""
         if self.lenVar:
-            if len(self.buff) < len(val):  # realloc
-                self.buff = array(self.buff.typecode, max(
-                    len(val), 2 * len(self.buff)) * [0. if self.buff.typecode in 'fd' else 0])
-                self.branch.SetAddress(self.buff)
-            for i, v in enumerate(val):
-                self.buff[i] = self.precision(v)
+            n = len(val)
+            if len(self.buff) < n:  # realloc
+                self._resize(max(n, 2 * len(self.buff)))
+            if n == 0:
+                return
+            if (self.reduceArray is None and isinstance(val, (list, tuple))) or not self._fitsBuffer(val):
+                for i, v in enumerate(val):
+                    self.buff[i] = v
+            else:
+                self.view[:n] = val
+                if self.reduceArray is not None:
+                    self.reduceArray(self.reducer, self.view, n)
         elif self.n == 1:
             self.buff[0] = self.precision(val)
         else:
             if len(val) != self.n:
                 raise RuntimeError("Mismatch in filling branch %s of fixed length %d with %d values (%s)" % (
                     self.branch.GetName(), self.n, len(val), val))
+            if isinstance(val, (list, tuple)) or not self._fitsBuffer(val):
+                for i, v in enumerate(val):
+                    self.buff[i] = v
+            else:
+                self.view[:] = val
+
+    def _fitsBuffer(self, val):
+        """Check that values can be copied to the buffer without truncation or wrap-around"""
+        if self.view.dtype.kind == 'f':
+            return True
+        val = np.asarray(val)
+        if val.dtype.kind == 'b':
+            return True
+        if val.dtype.kind not in 'iu':
+            return False
+        if val.size == 0:
+            return True
+        info = np.iinfo(self.view.dtype)
+        return val.min() >= info.min and val.max() <= info.max
+
+    def _resize(self, size):
+        self.buff = array(self.buff.typecode, size * [0. if self.buff.typecode in 'fd' else 0])
+        self.view = np.frombuffer(self.buff, dtype=self.buff.typecode)
+        self.branch.SetAddress(self.buff)
+
+    def _fillElementwise(self, val):
+        """Element by element filling used before bulk filling, kept for benchmarks"""
+        if self.lenVar:
+            if len(self.buff) < len(val):  # realloc
+                self._resize(max(len(val), 2 * len(self.buff)))
+            for i, v in enumerate(val):
+                self.buff[i] = self.precision(v)
+        elif self.n == 1:
+            self.buff[0] = self.precision(val)
+        else:
             for i, v in enumerate(val):
                 self.buff[i] = v
 
@@ -188,3 +254,48 @@ class FriendOutput(OutputTree):
         outputTree = ROOT.TTree(
             treeName, "Friend tree for " + inputTree.GetName())
         OutputTree.__init__(self, outputFile, outputTree, inputTree)
+
+
+def benchmark(nEvents=10000, sizes=(1, 10, 100, 500), nBranches=8):
+    """Output side event rate of element by element and bulk filling
+
+    Half of the float branches use limitedPrecision. Both modes must
+    produce bit-identical branch contents."""
+    rng = np.random.default_rng(1)
+    columns = ["Cand_x%d" % j for j in range(nBranches)]
+    for size in sizes:
+        values = [rng.normal(size=rng.poisson(size)).astype(np.float32) for i in range(100)]
+        rates = {}
+        content = {}
+        for mode in ["elementwise", "bulk"]:
+            tree = ROOT.TTree("Events", "")
+            tree.SetDirectory(0)
+            counter = OutputBranch(tree, "nCand", "i")
+            branches = [OutputBranch(tree, name, "F", lenVar="nCand",
+                                     limitedPrecision=10 if j % 2 else False)
+                        for j, name in enumerate(columns)]
+            t0 = time.time()
+            for i in range(nEvents):
+                val = values[i % len(values)]
+                counter.fill(len(val))
+                for branch in branches:
+                    if mode == "bulk":
+                        branch.fill(val)
+                    else:
+                        branch._fillElementwise(val)
+                tree.Fill()
+            rates[mode] = nEvents / (time.time() - t0)
+            data = ROOT.RDataFrame(tree).AsNumpy(columns)
+            content[mode] = []
+            for c in columns:
+                flat = [np.asarray(v, dtype=np.float32) for v in data[c]]
+                content[mode].append(np.concatenate(flat).view(np.uint32))
+        identical = all(np.array_equal(a, b) for a, b in zip(content["elementwise"], content["bulk"]))
+        print("%4d values/branch: elementwise %8.0f events/s, bulk %8.0f events/s (x%.1f), bit-identical: %s" % (
+            size, rates["elementwise"], rates["bulk"], rates["bulk"] / rates["elementwise"], identical))
+        if not identical:
+            raise RuntimeError("Bulk filling changed the output")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -5,10 +5,10 @@ from BmmScout.NanoAOD.postprocessing.output import FriendOutput, FullOutput
 from BmmScout.NanoAOD.postprocessing.eventloop import eventLoop
 from BmmScout.NanoAOD.postprocessing.datamodel import InputTree
 from BmmScout.NanoAOD.postprocessing.branchselection import BranchSelection
+from BmmScout.NanoAOD.postprocessing.prefetch import PrefetchCache, FilePrefetcher
 import os
 import time
-import hashlib
-import subprocess
+import tempfile
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
@@ -20,7 +20,7 @@ class PostProcessor:
             noOut=False, justcount=False, provenance=False, haddFileName=None,
             fwkJobReport=False, histFileName=None, histDirName=None,
             outputbranchsel=None, maxEntries=None, firstEntry=0, prefetch=False,
-            longTermCache=False
+            longTermCache=False, prefetchDepth=2, cacheDir=None, cacheSize=20e9
     ):
         self.outputDir = outputDir
         self.inputFiles = inputFiles
@@ -58,42 +58,26 @@ class PostProcessor:
         self.prefetch = prefetch  # prefetch files to TMPDIR using xrdcp
         # keep cached files across runs (it's then up to you to clean up the temp)
         self.longTermCache = longTermCache
+        # number of files copied in the background ahead of the current one
+        self.prefetchDepth = prefetchDepth
+        self.cacheDir = cacheDir
+        self.cacheSize = cacheSize
+        self.cache = None
 
-    def prefetchFile(self, fname, verbose=True):
-        tmpdir = os.environ['TMPDIR'] if 'TMPDIR' in os.environ else "/tmp"
-        if not fname.startswith("root://"):
-            return fname, False
-        rndchars = "".join([hex(ord(i))[2:] for i in os.urandom(
-            8)]) if not self.longTermCache else "long_cache-id%d-%s" \
-            % (os.getuid(), hashlib.sha1(fname).hexdigest())
-        localfile = "%s/%s-%s.root" \
-            % (tmpdir, os.path.basename(fname).replace(".root", ""), rndchars)
-        if self.longTermCache and os.path.exists(localfile):
-            if verbose:
-                print("Filename %s is already available in local path %s " \
-                    % (fname, localfile))
-            return localfile, False
-        try:
-            if verbose:
-                print("Filename %s is remote, will do a copy to local path %s"\
-                    % (fname, localfile))
-            start = time.time()
-            subprocess.check_output(["xrdcp", "-f", "-N", fname, localfile])
-            if verbose:
-                print("Time used for transferring the file locally: %.2f s"\
-                    % (time.time() - start))
-            return localfile, (not self.longTermCache)
-        except:
-            if verbose:
-                print("Error: could not save file locally, will run from remote")
-            if os.path.exists(localfile):
-                if verbose:
-                    print("Deleting partially transferred file %s" % localfile)
-                try:
-                    os.unlink(localfile)
-                except:
-                    pass
-            return fname, False
+    def prefetchCache(self):
+        """Local cache of prefetched files
+
+        The long term cache is shared between runs and bounded by
+        cacheSize. Otherwise files are removed after processing.
+        """
+        if self.cache is None:
+            if self.longTermCache:
+                self.cache = PrefetchCache(self.cacheDir, maxSize=self.cacheSize)
+            else:
+                tmpdir = os.environ['TMPDIR'] if 'TMPDIR' in os.environ else "/tmp"
+                self.cache = PrefetchCache(tempfile.mkdtemp(prefix="prefetch-", dir=tmpdir),
+                                           maxSize=self.cacheSize, keepFiles=False)
+        return self.cache
 
     def run(self):
         outpostfix = self.postfix if self.postfix is not None else (
@@ -146,121 +130,132 @@ class PostProcessor:
         outFileNames = []
         t0 = time.time()
         totEntriesRead = 0
-        for fname in self.inputFiles:
-            ffnames = []
-            if "," in fname:
-                fnames = fname.split(',')
-                fname, ffnames = fnames[0], fnames[1:]
+        prefetcher = None
+        if self.prefetch:
+            prefetcher = FilePrefetcher([f.split(',')[0] for f in self.inputFiles],
+                                        self.prefetchCache(), depth=self.prefetchDepth)
+        try:
+            for fname in self.inputFiles:
+                ffnames = []
+                if "," in fname:
+                    fnames = fname.split(',')
+                    fname, ffnames = fnames[0], fnames[1:]
 
-            # open input file
-            if self.prefetch:
-                ftoread, toBeDeleted = self.prefetchFile(fname)
-                print("Opening file " + ftoread)
-                inFile = ROOT.TFile.Open(ftoread)
-            else:
-                print("Opening file " + fname)
-                inFile = ROOT.TFile.Open(fname)
+                # open input file
+                if self.prefetch:
+                    ftoread = prefetcher.get(fname)
+                    print("Opening file " + ftoread)
+                    inFile = ROOT.TFile.Open(ftoread)
+                else:
+                    print("Opening file " + fname)
+                    inFile = ROOT.TFile.Open(fname)
 
-            # get input tree
-            inTree = inFile.Get("Events")
-            if inTree is None:
-                inTree = inFile.Get("Friends")
-            nEntries = min(inTree.GetEntries() -
-                           self.firstEntry, self.maxEntries)
-            totEntriesRead += nEntries
+                # get input tree
+                inTree = inFile.Get("Events")
+                if inTree is None:
+                    inTree = inFile.Get("Friends")
+                nEntries = min(inTree.GetEntries() -
+                               self.firstEntry, self.maxEntries)
+                totEntriesRead += nEntries
 
-            print('Number of entries: %s' % nEntries)
+                print('Number of entries: %s' % nEntries)
             
-            # pre-skimming
-            elist, jsonFilter = preSkim(
-                inTree, self.json, self.cut, maxEntries=self.maxEntries, firstEntry=self.firstEntry)
-            if self.justcount:
-                print('Would select %d / %d entries from %s (%.2f%%)' % (elist.GetN() if elist else nEntries, nEntries, fname, (elist.GetN() if elist else nEntries) / (0.01 * nEntries) if nEntries else 0))
-                if self.prefetch:
-                    if toBeDeleted:
-                        os.unlink(ftoread)
-                continue
-            # elif elist and elist.GetN() == 0:
-            #         # stop processing if no entries got pre-selected
-            #         print('Pre-select 0 entries out of %s (0.00%%)' % (nEntries))
-            #         continue
-            else:
-                print('Pre-select %d entries out of %s (%.2f%%)' % (elist.GetN() if elist else nEntries, nEntries, (elist.GetN() if elist else nEntries) / (0.01 * nEntries) if nEntries else 0))
-                inAddFiles = []
-                inAddTrees = []
-            for ffname in ffnames:
-                inAddFiles.append(ROOT.TFile.Open(ffname))
-                inAddTree = inAddFiles[-1].Get("Events")
-                if inAddTree is None:
-                    inAddTree = inAddFiles[-1].Get("Friends")
-                inAddTrees.append(inAddTree)
-                inTree.AddFriend(inAddTree)
+                # pre-skimming
+                elist, jsonFilter = preSkim(
+                    inTree, self.json, self.cut, maxEntries=self.maxEntries, firstEntry=self.firstEntry)
+                if self.justcount:
+                    print('Would select %d / %d entries from %s (%.2f%%)' % (elist.GetN() if elist else nEntries, nEntries, fname, (elist.GetN() if elist else nEntries) / (0.01 * nEntries) if nEntries else 0))
+                    if self.prefetch:
+                        prefetcher.release(fname)
+                    continue
+                # elif elist and elist.GetN() == 0:
+                #         # stop processing if no entries got pre-selected
+                #         print('Pre-select 0 entries out of %s (0.00%%)' % (nEntries))
+                #         continue
+                else:
+                    print('Pre-select %d entries out of %s (%.2f%%)' % (elist.GetN() if elist else nEntries, nEntries, (elist.GetN() if elist else nEntries) / (0.01 * nEntries) if nEntries else 0))
+                    inAddFiles = []
+                    inAddTrees = []
+                for ffname in ffnames:
+                    inAddFiles.append(ROOT.TFile.Open(ffname))
+                    inAddTree = inAddFiles[-1].Get("Events")
+                    if inAddTree is None:
+                        inAddTree = inAddFiles[-1].Get("Friends")
+                    inAddTrees.append(inAddTree)
+                    inTree.AddFriend(inAddTree)
 
-            if fullClone:
-                # no need of a reader (no event loop), but set up the elist if available
-                if elist:
-                    inTree.SetEntryList(elist)
-            else:
-                # initialize reader
-                if elist:
-                    inTree = InputTree(inTree, elist)
+                if fullClone:
+                    # no need of a reader (no event loop), but set up the elist if available
+                    if elist:
+                        inTree.SetEntryList(elist)
                 else:
-                    inTree = InputTree(inTree)
+                    # initialize reader
+                    if elist:
+                        inTree = InputTree(inTree, elist)
+                    else:
+                        inTree = InputTree(inTree)
 
-            # prepare output file
-            if not self.noOut:
-                outFileName = os.path.join(self.outputDir, os.path.basename(
-                    fname).replace(".root", outpostfix + ".root"))
-                outFile = ROOT.TFile.Open(
-                    outFileName, "RECREATE", "", compressionLevel)
-                outFileNames.append(outFileName)
-                if compressionLevel:
-                    outFile.SetCompressionAlgorithm(compressionAlgo)
-                # prepare output tree
-                if self.friend:
-                    outTree = FriendOutput(inFile, inTree, outFile)
+                # prepare output file
+                if not self.noOut:
+                    outFileName = os.path.join(self.outputDir, os.path.basename(
+                        fname).replace(".root", outpostfix + ".root"))
+                    outFile = ROOT.TFile.Open(
+                        outFileName, "RECREATE", "", compressionLevel)
+                    outFileNames.append(outFileName)
+                    if compressionLevel:
+                        outFile.SetCompressionAlgorithm(compressionAlgo)
+                    # prepare output tree
+                    if self.friend:
+                        outTree = FriendOutput(inFile, inTree, outFile)
+                    else:
+                        firstEntry = 0 if fullClone and elist else self.firstEntry
+                        outTree = FullOutput(
+                            inFile,
+                            inTree,
+                            outFile,
+                            branchSelection=self.branchsel,
+                            outputbranchSelection=self.outputbranchsel,
+                            fullClone=fullClone,
+                            maxEntries=self.maxEntries,
+                            firstEntry=firstEntry,
+                            jsonFilter=jsonFilter,
+                            provenance=self.provenance)
                 else:
-                    firstEntry = 0 if fullClone and elist else self.firstEntry
-                    outTree = FullOutput(
-                        inFile,
-                        inTree,
-                        outFile,
-                        branchSelection=self.branchsel,
-                        outputbranchSelection=self.outputbranchsel,
-                        fullClone=fullClone,
-                        maxEntries=self.maxEntries,
-                        firstEntry=firstEntry,
-                        jsonFilter=jsonFilter,
-                        provenance=self.provenance)
-            else:
-                outFile = None
-                outTree = None
-                if self.branchsel:
-                    self.branchsel.selectBranches(inTree)
+                    outFile = None
+                    outTree = None
+                    if self.branchsel:
+                        self.branchsel.selectBranches(inTree)
 
-            # process events, if needed
-            if not fullClone:
-                eventRange = range(self.firstEntry, self.firstEntry +
-                                    nEntries) if nEntries > 0 and not elist else None
-                (nall, npass, timeLoop) = eventLoop(
-                    self.modules, inFile, outFile, inTree, outTree,
-                    eventRange=eventRange, maxEvents=self.maxEntries
-                )
-                print('Processed %d preselected entries from %s (%s entries). Finally selected %d entries' % (nall, fname, nEntries, npass))
-            else:
-                nall = nEntries
-                print('Selected %d / %d entries from %s (%.2f%%)' % (outTree.tree().GetEntries(), nall, fname, outTree.tree().GetEntries() / (0.01 * nall) if nall else 0))
+                # process events, if needed
+                if not fullClone:
+                    eventRange = range(self.firstEntry, self.firstEntry +
+                                        nEntries) if nEntries > 0 and not elist else None
+                    (nall, npass, timeLoop) = eventLoop(
+                        self.modules, inFile, outFile, inTree, outTree,
+                        eventRange=eventRange, maxEvents=self.maxEntries
+                    )
+                    print('Processed %d preselected entries from %s (%s entries). Finally selected %d entries' % (nall, fname, nEntries, npass))
+                else:
+                    nall = nEntries
+                    print('Selected %d / %d entries from %s (%.2f%%)' % (outTree.tree().GetEntries(), nall, fname, outTree.tree().GetEntries() / (0.01 * nall) if nall else 0))
 
-            # now write the output
-            if not self.noOut:
-                outTree.write()
-                outFile.Close()
-                print("Done %s" % outFileName)
-            if self.jobReport:
-                self.jobReport.addInputFile(fname, nall)
-            if self.prefetch:
-                if toBeDeleted:
-                    os.unlink(ftoread)
+                # now write the output
+                if not self.noOut:
+                    outTree.write()
+                    outFile.Close()
+                    print("Done %s" % outFileName)
+                if self.jobReport:
+                    self.jobReport.addInputFile(fname, nall)
+                if self.prefetch:
+                    prefetcher.release(fname)
+        finally:
+            # stop background transfers and remove the temporary cache
+            # also if processing fails
+            if prefetcher is not None:
+                prefetcher.close()
+                if not self.longTermCache:
+                    self.cache.clear()
+                    self.cache = None
 
         for m in self.modules:
             m.endJob()
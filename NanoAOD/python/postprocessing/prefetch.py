@@ -0,0 +1,326 @@
+import concurrent.futures
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# commands are lists of arguments with {source} and {destination}
+# placeholders, so that xrootd tools can be replaced by local stand-ins
+XRDCP_COMMAND = ["xrdcp", "-f", "-N", "{source}", "{destination}"]
+XRDADLER32_COMMAND = ["xrdadler32", "{source}"]
+
+
+def adler32(fname, blockSize=16 * 1024 * 1024):
+    value = 1
+    with open(fname, "rb") as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            value = zlib.adler32(block, value)
+    return "%08x" % value
+
+
+def formatCommand(command, **kwargs):
+    return [arg.format(**kwargs) for arg in command]
+
+
+class PrefetchCache:
+    """Size bounded LRU cache of local copies of remote files
+
+    Copies are validated with adler32 checksums against the source.
+    Files in use are pinned and never evicted. The least recently used
+    ones are removed when the cache exceeds maxSize bytes. With
+    keepFiles=False copies are removed as soon as they are released.
+
+    The cache directory can be shared by several processes. Each of
+    them marks the files it uses with a pin file named after its pid,
+    and pinning and removal are serialized with a lock file.
+    """
+
+    def __init__(self, cacheDir=None, maxSize=20e9, keepFiles=True,
+                 copyCommand=XRDCP_COMMAND, checksumCommand=XRDADLER32_COMMAND,
+                 verbose=True):
+        if cacheDir is None:
+            tmpdir = os.environ['TMPDIR'] if 'TMPDIR' in os.environ else "/tmp"
+            cacheDir = "%s/prefetch-cache-%d" % (tmpdir, os.getuid())
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        self.cacheDir = os.path.normpath(cacheDir)
+        self.maxSize = maxSize
+        self.keepFiles = keepFiles
+        self.copyCommand = copyCommand
+        self.checksumCommand = checksumCommand
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.pinned = {}
+
+    def localFile(self, fname):
+        return os.path.join(self.cacheDir,
+                            hashlib.sha1(fname.encode("utf-8")).hexdigest() + ".root")
+
+    def _readInfo(self, localfile):
+        try:
+            with open(localfile + ".json") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _isValid(self, fname, localfile):
+        info = self._readInfo(localfile)
+        if info is None or info['source'] != fname:
+            return False
+        try:
+            return os.path.getsize(localfile) == info['size']
+        except OSError:
+            return False
+
+    def _remoteChecksum(self, fname):
+        if self.checksumCommand is None:
+            return None
+        output = subprocess.check_output(
+            formatCommand(self.checksumCommand, source=fname), encoding="utf8")
+        return output.split()[0].lower().zfill(8)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Lock the cache for threads of this process and for other processes"""
+        with self.lock:
+            # the lock file is opened each time, so that the lock isn't
+            # shared with forked processes
+            with open(os.path.join(self.cacheDir, ".lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+
+    def _pinFile(self, localfile):
+        return "%s.pin%d" % (localfile, os.getpid())
+
+    def _pinnedByOthers(self, localfile):
+        """Check for pins of other running processes and remove stale ones"""
+        pinned = False
+        for pinfile in glob.glob(glob.escape(localfile) + ".pin*"):
+            pid = int(pinfile[len(localfile) + 4:])
+            if pid == os.getpid():
+                continue
+            try:
+                os.kill(pid, 0)
+                pinned = True
+            except ProcessLookupError:
+                os.unlink(pinfile)
+            except PermissionError:
+                pinned = True
+        return pinned
+
+    def _pin(self, localfile):
+        with self._locked():
+            count = self.pinned.get(localfile, 0)
+            if count == 0:
+                open(self._pinFile(localfile), "w").close()
+            self.pinned[localfile] = count + 1
+
+    def fetch(self, fname):
+        """Return path of a validated local copy of the file"""
+        localfile = self.localFile(fname)
+        self._pin(localfile)
+        try:
+            if self._isValid(fname, localfile):
+                os.utime(localfile, None)
+                if self.verbose:
+                    print("Filename %s is already available in local path %s"
+                          % (fname, localfile))
+                return localfile
+            start = time.time()
+            partfile = "%s.part%d-%d" % (localfile, os.getpid(), threading.get_ident())
+            try:
+                subprocess.check_output(formatCommand(
+                    self.copyCommand, source=fname, destination=partfile))
+                checksum = adler32(partfile)
+                expected = self._remoteChecksum(fname)
+                if expected is not None and expected != checksum:
+                    raise RuntimeError("Checksum mismatch for %s: %s != %s"
+                                       % (fname, checksum, expected))
+                os.rename(partfile, localfile)
+            finally:
+                if os.path.exists(partfile):
+                    os.unlink(partfile)
+            with open(localfile + ".json", "w") as f:
+                json.dump({'source': fname, 'size': os.path.getsize(localfile),
+                           'adler32': checksum}, f)
+            if self.verbose:
+                print("Copied %s to %s in %.2f s" % (fname, localfile, time.time() - start))
+        except:
+            self.release(fname)
+            raise
+        self.evict()
+        return localfile
+
+    def release(self, fname):
+        """Unpin a file after use"""
+        localfile = self.localFile(fname)
+        with self._locked():
+            count = self.pinned.get(localfile, 0) - 1
+            if count > 0:
+                self.pinned[localfile] = count
+                return
+            self.pinned.pop(localfile, None)
+            try:
+                os.unlink(self._pinFile(localfile))
+            except OSError:
+                pass
+            if not self.keepFiles and not self._pinnedByOthers(localfile):
+                self._remove(localfile)
+
+    def _remove(self, localfile):
+        for f in [localfile, localfile + ".json"]:
+            try:
+                os.unlink(f)
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove least recently used unpinned files above the size limit"""
+        with self._locked():
+            entries = []
+            totalSize = 0
+            for name in os.listdir(self.cacheDir):
+                if not name.endswith(".root"):
+                    continue
+                path = os.path.join(self.cacheDir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                totalSize += stat.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if totalSize <= self.maxSize:
+                    break
+                if path in self.pinned or self._pinnedByOthers(path):
+                    continue
+                self._remove(path)
+                totalSize -= size
+
+    def clear(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+
+class FilePrefetcher:
+    """Copy the next inputs in the background while the current one is processed
+
+    Remote files (root://) are fetched in order, at most depth files
+    ahead of the file being processed. Local files are used as is. If
+    a copy fails the remote file is read directly.
+    """
+
+    def __init__(self, inputFiles, cache, depth=2, verbose=True):
+        self.inputFiles = list(inputFiles)
+        self.cache = cache
+        self.depth = depth
+        self.verbose = verbose
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(depth, 1))
+        self.futures = {}
+        self.next = 0
+
+    def _submit(self, upTo):
+        while self.next < min(upTo, len(self.inputFiles)):
+            fname = self.inputFiles[self.next]
+            self.next += 1
+            if fname.startswith("root://") and fname not in self.futures:
+                self.futures[fname] = self.executor.submit(self.cache.fetch, fname)
+
+    def get(self, fname):
+        """Return the local copy of the file or its remote name"""
+        # keep the pipeline full while this file is processed
+        if fname in self.inputFiles:
+            self._submit(self.inputFiles.index(fname) + 1 + self.depth)
+        if fname not in self.futures:
+            if not fname.startswith("root://"):
+                return fname
+            self.futures[fname] = self.executor.submit(self.cache.fetch, fname)
+        start = time.time()
+        try:
+            localfile = self.futures[fname].result()
+        except Exception as e:
+            del self.futures[fname]
+            if self.verbose:
+                print("Error: could not save file locally, will run from remote (%s)" % e)
+            return fname
+        if self.verbose:
+            print("Waited %.2f s for the local copy of %s" % (time.time() - start, fname))
+        return localfile
+
+    def release(self, fname):
+        future = self.futures.pop(fname, None)
+        if future is not None:
+            self.cache.release(fname)
+
+    def close(self):
+        """Wait for pending transfers and release all files"""
+        self.executor.shutdown(wait=True)
+        for fname, future in list(self.futures.items()):
+            if future.exception() is None:
+                self.cache.release(fname)
+        self.futures = {}
+
+
+def benchmark(nFiles=20, fileSize=20 * 1024 * 1024, transferTime=0.25, processTime=0.25):
+    """Compare wall time of serial fetching and prefetching
+
+    Transfers are emulated by a local copy with a fixed delay and
+    processing by a sleep of similar duration.
+    """
+    tmpdir = tempfile.mkdtemp()
+    remoteDir = "%s/remote" % tmpdir
+    os.makedirs(remoteDir)
+    prefix = "root://localhost/"
+    inputFiles = []
+    block = os.urandom(fileSize)
+    for i in range(nFiles):
+        fname = "%s/%03d.root" % (remoteDir, i)
+        with open(fname, "wb") as f:
+            f.write(block[i:] + block[:i])
+        inputFiles.append(prefix + fname)
+
+    # local stand-ins of xrdcp and xrdadler32
+    copyCommand = [sys.executable, "-c",
+                   "import sys, shutil, time; time.sleep(%s); shutil.copy(sys.argv[1][%d:], sys.argv[2])"
+                   % (transferTime, len(prefix)), "{source}", "{destination}"]
+    checksumCommand = [sys.executable, "-c",
+                       "import sys; sys.path.insert(0, %r); from prefetch import adler32; "
+                       "print(adler32(sys.argv[1][%d:]))"
+                       % (os.path.dirname(os.path.abspath(__file__)), len(prefix)), "{source}"]
+
+    results = {}
+    for mode in ["serial", "prefetch"]:
+        cache = PrefetchCache("%s/cache-%s" % (tmpdir, mode), maxSize=4 * fileSize,
+                              copyCommand=copyCommand, checksumCommand=checksumCommand,
+                              verbose=False)
+        depth = 2 if mode == "prefetch" else 0
+        prefetcher = FilePrefetcher(inputFiles, cache, depth=depth, verbose=False)
+        t0 = time.time()
+        for fname in inputFiles:
+            localfile = prefetcher.get(fname)
+            if localfile == fname:
+                raise RuntimeError("Failed to fetch %s" % fname)
+            time.sleep(processTime)
+            prefetcher.release(fname)
+        prefetcher.close()
+        results[mode] = time.time() - t0
+        nCached = len([f for f in os.listdir(cache.cacheDir) if f.endswith(".root")])
+        print("%-8s: %5.2f s for %d files, %d files kept in the cache" % (mode, results[mode], nFiles, nCached))
+    print("speedup x%.2f" % (results["serial"] / results["prefetch"]))
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    benchmark()
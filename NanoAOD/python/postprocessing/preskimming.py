@@ -1,9 +1,110 @@
 import json
 import re
+import time
+import numpy as np
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 
+def _declarePreskimCode():
+    """C++ helpers reading run/lumi columns and evaluating the cut in one pass"""
+    if hasattr(ROOT, 'preskimming'):
+        return ROOT.preskimming
+    ROOT.gInterpreter.Declare("""
+    #include <memory>
+    #include <stdexcept>
+    #include <string>
+    #include "TTree.h"
+    #include "TEntryList.h"
+    #include "TTreeFormula.h"
+    #include "TTreeReader.h"
+    #include "TTreeReaderValue.h"
+
+    namespace preskimming {
+        void readRunLumiRange(TTree *tree, Long64_t first, Long64_t n, unsigned int *runs, unsigned int *lumis) {
+            TTreeReader reader(tree);
+            TTreeReaderValue<UInt_t> run(reader, "run");
+            TTreeReaderValue<UInt_t> lumi(reader, "luminosityBlock");
+            reader.SetEntriesRange(first, first + n);
+            for (Long64_t i = 0; i < n && reader.Next(); ++i) {
+                runs[i] = *run;
+                lumis[i] = *lumi;
+            }
+        }
+
+        void readRunLumiEntries(TTree *tree, const long *entries, Long64_t n, unsigned int *runs, unsigned int *lumis) {
+            TTreeReader reader(tree);
+            TTreeReaderValue<UInt_t> run(reader, "run");
+            TTreeReaderValue<UInt_t> lumi(reader, "luminosityBlock");
+            for (Long64_t i = 0; i < n; ++i) {
+                reader.SetEntry(entries[i]);
+                runs[i] = *run;
+                lumis[i] = *lumi;
+            }
+        }
+
+        void listEntries(TEntryList *list, long *entries) {
+            Long64_t n = list->GetN();
+            for (Long64_t i = 0; i < n; ++i)
+                entries[i] = (i == 0) ? list->GetEntry(0) : list->Next();
+        }
+
+        TEntryList *makeList(const long *entries, Long64_t n, const char *name) {
+            TEntryList *list = new TEntryList(name, name);
+            for (Long64_t i = 0; i < n; ++i)
+                list->Enter(entries[i]);
+            return list;
+        }
+
+        // entry passes if any instance of the formula is non-zero, as in TTree::Draw
+        class Selection {
+          public:
+            Selection(TTree *tree, const char *cut) : tree_(tree), previousNotify_(tree->GetNotify()) {
+                if (cut != nullptr && cut[0] != 0) {
+                    formula_.reset(new TTreeFormula("preskim", cut, tree));
+                    if (formula_->GetNdim() == 0)
+                        throw std::runtime_error(std::string("Invalid preskim cut: ") + cut);
+                    tree->SetNotify(formula_.get());
+                }
+            }
+            ~Selection() {
+                // give the tree back the notify object it had before
+                if (formula_) tree_->SetNotify(previousNotify_);
+            }
+            bool pass(Long64_t entry) {
+                if (tree_->LoadTree(entry) < 0) return false;
+                if (!formula_) return true;
+                int ndata = formula_->GetNdata();
+                for (int i = 0; i < ndata; ++i)
+                    if (formula_->EvalInstance(i) != 0) return true;
+                return false;
+            }
+          private:
+            TTree *tree_;
+            TObject *previousNotify_;
+            std::unique_ptr<TTreeFormula> formula_;
+        };
+
+        TEntryList *selectRange(TTree *tree, const char *cut, Long64_t first, Long64_t n) {
+            Selection selection(tree, cut);
+            TEntryList *list = new TEntryList("elist", "elist");
+            for (Long64_t entry = first; entry < first + n; ++entry)
+                if (selection.pass(entry)) list->Enter(entry);
+            return list;
+        }
+
+        TEntryList *selectEntries(TTree *tree, const char *cut, const long *entries, Long64_t n) {
+            Selection selection(tree, cut);
+            TEntryList *list = new TEntryList("elist", "elist");
+            for (Long64_t i = 0; i < n; ++i)
+                if (selection.pass(entries[i])) list->Enter(entries[i]);
+            return list;
+        }
+    }
+    """)
+    return ROOT.preskimming
+
+
 class JSONFilter:
     def __init__(self, fname="", runsAndLumis={}):
         self.keep = {}
@@ -19,6 +120,22 @@ class JSONFilter:
         for run in list(self.keep.keys()):
             if len(self.keep[run]) == 0:
                 del self.keep[run]
+        self._buildIndex()
+
+    def _buildIndex(self):
+        """Merged (run << 32 | lumi) intervals for array lookups"""
+        intervals = sorted(((run << 32) | l1, (run << 32) | l2)
+                           for run, lumis in self.keep.items() for (l1, l2) in lumis)
+        starts = []
+        ends = []
+        for start, end in intervals:
+            if len(ends) > 0 and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self._starts = np.array(starts, dtype=np.uint64)
+        self._ends = np.array(ends, dtype=np.uint64)
 
     def filterRunLumi(self, run, lumi):
         try:
@@ -32,11 +149,36 @@ class JSONFilter:
     def filterRunOnly(self, run):
         return (run in self.keep)
 
+    def filterRunLumiArray(self, runs, lumis):
+        """Vectorised filterRunLumi. Returns a boolean array"""
+        keys = (np.asarray(runs, dtype=np.uint64) << np.uint64(32)) | np.asarray(lumis, dtype=np.uint64)
+        if len(self._starts) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        i = np.searchsorted(self._starts, keys, side='right') - 1
+        return (i >= 0) & (keys <= self._ends[np.maximum(i, 0)])
+
     def runCut(self):
         return "%d <= run && run <= %s" % (min(self.keep.keys()), max(self.keep.keys()))
 
     def filterEList(self, tree, elist):
-        # FIXME this can be optimized for sure
+        """Keep entries of elist (all entries if None) in certified lumi sections"""
+        preskimming = _declarePreskimCode()
+        if elist:
+            entries = np.zeros(elist.GetN(), dtype=np.int64)
+            preskimming.listEntries(elist, entries)
+            runs = np.zeros(len(entries), dtype=np.uint32)
+            lumis = np.zeros(len(entries), dtype=np.uint32)
+            preskimming.readRunLumiEntries(tree, entries, len(entries), runs, lumis)
+        else:
+            entries = np.arange(tree.GetEntries(), dtype=np.int64)
+            runs = np.zeros(len(entries), dtype=np.uint32)
+            lumis = np.zeros(len(entries), dtype=np.uint32)
+            preskimming.readRunLumiRange(tree, 0, len(entries), runs, lumis)
+        selected = entries[self.filterRunLumiArray(runs, lumis)]
+        return preskimming.makeList(selected, len(selected), 'filteredList')
+
+    def _filterEListLoop(self, tree, elist):
+        """Entry by entry version of filterEList, kept for benchmarks"""
         tree.SetBranchStatus("*", 0)
         tree.SetBranchStatus('run', 1)
         tree.SetBranchStatus('luminosityBlock', 1)
@@ -57,6 +199,47 @@ class JSONFilter:
 
 
 def preSkim(tree, jsonInput=None, cutstring=None, maxEntries=None, firstEntry=0):
+    """Select entries passing the JSON lumi mask and the cut
+
+    The run and luminosityBlock columns are read in bulk and checked
+    against the certified intervals as arrays. The cut is evaluated
+    with TTreeFormula, as TTree::Draw would do, only for certified
+    entries in the same pass.
+    """
+    if jsonInput == None and cutstring == None:
+        return None, None
+    jsonFilter = None
+    if jsonInput != None:
+        if type(jsonInput) is dict:
+            jsonFilter = JSONFilter(runsAndLumis=jsonInput)
+        else:
+            jsonFilter = JSONFilter(jsonInput)
+    cut = cutstring
+    if maxEntries is None:
+        maxEntries = ROOT.TVirtualTreePlayer.kMaxEntries
+    while cut and "AltBranch$" in cut:
+        m = re.search(r"AltBranch\$\(\s*(\w+)\s*,\s*(\w+)\s*\)", cut)
+        if not m:
+            raise RuntimeError(
+                "Error, found AltBranch$ in cut string, but it doesn't comply with the syntax this code can support. The cut is %r" % cut)
+        cut = cut.replace(m.group(0), m.group(
+            1) if tree.GetBranch(m.group(1)) else m.group(2))
+    nEntries = max(0, min(tree.GetEntries() - firstEntry, maxEntries))
+
+    preskimming = _declarePreskimCode()
+    if jsonFilter:
+        runs = np.zeros(nEntries, dtype=np.uint32)
+        lumis = np.zeros(nEntries, dtype=np.uint32)
+        preskimming.readRunLumiRange(tree, firstEntry, nEntries, runs, lumis)
+        entries = np.flatnonzero(jsonFilter.filterRunLumiArray(runs, lumis)).astype(np.int64) + firstEntry
+        elist = preskimming.selectEntries(tree, cut if cut else "", entries, len(entries))
+    else:
+        elist = preskimming.selectRange(tree, cut if cut else "", firstEntry, nEntries)
+    return elist, jsonFilter
+
+
+def _preSkimDraw(tree, jsonInput=None, cutstring=None, maxEntries=None, firstEntry=0):
+    """preSkim based on TTree::Draw and the entry loop, kept for benchmarks"""
     if jsonInput == None and cutstring == None:
         return None, None
     cut = None
@@ -81,5 +264,57 @@ def preSkim(tree, jsonInput=None, cutstring=None, maxEntries=None, firstEntry=0)
     tree.Draw('>>elist', cut, "entrylist", maxEntries, firstEntry)
     elist = ROOT.gDirectory.Get('elist')
     if jsonInput:
-        elist = jsonFilter.filterEList(tree, elist)
+        elist = jsonFilter._filterEListLoop(tree, elist)
     return elist, jsonFilter
+
+
+def _entries(elist):
+    preskimming = _declarePreskimCode()
+    entries = np.zeros(elist.GetN(), dtype=np.int64)
+    preskimming.listEntries(elist, entries)
+    return entries
+
+
+def benchmark(nEntries=1000000):
+    """Preskim time per million entries with TTree::Draw and with bulk reading"""
+    import os
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    fileName = os.path.join(tmpdir, "events.root")
+    df = ROOT.RDataFrame(nEntries)
+    df = df.Define("run", "(UInt_t)(355000 + rdfentry_ / 100000)")
+    df = df.Define("luminosityBlock", "(UInt_t)(1 + (rdfentry_ / 500) % 200)")
+    df = df.Define("nMuon", "(Int_t)(rdfentry_ % 4)")
+    df = df.Define("Muon_pt", "ROOT::RVecF v(nMuon); for (auto &x: v) x = gRandom->Exp(10); return v;")
+    df.Snapshot("Events", fileName)
+
+    # every other lumi range is certified
+    runsAndLumis = {}
+    for run in range(355000, 355000 + nEntries // 100000 + 1):
+        runsAndLumis[str(run)] = [[l, l + 9] for l in range(1, 200, 20)]
+
+    cases = [("cut", None, "Sum$(Muon_pt > 20) > 0"),
+             ("json", runsAndLumis, None),
+             ("json+cut", runsAndLumis, "Muon_pt > 20")]
+    for name, jsonInput, cut in cases:
+        times = {}
+        results = {}
+        for mode, function in [("draw", _preSkimDraw), ("bulk", preSkim)]:
+            inFile = ROOT.TFile.Open(fileName)
+            tree = inFile.Get("Events")
+            t0 = time.time()
+            elist, jsonFilter = function(tree, jsonInput, cut)
+            times[mode] = time.time() - t0
+            results[mode] = _entries(elist)
+            inFile.Close()
+        if not np.array_equal(results["draw"], results["bulk"]):
+            raise RuntimeError("Preskim results differ for %s" % name)
+        print("%-9s selected %8d: draw %6.2f s/M entries, bulk %6.2f s/M entries (x%.1f)" % (
+            name, len(results["bulk"]), times["draw"] * 1e6 / nEntries, times["bulk"] * 1e6 / nEntries,
+            times["draw"] / times["bulk"]))
+    os.remove(fileName)
+    os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    benchmark()
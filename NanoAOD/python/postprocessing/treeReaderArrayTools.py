@@ -1,3 +1,4 @@
+import fnmatch
 import types
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -15,11 +16,17 @@ def InputTree(tree, entrylist=ROOT.MakeNullPointer(ROOT.TEntryList)):
     tree._ttras = {}
     tree._leafTypes = {}
     tree._ttreereaderversion = 1
+    tree._sideReaders = []
+    tree._newSideReaders = 0
+    tree._newBranches = []
+    tree._quietEntries = 0
+    tree._mergeAfter = _minQuietEntries
     tree.arrayReader = types.MethodType(getArrayReader, tree)
     tree.valueReader = types.MethodType(getValueReader, tree)
     tree.readBranch = types.MethodType(readBranch, tree)
     tree.gotoEntry = types.MethodType(_gotoEntry, tree)
     tree.readAllBranches = types.MethodType(_readAllBranches, tree)
+    tree.declareBranches = types.MethodType(declareBranches, tree)
     tree.entries = tree._ttreereader.GetEntries(False)
     tree._extrabranches = {}
     return tree
@@ -55,6 +62,42 @@ def getValueReader(tree, branchName):
     return tree._ttrvs[branchName]
 
 
+def declareBranches(tree, branchNames):
+    """Make readers for a set of branches at once. Names may contain wildcards.
+
+    Before the first entry is read the readers are attached to the main
+    reader, later they share one new reader and existing ones are kept."""
+    names = []
+    allNames = None
+    for pattern in branchNames:
+        if any(c in pattern for c in "*?["):
+            if allNames is None:
+                allNames = [b.GetName() for b in tree.GetListOfBranches()]
+            names += [n for n in allNames if fnmatch.fnmatchcase(n, pattern)
+                      and tree.GetBranchStatus(n)]
+        else:
+            names.append(pattern)
+    reader = None
+    for branchName in names:
+        if branchName in tree._ttrvs or branchName in tree._ttras:
+            continue
+        branch = tree.GetBranch(branchName)
+        if not branch:
+            raise RuntimeError("Can't find branch '%s'" % branchName)
+        if not tree.GetBranchStatus(branchName):
+            raise RuntimeError("Branch %s has status=0" % branchName)
+        if reader is None:
+            reader, position = _readerForNewBranches(tree)
+        leaf = branch.GetLeaf(branchName)
+        typ = leaf.GetTypeName()
+        if leaf.GetLen() == 1 and not bool(leaf.GetLeafCount()):
+            _makeValueReader(tree, typ, branchName, reader)
+        else:
+            _makeArrayReader(tree, typ, branchName, reader)
+    if reader is not None and position:
+        _positionReader(tree, reader)
+
+
 def clearExtraBranches(tree):
     tree._extrabranches = {}
 
@@ -84,38 +127,80 @@ def readBranch(tree, branchName):
         typ = leaf.GetTypeName()
         if leaf.GetLen() == 1 and not bool(leaf.GetLeafCount()):
             _vr = _makeValueReader(tree, typ, branchName)
-            # force calling SetEntry as a new ValueReader was created
-            tree.gotoEntry(tree.entry, forceCall=True)
             ret = _vr.Get()[0]
             return ord(ret) if type(ret) == str else ret
         else:
-            _ar = _makeArrayReader(tree, typ, branchName)
-            # force calling SetEntry as a new ArrayReader was created
-            tree.gotoEntry(tree.entry, forceCall=True)
-            return _ar
+            return _makeArrayReader(tree, typ, branchName)
 
 
 ####### PRIVATE IMPLEMENTATION PART #######
 
-def _makeArrayReader(tree, typ, nam):
-    if not tree._ttreereader._isClean:
-        _remakeAllReaders(tree)
-    ttra = ROOT.TTreeReaderArray(typ)(tree._ttreereader, nam)
+# Readers of branches requested after the first entry was read are
+# attached to side readers, so that the existing ones are kept. A
+# TTreeReader doesn't set up readers added after it was positioned, so
+# each request within an entry gets its own side reader. At the next
+# entry they are moved to one side reader. Side readers are merged into
+# the main reader in one rebuild when there are too many of them or
+# when no new branches were requested for a number of entries. The
+# number of entries grows after each such merge, so that sparse branch
+# discovery causes only a few rebuilds.
+_maxSideReaders = 32
+_minQuietEntries = 16
+
+
+def _readerForNewBranches(tree):
+    """Return the TTreeReader for new branch readers and whether it has to be positioned"""
+    if tree._ttreereader._isClean:
+        return tree._ttreereader, False
+    reader = ROOT.TTreeReader(tree, getattr(tree, '_entrylist', ROOT.MakeNullPointer(ROOT.TEntryList)))
+    tree._sideReaders.append(reader)
+    tree._newSideReaders += 1
+    return reader, True
+
+
+def _remakeReadersForNewBranches(tree):
+    """Old behaviour kept for benchmarks: rebuild all readers for every new branch"""
+    if tree._ttreereader._isClean:
+        return tree._ttreereader, False
+    _remakeAllReaders(tree)
+    return tree._ttreereader, True
+
+
+def _positionReader(tree, reader):
+    reader.SetEntry(tree.entry)
+    reader._isClean = False
+
+
+def _makeArrayReader(tree, typ, nam, reader=None):
+    position = False
+    if reader is None:
+        reader, position = _readerForNewBranches(tree)
+    ttra = ROOT.TTreeReaderArray(typ)(reader, nam)
     tree._leafTypes[nam] = typ
     tree._ttras[nam] = ttra
+    if reader is not tree._ttreereader:
+        tree._newBranches.append(nam)
+    if position:
+        _positionReader(tree, reader)
     return tree._ttras[nam]
 
 
-def _makeValueReader(tree, typ, nam):
-    if not tree._ttreereader._isClean:
-        _remakeAllReaders(tree)
-    ttrv = ROOT.TTreeReaderValue(typ)(tree._ttreereader, nam)
+def _makeValueReader(tree, typ, nam, reader=None):
+    position = False
+    if reader is None:
+        reader, position = _readerForNewBranches(tree)
+    ttrv = ROOT.TTreeReaderValue(typ)(reader, nam)
     tree._leafTypes[nam] = typ
     tree._ttrvs[nam] = ttrv
+    if reader is not tree._ttreereader:
+        tree._newBranches.append(nam)
+    if position:
+        _positionReader(tree, reader)
     return tree._ttrvs[nam]
 
 
 def _remakeAllReaders(tree):
+    """Rebuild all value and array readers on a single new TTreeReader"""
     _ttreereader = ROOT.TTreeReader(tree, getattr(tree, '_entrylist', ROOT.MakeNullPointer(ROOT.TEntryList)))
     _ttreereader._isClean = True
     _ttrvs = {}
@@ -127,9 +212,25 @@ def _remakeAllReaders(tree):
     tree._ttrvs = _ttrvs
     tree._ttras = _ttras
     tree._ttreereader = _ttreereader
+    tree._sideReaders = []
+    tree._newSideReaders = 0
+    tree._newBranches = []
+    tree._quietEntries = 0
     tree._ttreereaderversion += 1
 
 
+def _mergeNewSideReaders(tree):
+    """Move the readers made on the side readers of the last entry to one side reader"""
+    reader = ROOT.TTreeReader(tree, getattr(tree, '_entrylist', ROOT.MakeNullPointer(ROOT.TEntryList)))
+    reader._isClean = True
+    for k in tree._newBranches:
+        if k in tree._ttrvs:
+            tree._ttrvs[k] = ROOT.TTreeReaderValue(tree._leafTypes[k])(reader, k)
+        else:
+            tree._ttras[k] = ROOT.TTreeReaderArray(tree._leafTypes[k])(reader, k)
+    tree._sideReaders[-tree._newSideReaders:] = [reader]
+
+
 def _readAllBranches(tree):
     tree.GetEntry(_currentTreeEntry(tree))
 
@@ -142,10 +243,29 @@ def _currentTreeEntry(tree):
 
 
 def _gotoEntry(tree, entry, forceCall=False):
+    if tree.entry != entry and tree._sideReaders:
+        if tree._newSideReaders == 0:
+            tree._quietEntries += 1
+        else:
+            tree._quietEntries = 0
+        if len(tree._sideReaders) >= _maxSideReaders:
+            _remakeAllReaders(tree)
+        elif tree._quietEntries >= tree._mergeAfter:
+            _remakeAllReaders(tree)
+            tree._mergeAfter *= 2
+        elif tree._newSideReaders > 1:
+            _mergeNewSideReaders(tree)
+        tree._newSideReaders = 0
+        tree._newBranches = []
+    fresh = tree._ttreereader._isClean
     tree._ttreereader._isClean = False
     if tree.entry != entry or forceCall:
-        if (tree.entry == entry - 1 and entry != 0):
-            tree._ttreereader.Next()
-        else:
-            tree._ttreereader.SetEntry(entry)
+        for reader in [tree._ttreereader] + tree._sideReaders:
+            if reader is not tree._ttreereader:
+                fresh = reader._isClean
+                reader._isClean = False
+            if (tree.entry == entry - 1 and entry != 0) and not fresh:
+                reader.Next()
+            else:
+                reader.SetEntry(entry)
         tree.entry = entry
@@ -1,6 +1,137 @@
 import ROOT
 import glob
 
+_cut_flow_declared = False
+
+def declare_cut_flow():
+    """Compile the cut flow event loop"""
+    global _cut_flow_declared
+    if _cut_flow_declared:
+        return
+    ROOT.gInterpreter.Declare("""
+    #include <memory>
+    #include <stdexcept>
+    #include <string>
+    #include <vector>
+    #include "TTree.h"
+    #include "TTreeFormula.h"
+
+    // Count events passing combinations of cuts given as bitmasks.
+    // Cuts are evaluated with TTreeFormula like in TTree::GetEntries(cut).
+    // Bits of cuts on arrays are kept per array element, so that a
+    // combination passes only if the same element satisfies all its
+    // cuts. The last element of the result is non-zero if array cuts
+    // had different numbers of elements, which can't be combined.
+    std::vector<double> cut_flow_count(TTree *tree, const std::vector<std::string> &cuts,
+                                       const std::vector<ULong64_t> &masks, const std::string &weight)
+    {
+        std::vector<std::unique_ptr<TTreeFormula>> formulas(cuts.size());
+        ULong64_t array_bits = 0;
+        for (size_t k = 0; k < cuts.size(); ++k) {
+            if (cuts[k].empty()) continue;
+            formulas[k].reset(new TTreeFormula(Form("cut%zu", k), cuts[k].c_str(), tree));
+            if (formulas[k]->GetNdim() == 0)
+                throw std::runtime_error("Invalid cut: " + cuts[k]);
+            if (formulas[k]->GetMultiplicity() != 0)
+                array_bits |= (1ULL << k);
+        }
+        std::unique_ptr<TTreeFormula> weight_formula;
+        if (!weight.empty()) {
+            weight_formula.reset(new TTreeFormula("weight", weight.c_str(), tree));
+            if (weight_formula->GetNdim() == 0)
+                throw std::runtime_error("Invalid weight: " + weight);
+        }
+
+        std::vector<double> counts(masks.size() + 1, 0);
+        std::vector<ULong64_t> element_bits;
+        Int_t tree_number = -1;
+        for (Long64_t entry = 0; ; ++entry) {
+            if (tree->LoadTree(entry) < 0) break;
+            if (tree->GetTreeNumber() != tree_number) {
+                tree_number = tree->GetTreeNumber();
+                for (auto &f: formulas)
+                    if (f) f->UpdateFormulaLeaves();
+                if (weight_formula) weight_formula->UpdateFormulaLeaves();
+            }
+
+            ULong64_t event_bits = 0;
+            int n_elements = -1;
+            for (size_t k = 0; k < formulas.size(); ++k) {
+                if (!formulas[k]) continue;
+                int n = formulas[k]->GetNdata();
+                if ((array_bits & (1ULL << k)) == 0) {
+                    if (n > 0 && formulas[k]->EvalInstance(0) != 0)
+                        event_bits |= (1ULL << k);
+                    continue;
+                }
+                if (n_elements < 0) {
+                    n_elements = n;
+                    element_bits.assign(n, 0);
+                } else if (n != n_elements) {
+                    counts.back() = 1;
+                    return counts;
+                }
+                for (int i = 0; i < n; ++i)
+                    if (formulas[k]->EvalInstance(i) != 0)
+                        element_bits[i] |= (1ULL << k);
+            }
+
+            double w = 1;
+            if (weight_formula)
+                w = weight_formula->GetNdata() > 0 ? weight_formula->EvalInstance(0) : 0;
+
+            for (size_t j = 0; j < masks.size(); ++j) {
+                ULong64_t scalar_mask = masks[j] & ~array_bits;
+                ULong64_t array_mask = masks[j] & array_bits;
+                if ((event_bits & scalar_mask) != scalar_mask) continue;
+                bool passed = (array_mask == 0);
+                for (int i = 0; !passed && i < n_elements; ++i)
+                    passed = (element_bits[i] & array_mask) == array_mask;
+                if (passed) counts[j] += w;
+            }
+        }
+        return counts;
+    }
+    """)
+    _cut_flow_declared = True
+
+
+class CutFlow:
+    """Count events passing combinations of cuts in one pass over a chain
+
+    Each cut is evaluated once per event and stored as a bit. Cumulative,
+    N-1 and individual selections are bitmasks over the list of cuts and
+    are counted in the same event loop. The counts are the same as those
+    of chain.GetEntries() with the corresponding selection. Empty cuts
+    always pass. With a weight expression the counts are sums of weights.
+    """
+    def __init__(self, chain, cuts, weight=None):
+        if len(cuts) > 64:
+            raise Exception("CutFlow supports up to 64 cuts")
+        self.chain = chain
+        self.cuts = cuts
+        self.weight = weight
+
+    def get_selection(self, mask):
+        """Selection string of a bitmask"""
+        return "&&".join(cut for k, cut in enumerate(self.cuts) if (mask >> k) & 1 and cut != "")
+
+    def count(self, masks):
+        """Number of events passing each mask. Returns a dict"""
+        masks = sorted(set(masks))
+        declare_cut_flow()
+        counts = ROOT.cut_flow_count(self.chain, ROOT.std.vector('std::string')(self.cuts),
+                                     ROOT.std.vector('ULong64_t')(masks), self.weight or "")
+        if counts[len(masks)] != 0:
+            # cuts on arrays of different size can only be checked in combination
+            if self.weight:
+                raise Exception("Weighted cut flow requires cuts on arrays of the same size")
+            return {mask: self.chain.GetEntries(self.get_selection(mask)) for mask in masks}
+        if self.weight:
+            return {mask: counts[j] for j, mask in enumerate(masks)}
+        return {mask: int(counts[j]) for j, mask in enumerate(masks)}
+
+
 class EfficiencyReport:
     def __init__(self, samples, cuts):
         self.samples = samples
@@ -18,6 +149,42 @@ class EfficiencyReport:
             return ""
 
 
+    def get_mask(self, final_state, cut_to_exclude=None):
+        """ Get bitmask of N and N-1 cuts """
+
+        mask = 0
+        for k, entry in enumerate(self.cuts):
+            if final_state in entry['cut']:
+                if cut_to_exclude and cut_to_exclude == entry['cut'][final_state]:
+                    continue
+                mask |= 1 << k
+        return mask
+
+
+    def get_counts(self, sample):
+        """ Count events for all selections of the report in one event loop
+
+        Returns event counts for cumulative, N-1 and individual cuts
+        keyed by their bitmasks. Events are weighted by sample['weight']
+        if it's defined.
+        """
+
+        final_state = sample['final_state']
+        cut_flow = CutFlow(self.get_events(sample),
+                           [entry['cut'].get(final_state, "") for entry in self.cuts],
+                           sample.get('weight'))
+
+        masks = [0, self.get_mask(final_state)]
+        current = 0
+        for k, entry in enumerate(self.cuts):
+            if final_state in entry['cut']:
+                current |= 1 << k
+                masks.append(current)
+                masks.append(self.get_mask(final_state, entry['cut'][final_state]))
+                masks.append(1 << k)
+        return cut_flow.count(masks)
+
+
     def get_complete_selection(self, final_state, cut_to_exclude=None):
         """ Get N and N-1 cuts """
 
@@ -94,17 +261,17 @@ class EfficiencyReport:
         current_counts = []
         final_counts = []
 
-        current_cuts = [""] * len(self.samples)
+        current_masks = [0] * len(self.samples)
+        counts = []
         
         for sample in self.samples:
-            events = self.get_events(sample)
             lumi = self.get_lumi(sample)
+            counts.append(self.get_counts(sample))
 
-            n_events_in_sample = events.GetEntries()
+            n_events_in_sample = counts[-1][0]
             event_counts.append(n_events_in_sample)
 
-            cut = self.get_complete_selection(sample['final_state'])
-            final_counts.append(events.GetEntries(cut))
+            final_counts.append(counts[-1][self.get_mask(sample['final_state'])])
 
             if baseline == "sample":
                 baseline_counts.append(n_events_in_sample)
@@ -112,8 +279,8 @@ class EfficiencyReport:
                 baseline_counts.append(lumi[0])
                 gen_passed_counts.append(lumi[1])
             elif baseline == "first_cut":
-                cut = self.get_first_cut(sample['final_state'])
-                baseline_counts.append(events.GetEntries(cut))
+                first_cut = 1 if sample['final_state'] in self.cuts[0]['cut'] else 0
+                baseline_counts.append(counts[-1][first_cut])
             else:
                 raise Exception("Unsupported report baseline: %s" % baseline)
             
@@ -144,24 +311,20 @@ class EfficiencyReport:
                 print(prefix % entry['name'], end=' ')
             for i,sample in enumerate(self.samples):
                 if baseline == "first_cut" and icut == 0:
-                    current_cuts[i] = entry['cut'][sample['final_state']]
+                    current_masks[i] = 1 << icut
                     continue
-                chain = self.get_events(sample)
                 if sample['final_state'] in entry['cut']:
                     scale = 100.0
                     if 'scale' in sample:
                         scale = sample['scale']
-                    if current_cuts[i] != "":
-                        current_cuts[i] += "&&"
-                    current_cuts[i] += entry['cut'][sample['final_state']]
+                    current_masks[i] |= 1 << icut
 
-                    #print "cut ",current_cuts[i]
-                    n1 = chain.GetEntries(current_cuts[i])
+                    n1 = counts[i][current_masks[i]]
 
                     print(("& " + format) % (scale * n1 / baseline_counts[i]), end=' ')
 
                     if not first_line:
-                        n2 = chain.GetEntries(self.get_complete_selection(sample['final_state'], entry['cut'][sample['final_state']]))
+                        n2 = counts[i][self.get_mask(sample['final_state'], entry['cut'][sample['final_state']])]
                         print(("& %5.1f & %5.1f ") % (100.0 * n1 / current_counts[i], 100.0 * final_counts[i] / n2), end=' ')
                     else:
                         print(f"& {default_empty_string} & {default_empty_string} ", end=' ')
@@ -2,6 +2,7 @@ import os, re
 import ROOT
 import math 
 import sweights
+from histogram_booking import translate, get_branch_counters
 import tdrstyle
 from ROOT.RooFit import Binning
 from ROOT import RooRealVar
@@ -136,11 +137,6 @@ for dataset, info in datasets.items():
     chain_mc = ROOT.TChain("mva")
     chain_mc.Add(info['mc'])
     print "Number of MC events:", chain_mc.GetEntries()
-    ds_mc = sweights.make_dataset(chain_mc, "mc", mass, roovars, selection)
-
-    # for i in range(10):
-    #     ds_mc.get(i).Print("V")
-    # break
 
     chain_data = ROOT.TChain("mva")
     for pattern in info['data']:
@@ -152,8 +148,10 @@ for dataset, info in datasets.items():
     chain_mc.Draw("mm_kin_mass>>ref_hist", selection)
 
     # ws = sweights.get_workspace_with_weights_for_jpsik(chain_data, "data", mass, roovars, selection)
-    ws = sweights.get_workspace_with_weights_for_jpsik(chain_data, "data", mass, roovars,
-                                                       cuts=selection, ref_hist=ref_hist)
+    # sWeights are stored in a friend tree, the workspace has only the mass
+    ws, sweights_file = sweights.compute_sweights(chain_data, "data", mass, roovars,
+                                                  cuts=selection, ref_hist=ref_hist,
+                                                  output="results/sweights_bjpsik_%s.root" % name)
 
     ### Fit Validation
     
@@ -174,18 +172,27 @@ for dataset, info in datasets.items():
 
     ### Plots results
 
-    dataw_sig = ROOT.RooDataSet(ds_data.GetName(), ds_data.GetTitle(), ds_data, ds_data.get(), "", "Nsig_sw")
+    # fill projections of all variables in one pass over each sample
+    projections = []
+    for var, binning, legend_position in variables:
+        if var.GetName() in ["trigger", "HLT_DoubleMu4_Jpsi_NoVertexing", "HLT_Dimuon6_Jpsi_NoVertexing"]:
+            continue
+        projections.append((var, binning, legend_position))
+    bins = [(var, binning) for var, binning, legend_position in projections]
+    h_data_all = sweights.fill_projections(chain_data, bins, "selected", "Nsig_sw", sweights_file)
+    # same translation of the TTree::Draw selection as in compute_sweights
+    mc_selection = sweights.range_selection(roovars + [mass],
+                                            translate(selection, get_branch_counters(chain_mc))[0])
+    h_mc_all = sweights.fill_projections(chain_mc, bins, mc_selection)
 
     ROOT.gStyle.SetOptFit(1)
     
-    for var, binning, legend_position in variables:
+    for i, (var, binning, legend_position) in enumerate(projections):
         c1.cd()
-        if var.GetName() in ["trigger", "HLT_DoubleMu4_Jpsi_NoVertexing", "HLT_Dimuon6_Jpsi_NoVertexing"]:
-            continue
         # nbins = 50
         # if v.GetName() == 'mm_mva':
         #     nbins = 11
-        h_data = ROOT.RooAbsData.createHistogram(dataw_sig, 'sig', var, binning)
+        h_data = h_data_all[i]
         h_data.SetLineWidth(2)
         # h_data.SetMarkerStyle(21)
         if var.GetName() == 'mm_kin_alphaSig':
@@ -196,7 +203,7 @@ for dataset, info in datasets.items():
         if var.GetName() == 'mm_kin_alphaSig':
             h_data.GetListOfFunctions().Clear()
             
-        h_mc = ROOT.RooAbsData.createHistogram( ds_mc, 'mc', var, binning)
+        h_mc = h_mc_all[i]
         h_mc.SetLineColor(ROOT.kRed)
         h_mc.SetMarkerColor(ROOT.kRed)
         h_mc.SetLineWidth(2)
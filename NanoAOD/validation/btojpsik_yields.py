@@ -12,13 +12,18 @@ The fits are heavy and memory demanding due to a large number of
 events in each Era for each category. If jobs fail you can re-run it
 for one Era at a time.
 
+In the fit farm mode (use_fit_farm) the selected entries of each
+sample are cached in compact files with only the fit variables and
+the fits of each Era and channel run in separate worker processes.
+
 """
-import os, re, copy, json
+import os, re, copy, json, time
 import ROOT
 import math 
 import tdrstyle
 from ROOT.RooFit import Binning
 from ROOT import RooRealVar
+import fit_farm
 
 # Set the TDR style
 tdrstyle.setTDRStyle()
@@ -51,6 +56,12 @@ jpsik_bf = 1.02e-3
 # channel.defineType("central", 0)
 # channel.defineType("forward", 1)
 
+# Fit farm mode: selections are cached as compact datasets and fits
+# of each Era and channel run in parallel worker processes
+use_fit_farm = True
+n_workers = 4
+memory_per_worker = 8000 # MB of address space, None - no limit
+
 # Silence RooFit info messages
 ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
 
@@ -179,8 +190,10 @@ def make_dataset(input_tree, name, mass_var, other_vars, cuts="", weight=""):
     
     # pre-filter tree to memory
     # ROOT.gROOT.cd()
-    ftmp = ROOT.TFile.Open("/tmp/dmytro/tmp.root","RECREATE")
-    tree = input_tree.CopyTree(cuts)
+    tree = input_tree
+    if cuts != "":
+        ftmp = ROOT.TFile.Open("/tmp/dmytro/tmp.root","RECREATE")
+        tree = input_tree.CopyTree(cuts)
     print "Nubmer of events after filter:", tree.GetEntries()
     
     var_set = ROOT.RooArgSet()
@@ -252,13 +265,114 @@ def get_generated_number_of_events(file_pattern):
 ROOT.gROOT.SetBatch(True)
 c1 = ROOT.TCanvas("c1","c1", 800, 800)
 
+# RooFit parallelization is not used when fits run in parallel
+num_cpu = 1 if use_fit_farm else 8
+
+def make_datasets(name, chains, selection, n_gen_jpsik, n_gen_jpsipi):
+    """Build MC and Data datasets and compute the JpsiPi fraction"""
+    info = datasets[name]
+
+    # roovars_mc applies mc matching
+    ds_mc_jpsik = make_dataset(chains['mc_jpsik'], "jpsik", mass, roovars_mc, selection)
+    eff_jpsik   = ds_mc_jpsik.sumEntries() / n_gen_jpsik
+    print "Efficiency JpsiPi: ", eff_jpsik
+
+    # roovars_mc applies mc matching
+    ds_mc_jpsipi = make_dataset(chains['mc_jpsipi'], "jpsipi", mass, roovars_mc, selection)
+    eff_jpsipi =  ds_mc_jpsipi.sumEntries() / n_gen_jpsipi
+    print "Efficiency JpsiPi: ", eff_jpsipi
+
+    jpsipi_fraction = jpsipi_bf / jpsik_bf * eff_jpsipi / eff_jpsik
+    print "JpsiPi yield is fixed to JpsiK at", jpsipi_fraction
+    
+    ds_data = make_dataset(chains['data'], "data", mass, roovars, selection, "%s_ps" % info['trigger'])
+
+    return ds_mc_jpsik, ds_mc_jpsipi, ds_data, jpsipi_fraction
+
+def fit_channel(name, ich, ds_mc_jpsik, ds_mc_jpsipi, ds_data, jpsipi_fraction):
+    """Fit one channel and return the signal yield"""
+    info = datasets[name]
+
+    if ich == 0:
+        ds_mc_jpsik_ch   = ds_mc_jpsik.reduce("chan<0.5")
+        ds_mc_jpsipi_ch  = ds_mc_jpsipi.reduce("chan<0.5")
+        ds_data_ch = ds_data.reduce("chan<0.5")
+    else:
+        ds_mc_jpsik_ch   = ds_mc_jpsik.reduce("chan>0.5")
+        ds_mc_jpsipi_ch  = ds_mc_jpsipi.reduce("chan>0.5")
+        ds_data_ch = ds_data.reduce("chan>0.5")
+
+    print "Number of JpsiK MC events in chan%u: %d"   % (ich, ds_mc_jpsik_ch.sumEntries())
+    print "Number of JpsiPi MC events in chan%u: %d"  % (ich, ds_mc_jpsipi_ch.sumEntries())
+    print "Number of Data events in chan%u: %d" % (ich, ds_data_ch.sumEntries())
+
+    ## Get reference signal mass distribution
+    
+    jpsik_hist = ROOT.RooAbsData.createHistogram(ds_mc_jpsik_ch, 'jpsik', mass, mass_ref_binning)
+    jpsik_hist.SetDirectory(0)
+    jpsik_hist.Draw()
+    print_canvas(name + "_mc_jpsik_chan%u_mass_ref" % ich, output_path)
+    
+    jpsipi_hist = ROOT.RooAbsData.createHistogram(ds_mc_jpsipi_ch, 'jpsipi', mass, mass_ref_binning)
+    jpsipi_hist.SetDirectory(0)
+    jpsipi_hist.Draw()
+    print_canvas(name + "_mc_jpsipi_chan%u_mass_ref" % ich, output_path)
+
+    ws = build_model(mass, jpsik_hist, jpsipi_hist, jpsipi_fraction)
+
+    ## Fit Data
+
+    model = ws.pdf("model")
+    model.fitTo(ds_data_ch,  ROOT.RooFit.NumCPU(num_cpu), ROOT.RooFit.Extended(ROOT.kTRUE), ROOT.RooFit.Minos(ROOT.kFALSE), ROOT.RooFit.PrintLevel(print_level))
+
+    if info['fix_resolution']:
+        ws.var("sigma").setConstant(True)
+        model.fitTo(ds_data_ch,  ROOT.RooFit.NumCPU(num_cpu), ROOT.RooFit.Extended(ROOT.kTRUE), ROOT.RooFit.Minos(ROOT.kFALSE), ROOT.RooFit.PrintLevel(print_level))
+
+    ## Plot results
+
+    frame = mass.frame()
+    ds_data_ch.plotOn(frame, mass_plot_binning)
+    frame.SetMaximum(frame.GetMaximum() * 1.2)
+    bkgs = ROOT.RooArgSet()
+    bkgs.add(ws.pdf("bkg"))
+    bkgs.add(ws.pdf("jpsipi_pdf"))
+    model.plotOn(frame, ROOT.RooFit.Components(bkgs),  ROOT.RooFit.LineColor(ROOT.kRed))
+    model.plotOn(frame, ROOT.RooFit.Components("bkg"), ROOT.RooFit.LineStyle(ROOT.kDashed))
+    model.plotOn(frame)
+    print "chiSquare: ", frame.chiSquare(6)
+    print "chiSquare: ", frame.chiSquare("model","data", 6)
+
+    model.paramOn(frame, ROOT.RooFit.Layout(0.7, 0.95, 0.92))
+    frame.getAttText().SetTextSize(0.02)
+    frame.Draw()
+    print_canvas(name + "_chan%u_mass_fit" % ich, output_path)
+
+    ## Store results
+    # {"2016BF": {"chan0": {"val": 305019.3, "err": 1167.6},
+    result = {"val": ws.var("Nsig").getVal(), "err": ws.var("Nsig").getError()}
+    
+    ws.Delete() # Cleanup
+
+    return result
+
+def fit_cached_channel(task):
+    name, ich, paths, n_gen_jpsik, n_gen_jpsipi = task
+    info = datasets[name]
+    chains = dict()
+    for sample, path in paths.items():
+        chains[sample] = fit_farm.cached_chain(info[sample + "_tree"], path)
+    ds_mc_jpsik, ds_mc_jpsipi, ds_data, jpsipi_fraction = make_datasets(name, chains, "", n_gen_jpsik, n_gen_jpsipi)
+    return fit_channel(name, ich, ds_mc_jpsik, ds_mc_jpsipi, ds_data, jpsipi_fraction)
+
+start_time = time.time()
+tasks = []
 for dataset, info in datasets.items():
     name = dataset
     if name in results and not recompute_results:
         print "Results are already available for %s. Skip" % name
         continue
     
-    results[name] = dict()
     selection = "%s>0 && m1q != m2q && (run == 1 || certified_muon) && m1bdt>0.45 && m2bdt>0.45 && m>%s && m<%s" % (info['trigger'], min_mass, max_mass)
     
     print "Processing", name
@@ -271,12 +385,7 @@ for dataset, info in datasets.items():
     print "Number of JpsiK MC events:", chain_mc_jpsik.GetEntries()
     if chain_mc_jpsik.GetEntries() == 0:
         raise Exception("No JpsiK MC events found for for " + name)
-    # roovars_mc applies mc matching
-    ds_mc_jpsik = make_dataset(chain_mc_jpsik, "jpsik", mass, roovars_mc, selection)
-
     n_gen_jpsik = get_generated_number_of_events(info['mc_jpsik'])
-    eff_jpsik   = ds_mc_jpsik.sumEntries() / n_gen_jpsik
-    print "Efficiency JpsiPi: ", eff_jpsik
 
     # B to Jpsi Pi
     chain_mc_jpsipi = ROOT.TChain(info['mc_jpsipi_tree'])
@@ -284,16 +393,8 @@ for dataset, info in datasets.items():
     print "Number of Jpsipi MC events:", chain_mc_jpsipi.GetEntries()
     if chain_mc_jpsipi.GetEntries() == 0:
         raise Exception("No Jpsipi MC events found for for " + name)
-    # roovars_mc applies mc matching
-    ds_mc_jpsipi = make_dataset(chain_mc_jpsipi, "jpsipi", mass, roovars_mc, selection)
-
     n_gen_jpsipi = get_generated_number_of_events(info['mc_jpsipi'])
-    eff_jpsipi =  ds_mc_jpsipi.sumEntries() / n_gen_jpsipi
-    print "Efficiency JpsiPi: ", eff_jpsipi
 
-    jpsipi_fraction = jpsipi_bf / jpsik_bf * eff_jpsipi / eff_jpsik
-    print "JpsiPi yield is fixed to JpsiK at", jpsipi_fraction
-    
     ## Get Data datasets
     
     chain_data = ROOT.TChain(info['data_tree'])
@@ -303,73 +404,47 @@ for dataset, info in datasets.items():
     if chain_data.GetEntries() == 0:
         raise Exception("No Data events found for for " + name)
 
-    ds_data = make_dataset(chain_data, "data", mass, roovars, selection, "%s_ps" % info['trigger'])
-    
-    for ich in range(2):
-        if ich == 0:
-            ds_mc_jpsik_ch   = ds_mc_jpsik.reduce("chan<0.5")
-            ds_mc_jpsipi_ch  = ds_mc_jpsipi.reduce("chan<0.5")
-            ds_data_ch = ds_data.reduce("chan<0.5")
-        else:
-            ds_mc_jpsik_ch   = ds_mc_jpsik.reduce("chan>0.5")
-            ds_mc_jpsipi_ch  = ds_mc_jpsipi.reduce("chan>0.5")
-            ds_data_ch = ds_data.reduce("chan>0.5")
-
-        print "Number of JpsiK MC events in chan%u: %d"   % (ich, ds_mc_jpsik_ch.sumEntries())
-        print "Number of JpsiPi MC events in chan%u: %d"  % (ich, ds_mc_jpsipi_ch.sumEntries())
-        print "Number of Data events in chan%u: %d" % (ich, ds_data_ch.sumEntries())
-
-        ## Get reference signal mass distribution
-        
-        jpsik_hist = ROOT.RooAbsData.createHistogram(ds_mc_jpsik_ch, 'jpsik', mass, mass_ref_binning)
-        jpsik_hist.SetDirectory(0)
-        jpsik_hist.Draw()
-        print_canvas(name + "_mc_jpsik_chan%u_mass_ref" % ich, output_path)
-        
-        jpsipi_hist = ROOT.RooAbsData.createHistogram(ds_mc_jpsipi_ch, 'jpsipi', mass, mass_ref_binning)
-        jpsipi_hist.SetDirectory(0)
-        jpsipi_hist.Draw()
-        print_canvas(name + "_mc_jpsipi_chan%u_mass_ref" % ich, output_path)
-
-        ws = build_model(mass, jpsik_hist, jpsipi_hist, jpsipi_fraction)
-
-        ## Fit Data
-    
-        model = ws.pdf("model")
-        model.fitTo(ds_data_ch,  ROOT.RooFit.NumCPU(8), ROOT.RooFit.Extended(ROOT.kTRUE), ROOT.RooFit.Minos(ROOT.kFALSE), ROOT.RooFit.PrintLevel(print_level))
-
-        if info['fix_resolution']:
-            ws.var("sigma").setConstant(True)
-            model.fitTo(ds_data_ch,  ROOT.RooFit.NumCPU(8), ROOT.RooFit.Extended(ROOT.kTRUE), ROOT.RooFit.Minos(ROOT.kFALSE), ROOT.RooFit.PrintLevel(print_level))
+    if use_fit_farm:
+        cache = fit_farm.DatasetCache()
+        columns_mc = [var.GetName() for var in roovars_mc] + [mass.GetName()]
+        columns = [var.GetName() for var in roovars] + [mass.GetName()]
+        paths = {
+            'mc_jpsik': cache.get(info['mc_jpsik_tree'], info['mc_jpsik'], selection, columns_mc),
+            'mc_jpsipi': cache.get(info['mc_jpsipi_tree'], info['mc_jpsipi'], selection, columns_mc),
+            'data': cache.get(info['data_tree'], info['data'], selection, columns),
+        }
+        for ich in range(2):
+            tasks.append(("%s chan%u" % (name, ich), ich, paths, n_gen_jpsik, n_gen_jpsipi))
+        continue
 
-        ## Plot results
+    chains = {'mc_jpsik': chain_mc_jpsik, 'mc_jpsipi': chain_mc_jpsipi, 'data': chain_data}
+    ds_mc_jpsik, ds_mc_jpsipi, ds_data, jpsipi_fraction = make_datasets(name, chains, selection, n_gen_jpsik, n_gen_jpsipi)
     
-        frame = mass.frame()
-        ds_data_ch.plotOn(frame, mass_plot_binning)
-        frame.SetMaximum(frame.GetMaximum() * 1.2)
-        bkgs = ROOT.RooArgSet()
-        bkgs.add(ws.pdf("bkg"))
-        bkgs.add(ws.pdf("jpsipi_pdf"))
-        model.plotOn(frame, ROOT.RooFit.Components(bkgs),  ROOT.RooFit.LineColor(ROOT.kRed))
-        model.plotOn(frame, ROOT.RooFit.Components("bkg"), ROOT.RooFit.LineStyle(ROOT.kDashed))
-        model.plotOn(frame)
-        print "chiSquare: ", frame.chiSquare(6)
-        print "chiSquare: ", frame.chiSquare("model","data", 6)
-
-        model.paramOn(frame, ROOT.RooFit.Layout(0.7, 0.95, 0.92))
-        frame.getAttText().SetTextSize(0.02)
-        frame.Draw()
-        print_canvas(name + "_chan%u_mass_fit" % ich, output_path)
-
-        ## Store results
-        # {"2016BF": {"chan0": {"val": 305019.3, "err": 1167.6},
-        results[name]["chan%u" % ich] = {"val": ws.var("Nsig").getVal(), "err": ws.var("Nsig").getError()}
-        
-        ws.Delete() # Cleanup
+    era_results = dict()
+    for ich in range(2):
+        era_results["chan%u" % ich] = fit_channel(name, ich, ds_mc_jpsik, ds_mc_jpsipi, ds_data, jpsipi_fraction)
 
     ## Save results
+    results[name] = era_results
     json.dump(results, open(output_path + "/results.json", "w"))
+
+if use_fit_farm:
+    # an Era is stored only when fits of both channels succeeded, so
+    # that incomplete Eras are recomputed in the next run
+    era_results = dict()
+    completed = set()
+    try:
+        for task, result in fit_farm.run_fits(tasks, fit_cached_channel, n_workers, memory_per_worker):
+            name = task[0].split()[0]
+            era_results.setdefault(name, dict())["chan%u" % task[1]] = result
+            if len(era_results[name]) == 2:
+                results[name] = era_results.pop(name)
+                completed.add(name)
+                ## Save results
+                json.dump(results, open(output_path + "/results.json", "w"))
+    except Exception as e:
+        print "Fits failed:", e
+        print "Eras without results:", ", ".join(sorted(set(task[0].split()[0] for task in tasks) - completed))
     
 print results
-
-
+fit_farm.print_usage(start_time)
@@ -0,0 +1,192 @@
+"""Fit farm for yield fits
+
+Yield fit scripts used to build a RooDataSet from the full TChain for
+every fit (CopyTree with the selection, then import) and run the fits
+one after another. In the fit farm mode
+- each selection is applied once and the selected entries with only
+  the columns needed by the fits are stored in a compact ROOT file
+  (DatasetCache). Later runs with the same input files, selection and
+  columns reuse the file.
+- independent fits (per era, channel, bin, ...) run in a pool of
+  forked worker processes (run_fits). Each fit gets a fresh process
+  with an optional address space limit, so memory is bounded per
+  worker and returned to the system after each fit. Fits that fail
+  or whose worker dies are reported and don't stop the other fits.
+
+Usage:
+    cache = fit_farm.DatasetCache()
+    path = cache.get("bupsikData", patterns, selection, ["m", "chan"])
+    for task, result in fit_farm.run_fits(tasks, fit_function, n_workers=4):
+        ...
+    fit_farm.print_usage(start_time)
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import time
+import traceback
+import ROOT
+from histogram_booking import translate, get_branch_counters
+
+cache_dir = "results/fit_datasets"
+
+
+class DatasetCache(object):
+    """Selected entries of TChains with only the requested columns"""
+
+    def __init__(self, directory=cache_dir, verbose=True):
+        self.directory = directory
+        self.verbose = verbose
+
+    def _input_files(self, chain):
+        files = []
+        for f in chain.GetListOfFiles():
+            name = f.GetTitle()
+            try:
+                info = os.stat(re.sub(r"^.*?/eos/", "/eos/", name))
+                files.append([name, info.st_size, info.st_mtime])
+            except OSError:
+                files.append([name, None, None])
+        return files
+
+    def get(self, tree_name, patterns, selection, columns):
+        """Path of a ROOT file with the selected entries
+
+        The tree in the file has the same name as the input tree.
+        """
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        chain = ROOT.TChain(tree_name)
+        for pattern in patterns:
+            chain.Add(pattern)
+        columns = sorted(set(columns))
+        info = json.dumps([tree_name, self._input_files(chain), selection, columns],
+                          sort_keys=True)
+        key = hashlib.md5(info.encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, "%s_%s.root" % (tree_name, key))
+        if os.path.exists(path):
+            if self.verbose:
+                print("Use cached dataset %s" % path)
+            return path
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        t0 = time.time()
+        df = ROOT.RDataFrame(chain)
+        if selection.strip() != "":
+            code = translate(selection, get_branch_counters(chain))[0]
+            df = df.Filter("(%s) != 0" % code)
+        tmp_path = "%s.tmp%u" % (path, os.getpid())
+        branches = ROOT.std.vector('string')(columns)
+        snapshot = df.Snapshot(tree_name, tmp_path, branches)
+        n = snapshot.Count().GetValue()
+        os.rename(tmp_path, path)
+        if self.verbose:
+            print("Cached %u of %u entries of %s in %s (%0.1f sec, %0.1f MB)" %
+                  (n, chain.GetEntries(), tree_name, path, time.time() - t0,
+                   os.path.getsize(path) / 1e6))
+        return path
+
+
+def cached_chain(tree_name, path):
+    chain = ROOT.TChain(tree_name)
+    chain.Add(path)
+    return chain
+
+
+def _init_worker(memory_limit):
+    if memory_limit != None:
+        limit = int(memory_limit * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _run_in_worker(function, task, memory_limit, connection):
+    """Run a fit and send (status, result or traceback, peak RSS) back"""
+    try:
+        _init_worker(memory_limit)
+        result = function(task)
+        sys.stdout.flush()
+        connection.send((True, result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    except:
+        sys.stdout.flush()
+        connection.send((False, traceback.format_exc(), None))
+    connection.close()
+
+
+def run_fits(tasks, function, n_workers=4, memory_limit=None, poll_interval=0.1):
+    """Run function(task) for each task in forked worker processes
+
+    Tasks are tuples starting with a name used in the printout. Each
+    task is processed in a fresh process. memory_limit is the
+    maximal address space of a worker in MB. It includes ROOT
+    libraries, so it should be well above the expected RSS. Results
+    are yielded as (task, result) as soon as they are available.
+    Failed fits, including workers killed by a signal or by the memory
+    limit, are reported and the remaining fits continue. An exception
+    listing them is raised once all other fits are done.
+    """
+    print("Running %u fits with %u workers" % (len(tasks), n_workers))
+    sys.stdout.flush()
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+    pending = list(tasks)
+    running = []
+    failures = []
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < n_workers:
+                task = pending.pop(0)
+                receiver, sender = context.Pipe(False)
+                process = context.Process(target=_run_in_worker,
+                                          args=(function, task, memory_limit, sender))
+                process.start()
+                sender.close()
+                running.append((task, process, receiver))
+
+            finished = []
+            for entry in running:
+                task, process, receiver = entry
+                if receiver.poll():
+                    try:
+                        finished.append((entry, receiver.recv()))
+                    except EOFError:
+                        finished.append((entry, (False, None, None)))
+                elif not process.is_alive():
+                    finished.append((entry, (False, None, None)))
+            if len(finished) == 0:
+                time.sleep(poll_interval)
+
+            for entry, (status, value, max_rss) in finished:
+                task, process, receiver = entry
+                running.remove(entry)
+                process.join()
+                receiver.close()
+                if status:
+                    print("Finished %s, peak RSS %0.0f MB" % (task[0], max_rss / 1024.))
+                    yield task, value
+                elif value == None:
+                    print("Failed %s: worker died with exit code %s" % (task[0], process.exitcode))
+                    failures.append(task[0])
+                else:
+                    print("Failed %s:\n%s" % (task[0], value))
+                    failures.append(task[0])
+                sys.stdout.flush()
+    finally:
+        for task, process, receiver in running:
+            process.terminate()
+            process.join()
+    if len(failures) > 0:
+        raise Exception("%u of %u fits failed: %s" % (len(failures), len(tasks), ", ".join(failures)))
+
+
+def print_usage(start_time):
+    """Print wall time and peak RSS of this process and its children"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.
+    print("Total wall time: %0.1f sec, peak RSS: %0.0f MB (main), %0.0f MB (largest child)" %
+          (time.time() - start_time, rss, rss_children))
@@ -0,0 +1,348 @@
+"""Single pass histogram filling for validation studies
+
+Validation scripts used to call TTree::Draw once per histogram, which
+reads the same chain again for every numerator and denominator. With
+HistogramBooker all histograms of a chain are booked first, using the
+same variable and selection expressions as TTree::Draw, and filled
+together in one RDataFrame event loop.
+
+Expressions are translated into C++ with the TTree::Draw conventions
+used in the scripts:
+- array branches without an index loop over their elements, ex. mm_kin_mass
+- arrays can be indexed by other arrays, ex. Muon_pt[mm_mu1_index]
+- a histogram is filled once for every element passing the selection
+  and the value of the selection is used as weight, ex. (cut)*prescale
+- out of range indices give 0
+
+Expressions that cannot be translated (for example with Sum$ like
+functions) are filled with TTree::Draw as before.
+
+Filled histograms are cached in a ROOT file next to results/summary.json.
+The cache key includes the expressions, the binning and the input files
+with their sizes, so changes of any of them trigger a new event loop.
+
+Usage:
+    booker = HistogramBooker(chain)
+    h_all = ROOT.TH1F("h_all", "", 40, 0, 20)
+    booker.book(h_all, "Muon_pt[mm_mu1_index]", cut)
+    booker.book(h_trig, "Muon_pt[mm_mu1_index]", cut + "&&" + trigger)
+    booker.run()
+"""
+import hashlib
+import json
+import os
+import re
+import time
+import ROOT
+
+cache_file = "results/histograms.root"
+
+# identifiers that are not branches, but can be used in expressions
+functions = {
+    'abs': 'std::abs', 'fabs': 'std::abs', 'sqrt': 'std::sqrt', 'pow': 'std::pow',
+    'exp': 'std::exp', 'log': 'std::log', 'log10': 'std::log10',
+    'sin': 'std::sin', 'cos': 'std::cos', 'tan': 'std::tan',
+    'asin': 'std::asin', 'acos': 'std::acos', 'atan': 'std::atan', 'atan2': 'std::atan2',
+    'min': 'std::min<double>', 'max': 'std::max<double>',
+    'true': 'true', 'false': 'false', 'TMath': 'TMath',
+}
+
+token_re = re.compile(r"(\s*)(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|(::)|([A-Za-z_]\w*\$?)|(.))")
+
+_declared = False
+
+def _declare_helpers():
+    global _declared
+    if _declared:
+        return
+    ROOT.gInterpreter.Declare("""
+    #include <cmath>
+    #include <vector>
+    #include "ROOT/RVec.hxx"
+    namespace histogram_booking {
+        template <typename T>
+        T at(const ROOT::RVec<T> &v, long i) {
+            return (i >= 0 && i < (long)v.size()) ? v[i] : T();
+        }
+    }
+    """)
+    _declared = True
+
+
+class TranslationError(Exception):
+    pass
+
+
+def get_branch_counters(chain):
+    """Map between branch names and their counter branches"""
+    branches = dict()
+    for br in chain.GetListOfBranches():
+        name = br.GetName()
+        leaf = br.GetLeaf(name)
+        if leaf and leaf.GetLeafCount():
+            branches[name] = leaf.GetLeafCount().GetName()
+        elif leaf and leaf.GetLenStatic() > 1:
+            branches[name] = str(leaf.GetLenStatic())
+        else:
+            branches[name] = ""
+    return branches
+
+
+def translate(expression, branches):
+    """Translate a TTree::Draw expression into C++ for element _i
+
+    Returns the C++ expression and the list of arrays that define the
+    number of elements.
+    """
+    if expression.strip() == "":
+        return "1", []
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        m = token_re.match(expression, pos)
+        if not m or m.end() == pos:
+            break
+        tokens.append(m.groups())
+        pos = m.end()
+    code = ""
+    loops = []
+    brackets = []
+    namespace = False
+    for i, (space, number, scope, name, other) in enumerate(tokens):
+        code += space
+        if number is not None:
+            code += number
+        elif scope is not None:
+            code += "::"
+            namespace = True
+            continue
+        elif name is not None:
+            followed_by_index = i + 1 < len(tokens) and tokens[i + 1][4] == '['
+            if namespace:
+                code += name
+            elif name.endswith('$'):
+                raise TranslationError("%s is not supported" % name)
+            elif name in branches:
+                if branches[name] == "":
+                    code += name
+                elif followed_by_index:
+                    code += "histogram_booking::at(%s, " % name
+                else:
+                    code += "histogram_booking::at(%s, _i)" % name
+                    if name not in loops:
+                        loops.append(name)
+            elif name in functions:
+                code += functions[name]
+            else:
+                raise TranslationError("unknown identifier %s" % name)
+        elif other == '[':
+            previous = tokens[i - 1][3] if i > 0 else None
+            if previous in branches and branches[previous] != "":
+                brackets.append(')')
+            else:
+                raise TranslationError("only array branches can be indexed")
+        elif other == ']':
+            if len(brackets) == 0:
+                raise TranslationError("unbalanced brackets")
+            code += brackets.pop()
+        elif other == '/':
+            # TTreeFormula computes in double precision
+            code += "/(double)"
+        else:
+            code += other
+        namespace = False
+    if pos != len(expression) or len(brackets) > 0:
+        raise TranslationError("cannot parse %s" % expression)
+    return code, loops
+
+
+def _split_varexp(varexp):
+    """Split y:x into its components ignoring ::"""
+    parts = re.split(r"(?<!:):(?!:)", varexp)
+    # TTree::Draw convention: y:x
+    return list(reversed(parts))
+
+
+class Booking(object):
+    def __init__(self, hist, varexp, selection):
+        self.hist = hist
+        self.varexp = varexp
+        self.selection = selection
+        self.key = None
+        self.result = None
+
+
+class HistogramBooker(object):
+    """Fill many histograms of a chain in one event loop"""
+
+    def __init__(self, chain, cache=cache_file, single_pass=True, verbose=True):
+        self.chain = chain
+        self.cache = cache
+        self.single_pass = single_pass
+        self.verbose = verbose
+        self.bookings = []
+        # wall time and bytes read by the event loops
+        self.time = 0
+        self.bytes_read = 0
+
+    def book(self, hist, varexp, selection=""):
+        """Book filling of hist, like chain.Draw("varexp>>hist", selection)
+
+        The histogram is filled by run(). The same object is returned.
+        """
+        if hist.GetDimension() != len(_split_varexp(varexp)):
+            raise Exception("Histogram %s doesn't match the number of variables in %s" %
+                            (hist.GetName(), varexp))
+        self.bookings.append(Booking(hist, varexp, selection))
+        return hist
+
+    def _input_files(self):
+        files = []
+        for f in self.chain.GetListOfFiles():
+            name = f.GetTitle()
+            try:
+                info = os.stat(re.sub(r"^.*?/eos/", "/eos/", name))
+                files.append([name, info.st_size, info.st_mtime])
+            except OSError:
+                files.append([name, None, None])
+        return files
+
+    def _hist_info(self, hist):
+        axes = []
+        for axis in [hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis()][:hist.GetDimension()]:
+            axes.append([axis.GetXmin(), axis.GetXmax(),
+                         [axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)]])
+        return [hist.ClassName(), axes]
+
+    def _set_keys(self, bookings):
+        files = self._input_files()
+        for b in bookings:
+            info = json.dumps([self.chain.GetName(), files, b.varexp, b.selection,
+                               self._hist_info(b.hist)], sort_keys=True)
+            b.key = "h_" + hashlib.md5(info.encode("utf-8")).hexdigest()
+
+    def _load_cached(self, pending):
+        if self.cache == None or not os.path.exists(self.cache):
+            return pending
+        remaining = []
+        f = ROOT.TFile.Open(self.cache)
+        for b in pending:
+            h = f.Get(b.key) if f else None
+            if h:
+                b.hist.Add(h)
+            else:
+                remaining.append(b)
+        if f:
+            f.Close()
+        if self.verbose and len(remaining) < len(pending):
+            print("Loaded %u histograms from %s" % (len(pending) - len(remaining), self.cache))
+        return remaining
+
+    def _save(self, bookings):
+        if self.cache == None or len(bookings) == 0:
+            return
+        directory = os.path.dirname(self.cache)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        f = ROOT.TFile.Open(self.cache, "update")
+        for b in bookings:
+            h = b.hist.Clone(b.key)
+            h.SetDirectory(f)
+            h.Write(b.key, ROOT.TObject.kOverwrite)
+        f.Close()
+
+    def _draw(self, b):
+        """Fill a histogram with TTree::Draw"""
+        name = "_booked_hist"
+        h = b.hist.Clone(name)
+        h.Reset()
+        h.SetDirectory(ROOT.gDirectory)
+        self.chain.Draw("%s>>%s" % (b.varexp, name), b.selection, "goff")
+        b.hist.Add(h)
+        h.Delete()
+
+    def _book_rdf(self, df, b, index, branches):
+        """Book histogram filling in the RDataFrame graph"""
+        variables = _split_varexp(b.varexp)
+        loops = []
+        values = []
+        for var in variables + [b.selection]:
+            code, arrays = translate(var, branches)
+            values.append(code)
+            loops += [a for a in arrays if a not in loops]
+        if len(loops) == 0:
+            n = "1"
+        elif len(loops) == 1:
+            n = "%s.size()" % loops[0]
+        else:
+            n = "std::min({%s})" % ", ".join("%s.size()" % a for a in loops)
+        # all values and the weight for each element passing the selection
+        body = "std::vector<ROOT::RVecD> _v(%u);\n" % len(values)
+        body += "const size_t _n = %s;\n" % n
+        body += "for (size_t _i = 0; _i < _n; ++_i) {\n"
+        body += "  const double _w = (%s);\n" % values[-1]
+        body += "  if (_w == 0) continue;\n"
+        for i, code in enumerate(values[:-1]):
+            body += "  _v[%u].push_back(%s);\n" % (i, code)
+        body += "  _v[%u].push_back(_w);\n" % (len(values) - 1)
+        body += "}\nreturn _v;"
+        column = "_booking%u" % index
+        df = df.Define(column, body)
+        columns = []
+        for i in range(len(values)):
+            df = df.Define("%s_%u" % (column, i), "%s[%u]" % (column, i))
+            columns.append("%s_%u" % (column, i))
+        h = b.hist
+        edges = []
+        for axis in [h.GetXaxis(), h.GetYaxis()][:h.GetDimension()]:
+            edges.append(ROOT.std.vector('double')([axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)]))
+        if h.GetDimension() == 1:
+            model = ROOT.RDF.TH1DModel(column, "", len(edges[0]) - 1, edges[0].data())
+            b.result = df.Histo1D(model, columns[0], columns[1])
+        else:
+            model = ROOT.RDF.TH2DModel(column, "", len(edges[0]) - 1, edges[0].data(),
+                                       len(edges[1]) - 1, edges[1].data())
+            b.result = df.Histo2D(model, columns[0], columns[1], columns[2])
+        return df
+
+    def run(self):
+        """Fill all booked histograms"""
+        bookings = self.bookings
+        self.bookings = []
+        if len(bookings) == 0:
+            return
+        self._set_keys(bookings)
+        pending = self._load_cached(bookings)
+        if len(pending) == 0:
+            return
+
+        t0 = time.time()
+        bytes0 = ROOT.TFile.GetFileBytesRead()
+        draw = pending
+        if self.single_pass:
+            _declare_helpers()
+            branches = get_branch_counters(self.chain)
+            df = ROOT.RDataFrame(self.chain)
+            draw = []
+            booked = []
+            for i, b in enumerate(pending):
+                try:
+                    self._book_rdf(df, b, i, branches)
+                    booked.append(b)
+                except TranslationError as e:
+                    if self.verbose:
+                        print("Use TTree::Draw for %s: %s" % (b.varexp, e))
+                    draw.append(b)
+            # the first result triggers the event loop for all of them
+            for b in booked:
+                b.hist.Add(b.result.GetValue())
+        for b in draw:
+            self._draw(b)
+        self.time += time.time() - t0
+        self.bytes_read += ROOT.TFile.GetFileBytesRead() - bytes0
+        if self.verbose:
+            print("Filled %u histograms of %s in %0.1f sec, %0.1f MB read" %
+                  (len(pending), self.chain.GetName(), time.time() - t0,
+                   (ROOT.TFile.GetFileBytesRead() - bytes0) / 1e6))
+        self._save(pending)
@@ -1,6 +1,7 @@
 import ROOT
 import glob
 import os
+from BmmScout.NanoAOD.gen_ancestry import GenAncestry
 
 # input_path = '/data/dmytro/Run3-Bmm-NanoAODv12/root-files/InclusiveDileptonMinBias.root'
 # input_path = '/tmp/dmytro/InclusiveDileptonMinBias.root'
@@ -48,126 +49,6 @@ def print_decay(event, gen_index, indent):
             if event.GenPart_genPartIdxMother[i] == gen_index:
                 print_decay(event, i, indent + "\t")
 
-def hadron_type(id):
-
-    digits = [int(digit) for digit in str(abs(id))]
-    
-    # Single b-quark
-    # mesons
-    if len(digits) >= 3 and digits[-3] == 5 and \
-       (len(digits) == 3 or digits[-4] == 0):
-        return "b-hadron"
-
-    # Single c-quark
-    # mesons
-    if len(digits) >= 3 and digits[-3] == 4 and \
-       (len(digits) == 3 or digits[-4] == 0):
-        return "c-hadron"
-
-    return None
-
-def is_DtoMuNuX_decay(event, p_id, p_index):
-    if hadron_type(p_id) != 'c-hadron':
-        return False
-    mu = 0
-    nu = 0
-    for gen_index in range(event.nGenPart):
-        if event.GenPart_genPartIdxMother[gen_index] == p_index:
-            id = event.GenPart_pdgId[gen_index]
-            if hadron_type(id) == 'c-hadron':
-                return is_DtoMuNuX_decay(event, id, gen_index)
-            if abs(id) == 13:
-                mu = id
-            if abs(id) == 14:
-                nu = id
-    if mu * nu == -13 * 14:
-        return True
-    return False
-
-def has_fake_muon(event, p_id, p_index):
-    mu = 0
-    nu = 0
-    for gen_index in range(event.nGenPart):
-        if event.GenPart_genPartIdxMother[gen_index] == p_index:
-            id = event.GenPart_pdgId[gen_index]
-            if abs(id) not in [13, 14]:
-                if has_fake_muon(event, id, gen_index):
-                    return True
-            if abs(id) == 13:
-                mu = id
-            if abs(id) == 14:
-                nu = id
-    if mu * nu == -13 * 14 and abs(p_id) in [211, 321]:
-        return True
-    return False
-
-def classify_event(event, ancestor, ancestor_index):
-
-    # No common ancestor
-    if ancestor == 0:
-        return "No common ancestor"
-
-    ancestor_type = hadron_type(ancestor)
-    
-    # Ks to pipi
-    if abs(ancestor) == 310:
-        signature = 1
-        for gen_index in range(event.nGenPart):
-            if event.GenPart_genPartIdxMother[gen_index] == ancestor_index:
-                signature *= event.GenPart_pdgId[gen_index]
-        if signature == -211 * 211:
-            return "KsToPiPi"
-
-    # B decay
-    if ancestor_type == "b-hadron":
-        mu = 0
-        nu = 0
-        n_charm_semileptonic = 0
-        n_fakes = 0
-        for gen_index in range(event.nGenPart):
-            if event.GenPart_genPartIdxMother[gen_index] == ancestor_index:
-                id = event.GenPart_pdgId[gen_index]
-                if abs(id) == 13:
-                    mu = id
-                if abs(id) == 14:
-                    nu = id
-                if is_DtoMuNuX_decay(event, id, gen_index):
-                    n_charm_semileptonic += 1
-                if has_fake_muon(event, id, gen_index):
-                    n_fakes += 1
-        if mu * nu == -13 * 14:
-            if n_charm_semileptonic == 1:
-                return "H_b to H_c mu nu, H_c to mu nu X"
-            if n_fakes == 1:
-                return "H_b to X mu nu, X contains decay in flight"
-        elif n_charm_semileptonic == 1:
-            return "H_b to H_c X, H_c to mu nu X'"
-        elif n_charm_semileptonic == 2:
-            return "H_b to H_c H_c', H_c to mu nu X"
-
-    # if ancestor_type == "b-hadron":
-    #     mu = 0
-    #     nu = 0
-    #     chadron = 0
-    #     for gen_index in range(event.nGenPart):
-    #         if event.GenPart_genPartIdxMother[gen_index] == ancestor_index:
-    #             id = event.GenPart_pdgId[gen_index]
-    #             if abs(id) == 13:
-    #                 mu = id
-    #             if abs(id) == 14:
-    #                 nu = id
-    #             if hadron_type(id) == "c-hadron":
-    #                 chadron = id
-    #     if mu * nu == -13 * 14 and chadron != 0:
-    #         return "H_b to H_c mu nu, H_c to mu nu X"
-
-    # D semi-leptonic
-    if is_DtoMuNuX_decay(event, ancestor, ancestor_index):
-        return "H_c to mu nu X"
-
-    return "Unclassified"
-
-
 skim_file_name = "/tmp/dmytro/ksmm_skim.root"
 
 if not os.path.exists(skim_file_name) or force_recreate:
@@ -210,6 +91,8 @@ processes = dict()
 
 # for event in chain:
 for event in events:
+    # decay history of the event is indexed once when needed
+    ancestry = None
     for mm_index in range(event.nmm):
         ## Selection
         if event.mm_kin_mass[mm_index] < 0.48 or event.mm_kin_mass[mm_index] > 0.60: continue
@@ -265,7 +148,9 @@ for event in events:
             
             ancestor = event.mm_gen_cpdgId[mm_index]
             ancestor_index = event.mm_gen_cindex[mm_index]
-            process = classify_event(event, ancestor, ancestor_index)
+            if ancestry is None:
+                ancestry = GenAncestry(event.GenPart_pdgId, event.GenPart_genPartIdxMother, event.nGenPart)
+            process = ancestry.classify(ancestor, ancestor_index)
             if process not in processes:
                 processes[process] = 0
             processes[process] += 1
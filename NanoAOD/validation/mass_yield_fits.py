@@ -1,10 +1,11 @@
-import os, re, copy, json
+import os, re, copy, json, time
 import ROOT
 import math 
 import tdrstyle
 from ROOT.RooFit import Binning
 from ROOT import RooRealVar
 from fwhm_calculator import compute_fwhm
+import fit_farm
 
 """
 BmmScout BstoJpsiPhi fit
@@ -22,6 +23,12 @@ results = dict()
 if os.path.exists(result_file):
     results = json.load(open(result_file))
     
+# Fit farm mode: selections are cached as compact datasets and
+# datasets are fitted in parallel worker processes
+use_fit_farm = True
+n_workers = 4
+memory_per_worker = 8000 # MB of address space, None - no limit
+
 # Silence RooFit info messages
 ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
 print_level = 0
@@ -229,8 +236,10 @@ def make_dataset(input_tree, name, mass_var, other_vars, cuts="", weight=""):
     
     # pre-filter tree to memory
     # ROOT.gROOT.cd()
-    ftmp = ROOT.TFile.Open("/tmp/dmytro/tmp.root","RECREATE")
-    tree = input_tree.CopyTree(cuts)
+    tree = input_tree
+    if cuts != "":
+        ftmp = ROOT.TFile.Open("/tmp/dmytro/tmp.root","RECREATE")
+        tree = input_tree.CopyTree(cuts)
     print("Nubmer of events after filter:", tree.GetEntries())
     
     var_set = ROOT.RooArgSet()
@@ -344,32 +353,25 @@ import cmsstyle as CMS
 CMS.SetExtraText("Preliminary")
 CMS.SetEnergy("13.6")
 
-for dataset, info in list(datasets.items()):
-    name = dataset
-    if name in results and not recompute_results:
-        print("Results are already available for %s. Skip" % name)
-        continue
-    
-    # min_mass = 5.20
-    # max_mass = 5.56
+# RooFit parallelization is not used when fits run in parallel
+num_cpu = 1 if use_fit_farm else 8
+
+def get_selection(info):
     min_mass = info["min_mass"]
     max_mass = info["max_mass"]
     selection = "m>%s && m<%s" % (min_mass, max_mass)
     if "trigger" in info:
         selection += " && %s>0" % (info['trigger'])
-    
-    print("Processing", name)
+    return selection
 
-    ## Get Data datasets
-    
-    chain_data = ROOT.TChain(info['data_tree'])
-    for pattern in info['data']:
-        print(pattern)
-        chain_data.Add(pattern)
+def fit_dataset(name, info, chain_data, selection, n_entries):
+    """Fit the mass distribution and return the signal yield
 
-    print("Number of Data events:", chain_data.GetEntries())
-    if chain_data.GetEntries() == 0:
-        raise Exception("No Data events found for for " + name)
+    n_entries is the number of entries in the input chain before the
+    selection. It's used to initialize the yields.
+    """
+    min_mass = info["min_mass"]
+    max_mass = info["max_mass"]
 
     nbins = info["nbins"]
 
@@ -385,15 +387,15 @@ for dataset, info in list(datasets.items()):
     model = ws.pdf("model")
 
     # prefit
-    ws.var("Nsig").setVal(chain_data.GetEntries() * 0.9)
-    ws.var("Nbkg").setVal(chain_data.GetEntries() * 0.1)
+    ws.var("Nsig").setVal(n_entries * 0.9)
+    ws.var("Nbkg").setVal(n_entries * 0.1)
     ws.var("sig_G2_fract").setVal(0.0)
     ws.var("sig_G2_fract").setConstant(True)
     ws.var("sig_G2_scale").setConstant(True)
     ws.var("sig_G3_fract").setVal(0.0)
     ws.var("sig_G3_fract").setConstant(True)
     ws.var("sig_G3_scale").setConstant(True)
-    model.fitTo(ds_data,  ROOT.RooFit.NumCPU(8),
+    model.fitTo(ds_data,  ROOT.RooFit.NumCPU(num_cpu),
                 ROOT.RooFit.Extended(ROOT.kTRUE), ROOT.RooFit.Minos(ROOT.kFALSE),
                 ROOT.RooFit.PrintLevel(print_level))
 
@@ -402,7 +404,7 @@ for dataset, info in list(datasets.items()):
     ws.var("sig_G2_scale").setConstant(False)
     ws.var("sig_G3_fract").setConstant(False)
     ws.var("sig_G3_scale").setConstant(False)
-    model.fitTo(ds_data,  ROOT.RooFit.NumCPU(8),
+    model.fitTo(ds_data,  ROOT.RooFit.NumCPU(num_cpu),
                 ROOT.RooFit.Extended(ROOT.kTRUE), ROOT.RooFit.Minos(ROOT.kFALSE),
                 ROOT.RooFit.PrintLevel(print_level))
     
@@ -451,13 +453,50 @@ for dataset, info in list(datasets.items()):
 
     ## Store results
     # {"2016BF": {"val": 305019.3, "err": 1167.6},
-    results[name] = {"val": ws.var("Nsig").getVal(), "err": ws.var("Nsig").getError()}
+    return {"val": ws.var("Nsig").getVal(), "err": ws.var("Nsig").getError()}
 
-    # ws.Delete() # Cleanup
+
+def fit_cached_dataset(task):
+    name, path, n_entries = task
+    info = datasets[name]
+    return fit_dataset(name, info, fit_farm.cached_chain(info['data_tree'], path), "", n_entries)
+
+start_time = time.time()
+tasks = []
+for dataset, info in list(datasets.items()):
+    name = dataset
+    if name in results and not recompute_results:
+        print("Results are already available for %s. Skip" % name)
+        continue
+    
+    selection = get_selection(info)
+    
+    print("Processing", name)
+
+    ## Get Data datasets
+    
+    chain_data = ROOT.TChain(info['data_tree'])
+    for pattern in info['data']:
+        print(pattern)
+        chain_data.Add(pattern)
+
+    print("Number of Data events:", chain_data.GetEntries())
+    if chain_data.GetEntries() == 0:
+        raise Exception("No Data events found for for " + name)
+
+    if use_fit_farm:
+        path = fit_farm.DatasetCache().get(info['data_tree'], info['data'], selection, ["m"])
+        tasks.append((name, path, chain_data.GetEntries()))
+    else:
+        results[name] = fit_dataset(name, info, chain_data, selection, chain_data.GetEntries())
+
+if use_fit_farm:
+    for task, result in fit_farm.run_fits(tasks, fit_cached_dataset, n_workers, memory_per_worker):
+        results[task[0]] = result
+        json.dump(results, open(output_path + "/results.json", "w"))
 
 ## Save results
 json.dump(results, open(output_path + "/results.json", "w"))
     
 print(results)
-
-
+fit_farm.print_usage(start_time)
@@ -5,6 +5,8 @@ from ROOT import TChain, TFile
 from time import sleep
 import math 
 import warnings
+import numpy
+from histogram_booking import translate, get_branch_counters
 
 def make_dataset(tree, name, mass_var, other_vars, cuts=""):
     '''
@@ -100,12 +102,163 @@ def get_workspace_with_weights_for_jpsik(tree, name, mass_var, other_vars, cuts=
     s-weights for flat ntuples flat ntuples
     '''
     warnings.warn("get_workspace_with_weights_for_jpsik is deprecated and will be removed in the future. "
-                  "Use new_method instead.", DeprecationWarning)
+                  "Use compute_sweights instead.", DeprecationWarning)
 
     data = make_dataset(tree, name, mass_var, other_vars, cuts)
 
     return get_workspace_with_weights_for_bjpsik(data, mass_var, ref_hist)
 
+
+def range_selection(variables, cuts=""):
+    '''
+    Selection equivalent to importing the variables in a RooDataSet
+
+    Variable ranges are effectively cuts when a RooDataSet is built
+    from a tree, so they are added to the selection explicitly.
+    '''
+    selection = []
+    if cuts != "":
+        selection.append("(%s)" % cuts)
+    for var in variables:
+        if not var.InheritsFrom("RooRealVar"):
+            raise Exception("Only RooRealVar variables are supported, got %s" % var.GetName())
+        if var.hasMin():
+            selection.append("%s>=%r" % (var.GetName(), var.getMin()))
+        if var.hasMax():
+            selection.append("%s<=%r" % (var.GetName(), var.getMax()))
+    if len(selection) == 0:
+        return "1"
+    return " && ".join(selection)
+
+
+def candidate_index(run, event):
+    '''
+    Index of each candidate within its event
+
+    Candidates of the same event are stored next to each other in
+    flat ntuples.
+    '''
+    n = len(run)
+    if n == 0:
+        return numpy.zeros(0, dtype=numpy.int32)
+    first = numpy.ones(n, dtype=bool)
+    first[1:] = (run[1:] != run[:-1]) | (event[1:] != event[:-1])
+    starts = numpy.flatnonzero(first)
+    sizes = numpy.diff(numpy.append(starts, n))
+    return (numpy.arange(n) - numpy.repeat(starts, sizes)).astype(numpy.int32)
+
+
+def _make_mass_dataset(name, mass_var, values):
+    if hasattr(ROOT.RooDataSet, "from_numpy"):
+        return ROOT.RooDataSet.from_numpy({mass_var.GetName(): values}, [mass_var], name=name)
+    var_set = ROOT.RooArgSet(mass_var)
+    data = ROOT.RooDataSet(name, "", var_set)
+    for value in values:
+        mass_var.setVal(value)
+        data.add(var_set)
+    return data
+
+
+def _get_column(data, name):
+    if hasattr(data, "to_numpy"):
+        return numpy.asarray(data.to_numpy()[name])
+    return numpy.array([data.get(i).getRealValue(name) for i in range(data.numEntries())])
+
+
+def _write_columns(columns, tree_name, output):
+    directory = os.path.dirname(output)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory)
+    if hasattr(ROOT.RDF, "FromNumpy"):
+        df = ROOT.RDF.FromNumpy(columns)
+    else:
+        df = ROOT.RDF.MakeNumpyDataFrame(columns)
+    df.Snapshot(tree_name, output)
+
+
+def compute_sweights(tree, name, mass_var, other_vars, cuts="", ref_hist=None,
+                     output=None, run="evt_run", event="evt_event"):
+    '''
+    Fit the mass distribution once and store sWeights in a friend tree
+
+    Only the mass of the selected candidates is loaded in a RooDataSet
+    for the fit and the sPlot. The friend tree "sweights" has one entry
+    per entry of the input tree with the columns
+    - run, event and cand: key of the candidate (cand is the index of
+      the candidate in its event)
+    - selected: 1 if the candidate passes the cuts and the variable ranges
+    - Nsig_sw, Nbkg_sw: sWeights, 0 for candidates that are not selected
+    Entries are aligned with the input tree, so it can be used directly
+    with AddFriend.
+
+    Returns the workspace with the fit model and the mass dataset, and
+    the name of the friend tree file.
+    '''
+    if output == None:
+        output = "results/sweights_%s.root" % name
+
+    # one pass over the input to get the keys and the mass of the selected candidates
+    selection = range_selection(list(other_vars) + [mass_var],
+                                translate(cuts, get_branch_counters(tree))[0] if cuts != "" else "")
+    df = ROOT.RDataFrame(tree).Define("_selected", selection)
+    columns = df.AsNumpy([run, event, mass_var.GetName(), "_selected"])
+    selected = numpy.asarray(columns["_selected"]).astype(bool)
+    mass_values = numpy.asarray(columns[mass_var.GetName()], dtype=numpy.float64)[selected]
+    print("Input tree has ", len(selected), "entries. The derived dataset has ", len(mass_values))
+
+    data = _make_mass_dataset(name, mass_var, mass_values)
+    ws = get_workspace_with_weights_for_bjpsik(data, mass_var, ref_hist)
+
+    data = ws.data(name)
+    friend = {
+        'run':      numpy.asarray(columns[run]).astype(numpy.uint64),
+        'event':    numpy.asarray(columns[event]).astype(numpy.uint64),
+        'selected': selected.astype(numpy.int32),
+    }
+    friend['cand'] = candidate_index(friend['run'], friend['event'])
+    for yield_name in ["Nsig", "Nbkg"]:
+        weights = numpy.zeros(len(selected))
+        weights[selected] = _get_column(data, yield_name + "_sw")
+        friend[yield_name + "_sw"] = weights
+    _write_columns(friend, "sweights", output)
+
+    return ws, output
+
+
+def fill_projections(tree, variables, selection="", weight="", friend=None):
+    '''
+    Fill histograms of many variables in one pass over the tree
+
+    variables is a list of (RooRealVar, Binning) pairs. If a friend
+    tree file made by compute_sweights is given, its columns can be used
+    in the selection and the weight, ex. selection="selected",
+    weight="Nsig_sw". Returns a list of histograms in the same order.
+    '''
+    if friend != None:
+        tree.AddFriend("sweights", friend)
+    df = ROOT.RDataFrame(tree)
+    if selection != "":
+        df = df.Filter(selection)
+    results = []
+    for var, binning in variables:
+        nbins, xmin, xmax = binning.getInt(0), binning.getDouble(0), binning.getDouble(1)
+        model = ROOT.RDF.TH1DModel("h_%s" % var.GetName(), "", nbins, xmin, xmax)
+        if weight != "":
+            results.append(df.Histo1D(model, var.GetName(), weight))
+        else:
+            results.append(df.Histo1D(model, var.GetName()))
+    histograms = []
+    for (var, binning), result in zip(variables, results):
+        h = result.GetValue().Clone()
+        h.SetDirectory(0)
+        h.Sumw2()
+        h.GetXaxis().SetTitle(var.GetTitle())
+        h.GetYaxis().SetTitle("Events / ( %g )" % h.GetXaxis().GetBinWidth(1))
+        histograms.append(h)
+    if friend != None:
+        tree.RemoveFriend(tree.GetFriend("sweights"))
+    return histograms
+
 if __name__ == '__main__':
     tree = ROOT.TChain("mva")
     # tree.Add("/eos/cms/store/group/phys_bphys/bmm/BmmScout/PostProcessing/FlatNtuples/512/bmm_mva_jpsik/Charmonium+Run2018D-PromptReco-v2+MINIAOD/*.root")
@@ -24,6 +24,8 @@ import sys, os, subprocess, re, json
 import ROOT
 from math import *
 from tdrstyle import *
+from histogram_booking import HistogramBooker
+import trigger_object_weights
 from BmmScout.NanoAOD.selection import *
 from collections import Counter
 import numpy
@@ -35,6 +37,9 @@ import numpy
 # mode = "flat"
 mode = "nano"
 recompute_results = False
+# fill all histograms of a sample in one event loop. Set it to False
+# to fill them one by one with TTree::Draw
+single_pass = True
 
 path_skim1 = "/eos/cms/store/group/phys_bphys/bmm/BmmScout/PostProcessing/NanoAOD-skims/516/mm/"
 path_skim2 = "/eos/cms/store/group/phys_bphys/bmm/BmmScout/PostProcessing-NEW/NanoAOD-skims/518/trig/"
@@ -631,146 +636,43 @@ def apply_trigger_object_efficiency2D(chain, selection, filename):
 	
 	f_eff = ROOT.TFile("results/%s.root" % filename)
 
-	cut = convert(chain, selection)
-
-	# print cut
-
 	print "using", filename
 	h_name = re.sub("trigger_object_efficiency", "h2_eff", filename)
 	h2 = f_eff.Get(h_name)
 
-	n = 0
-	n_weighted = 0
-	events = dict()
-	for event in chain:
-		cut = cut.format(tree='event')
-		if not eval(cut): continue
-		
-		evt = "%u-%u" % (event.run, event.evt)
-		if evt in events: continue
-		n += 1
-		
-		events[evt] = 1
-			
-		mu1_pt = event.m1pt
-		if mu1_pt >= 20:
-			mu1_pt = 19.99
-		mu2_pt = event.m2pt
-		if mu2_pt >= 20:
-			mu2_pt = 19.99
-		
-		mu1_eff = h2.GetBinContent(h2.FindBin(mu1_pt, event.m1eta))
-		mu2_eff = h2.GetBinContent(h2.FindBin(mu2_pt, event.m2eta))
-
-		n_weighted += mu1_eff * mu2_eff
-		# if filename == 'trigger_object_efficiency_Run2017':
-		# 	print "mu1: %4.1f %4.1f eff: %4.2f mu2: %4.1f %4.1f eff: %4.2f" % (mu1_pt, event.m1eta, mu1_eff, mu2_pt, event.m2eta, mu2_eff)
+	# first candidate of each event weighted with the efficiency of both muons
+	n, n_weighted = trigger_object_weights.apply_efficiency2D(chain, selection, h2)
 	
 	print "Selected candidates:", n
 	print "Efficiency: %0.1f" % (100. * n_weighted/ n)
-	# print "Candidate multiplicity: %0.2f" % (float(n)/len(events))
 
 def apply_trigger_object_efficiency(chain, selection, filename):
 	if mode != "flat": return
 	
 	f_eff = ROOT.TFile("results/%s.root" % filename)
 
-	cut = convert(chain, selection)
-
-	# print cut
-
 	print "using", filename
 	name = re.sub("trigger_object_efficiency_", "", filename)
 	h_chan0 = f_eff.Get("h_eff_chan0_" + name)
 	h_chan1 = f_eff.Get("h_eff_chan1_" + name)
 
-	n = 0
-	n_weighted = 0
-	nbins = h_chan0.GetNbinsX()
-	event_counts = numpy.zeros((2*nbins, 2*nbins))
-	events = dict()
-	for event in chain:
-		cut = cut.format(tree='event')
-		if not eval(cut): continue
-		
-		evt = "%u-%u" % (event.run, event.evt)
-		if evt in events: continue
-		n += 1
-		
-		events[evt] = 1
-			
-		mu1_pt = event.m1pt
-		if mu1_pt >= 20:
-			mu1_pt = 19.99
-		mu2_pt = event.m2pt
-		if mu2_pt >= 20:
-			mu2_pt = 19.99
-
-		if abs(event.m1eta) < 0.7:
-			mu1_ch  = 0
-			mu1_bin = h_chan0.FindBin(mu1_pt)
-			mu1_eff = h_chan0.GetBinContent(mu1_bin)
-		else:
-			mu1_ch  = 1
-			mu1_bin = h_chan1.FindBin(mu1_pt)
-			mu1_eff = h_chan1.GetBinContent(mu1_bin)
-			
-		if abs(event.m2eta) < 0.7:
-			mu2_ch  = 0
-			mu2_bin = h_chan0.FindBin(mu2_pt)
-			mu2_eff = h_chan0.GetBinContent(mu2_bin)
-		else:
-			mu2_ch  = 1
-			mu2_bin = h_chan1.FindBin(mu2_pt)
-			mu2_eff = h_chan1.GetBinContent(mu2_bin)
-
-		event_counts[mu1_ch * nbins + mu1_bin - 1][mu2_ch * nbins + mu2_bin - 1] += 1
-
-		n_weighted += mu1_eff * mu2_eff
-		
-		# if filename == 'trigger_object_efficiency_Run2017':
-		# 	print "mu1: %4.1f %4.1f eff: %4.2f mu2: %4.1f %4.1f eff: %4.2f" % (mu1_pt, event.m1eta, mu1_eff, mu2_pt, event.m2eta, mu2_eff)
+	# first candidate of each event weighted with the efficiency of both
+	# muons, barrel (|eta|<0.7) and endcap muons use different maps
+	n, n_weighted, sum_rel_err2 = trigger_object_weights.apply_efficiency(chain, selection, h_chan0, h_chan1)
 	
 	print "Selected candidates:", n
-	
-	sum_rel_err2 = 0
-	h1 = None
-	h2 = None
-	for mu1 in range(2 * nbins):
-		if mu1 < nbins:
-			h1 = h_chan0
-			m1 = mu1
-		else:
-			h1 = h_chan1
-			m1 = mu1 - nbins
-			
-		for mu2 in range(2 * nbins):
-			# print "%2u %2u: %u" % (mu1, mu2, event_counts[mu1][mu2])
-			if event_counts[mu1][mu2] == 0: continue
-			
-			if mu2 < nbins:
-				h2 = h_chan0
-				m2 = mu2
-			else:
-				h2 = h_chan1
-				m2 = mu2 - nbins
-				
-			if mu1 == mu2:
-				sum_rel_err2 += pow(2 * h1.GetBinError(m1 + 1) / h1.GetBinContent(m1 + 1), 2)
-			else:
-				sum_rel_err2 += pow(h1.GetBinError(m1 + 1) / h1.GetBinContent(m1 + 1), 2)
-				sum_rel_err2 += pow(h2.GetBinError(m2 + 1) / h2.GetBinContent(m2 + 1), 2)
-			
 	print "Efficiency: %0.1f \pm %0.1f" % (100. * n_weighted/ n,
-										   100. * n_weighted/ n * sqrt(sum_rel_err2 / n)) 
-	# print "Candidate multiplicity: %0.2f" % (float(n)/len(events))
+										   100. * n_weighted/ n * sqrt(sum_rel_err2 / n))
 
 
 	
+## Book histograms of all studies, so that each sample is read only once
+bookers = dict()
+measurements = []
+
 for name, info in sorted(studies.items()):
-	print "\nProcessing", name
+	print "\nBooking", name
 	
-	chain = None
 	trigger = info['trigger']
 
 	for ch in range(2):
@@ -796,96 +698,109 @@ for name, info in sorted(studies.items()):
 			print "%s efficiency: %0.2f \pm %0.2f %%" % (trigger, 100. * results[study_name]['eff'], 100. * results[study_name]['eff_err'])
 			continue
 
-		if chain == None:
-			chain = load_data(info['samples'])
+		if info['samples'] not in bookers:
+			bookers[info['samples']] = HistogramBooker(load_data(info['samples']), single_pass=single_pass)
+		booker = bookers[info['samples']]
+		chain = booker.chain
 
 		prescale = ""
 		if hasattr(chain, 'prescale_%s' % trigger):
 			prescale = "*prescale_%s" % trigger
 
+		hists = dict()
 		if mode == "nano":
-			f = ROOT.TFile.Open('results/' + file_name + ".root", "recreate")
-			h_off = ROOT.TH1F("h_off","h_off", nbins, 0, nbins)
-			h_off.Sumw2()
-			chain.Draw("PV_npvsGood>>h_off", cut)
-			h_off.Write()
-			h_off.SetDirectory(0)
-
-			h_off_trig = ROOT.TH1F("h_off_trig","h_off_trig", nbins, 0, nbins)
-			h_off_trig.Sumw2()
-
-			chain.Draw("PV_npvsGood>>h_off_trig", "(%s)%s" % (cut + "&&" + trigger, prescale))
-			h_off_trig.Write()
-			h_off_trig.SetDirectory(0)
-			f.Close()
+			for h_name in ["h_off", "h_off_trig"]:
+				hists[h_name] = ROOT.TH1F("%s_%s" % (h_name, file_name), h_name, nbins, 0, nbins)
 		else:
-			h_off = ROOT.TH1F("h_off","h_off", nbins, 0, 100)
-			h_off.Sumw2()
-			chain.Draw("pt>>h_off", cut)
+			for h_name in ["h_off", "h_off_trig", "h_off_trig2", "h_off_trig3"]:
+				hists[h_name] = ROOT.TH1F("%s_%s" % (h_name, file_name), h_name, nbins, 0, 100)
+		for h in hists.values():
+			h.SetDirectory(0)
+			h.Sumw2()
 
-			h_off_trig = h_off.Clone("h_off_trig")
+		if mode == "nano":
+			booker.book(hists["h_off"], "PV_npvsGood", cut)
+			booker.book(hists["h_off_trig"], "PV_npvsGood", "(%s)%s" % (cut + "&&" + trigger, prescale))
+		else:
+			booker.book(hists["h_off"], "pt", cut)
+			booker.book(hists["h_off_trig"], "pt", "(%s)%s" % (cut + "&&" + trigger, prescale))
+			booker.book(hists["h_off_trig2"], "pt", cut + "&& m1_hlt_pt>0 && m2_hlt_pt>0")
+			booker.book(hists["h_off_trig3"], "pt", "(%s)%s" % (cut + "&& m1_hlt_pt>0 && m2_hlt_pt>0 &&" + trigger, prescale))
 
-			chain.Draw("pt>>h_off_trig", "(%s)%s" % (cut + "&&" + trigger, prescale))
+		measurements.append((info, study_name, file_name, cut, chain, hists))
+			
+		if not split_channels:
+			break
 
-			h_off_trig2 = h_off.Clone("h_off_trig2")
+## Fill histograms in one pass per sample
+for booker in bookers.values():
+	booker.run()
 
-			chain.Draw("pt>>h_off_trig2", cut + "&& m1_hlt_pt>0 && m2_hlt_pt>0")
-			
-			h_off_trig3 = h_off.Clone("h_off_trig3")
+print "\nHistogram filling: %0.1f sec, %0.1f MB read" % (sum(b.time for b in bookers.values()),
+	sum(b.bytes_read for b in bookers.values()) / 1e6)
 
-			chain.Draw("pt>>h_off_trig3", "(%s)%s" % (cut + "&& m1_hlt_pt>0 && m2_hlt_pt>0 &&" + trigger, prescale))
+## Compute efficiencies
+for info, study_name, file_name, cut, chain, hists in measurements:
+	print "\nProcessing", study_name
 
-		if h_off_trig.Integral(0,nbins + 1) > 2 * h_off_trig.GetEntries():
-			# prescaled case - use standard error estimation
-			
-			err_off = ROOT.Double(0)
-			n_off = h_off.IntegralAndError(0, nbins + 1, err_off)
+	trigger = info['trigger']
+	h_off = hists["h_off"]
+	h_off_trig = hists["h_off_trig"]
 
-			err_off_trig = ROOT.Double(0)
-			n_off_trig = h_off_trig.IntegralAndError(0, nbins + 1, err_off_trig)
+	if mode == "nano":
+		f = ROOT.TFile.Open('results/' + file_name + ".root", "recreate")
+		h_off.Write("h_off")
+		h_off_trig.Write("h_off_trig")
+		f.Close()
 
-			eff = float(n_off_trig) / n_off
-			eff_err = eff * sqrt((err_off/n_off)**2 + (err_off_trig/n_off_trig)**2)
-		else:
-			# unprescaled case - use binomial error estimation
+	if h_off_trig.Integral(0,nbins + 1) > 2 * h_off_trig.GetEntries():
+		# prescaled case - use standard error estimation
+		
+		err_off = ROOT.Double(0)
+		n_off = h_off.IntegralAndError(0, nbins + 1, err_off)
 
-			n_off = h_off.Integral(0, nbins + 1)
-			n_off_trig = h_off_trig.Integral(0, nbins + 1)
+		err_off_trig = ROOT.Double(0)
+		n_off_trig = h_off_trig.IntegralAndError(0, nbins + 1, err_off_trig)
 
-			eff = float(n_off_trig) / n_off
-			eff_err = sqrt(eff * (1 - eff) / n_off)
-			
-		print "%s efficiency: %0.2f \pm %0.2f %%" % (trigger, 100. * eff, 100. * eff_err)
-
-		# err_off_trig2 = ROOT.Double(0)
-		# n_off_trig2 = h_off_trig2.IntegralAndError(0, nbins + 1, err_off_trig2)
-
-		# err_off_trig3 = ROOT.Double(0)
-		# n_off_trig3 = h_off_trig3.IntegralAndError(0, nbins + 1, err_off_trig3)
-
-		# eff2 = float(n_off_trig2) / n_off
-		# eff_err2 = eff2 * sqrt((err_off/n_off)**2 + (err_off_trig2/n_off_trig)**2)
-		# print "%s efficiency: %0.1f +/- %0.1f %%" % ("m1_hlt_pt>0 && m2_hlt_pt>0",
-		# 											 100. * eff2,
-		# 											 100. * eff_err2)
-
-		# eff3 = float(n_off_trig3) / n_off
-		# eff_err3 = eff3 * sqrt((err_off/n_off)**2 + (err_off_trig3/n_off_trig)**2)
-		# print "%s efficiency: %0.1f +/- %0.1f %%" % ("m1_hlt_pt>0 && m2_hlt_pt>0 && " + trigger,
-		# 											 100. * eff3,
-		# 											 100. * eff_err3)
-
-		if 'efficiency' in info:
-			for to_eff in info['efficiency']:
-				apply_trigger_object_efficiency(chain, cut, to_eff)
-
-		results[study_name] = {
-			'eff':eff,
-			'eff_err':eff_err
-		}
-			
-		if not split_channels:
-			break
+		eff = float(n_off_trig) / n_off
+		eff_err = eff * sqrt((err_off/n_off)**2 + (err_off_trig/n_off_trig)**2)
+	else:
+		# unprescaled case - use binomial error estimation
+
+		n_off = h_off.Integral(0, nbins + 1)
+		n_off_trig = h_off_trig.Integral(0, nbins + 1)
+
+		eff = float(n_off_trig) / n_off
+		eff_err = sqrt(eff * (1 - eff) / n_off)
+		
+	print "%s efficiency: %0.2f \pm %0.2f %%" % (trigger, 100. * eff, 100. * eff_err)
+
+	# err_off_trig2 = ROOT.Double(0)
+	# n_off_trig2 = h_off_trig2.IntegralAndError(0, nbins + 1, err_off_trig2)
+
+	# err_off_trig3 = ROOT.Double(0)
+	# n_off_trig3 = h_off_trig3.IntegralAndError(0, nbins + 1, err_off_trig3)
+
+	# eff2 = float(n_off_trig2) / n_off
+	# eff_err2 = eff2 * sqrt((err_off/n_off)**2 + (err_off_trig2/n_off_trig)**2)
+	# print "%s efficiency: %0.1f +/- %0.1f %%" % ("m1_hlt_pt>0 && m2_hlt_pt>0",
+	# 											 100. * eff2,
+	# 											 100. * eff_err2)
+
+	# eff3 = float(n_off_trig3) / n_off
+	# eff_err3 = eff3 * sqrt((err_off/n_off)**2 + (err_off_trig3/n_off_trig)**2)
+	# print "%s efficiency: %0.1f +/- %0.1f %%" % ("m1_hlt_pt>0 && m2_hlt_pt>0 && " + trigger,
+	# 											 100. * eff3,
+	# 											 100. * eff_err3)
+
+	if 'efficiency' in info:
+		for to_eff in info['efficiency']:
+			apply_trigger_object_efficiency(chain, cut, to_eff)
+
+	results[study_name] = {
+		'eff':eff,
+		'eff_err':eff_err
+	}
 
 ## Save results
 json.dump(results, open(output, 'w'))
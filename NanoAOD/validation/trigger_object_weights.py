@@ -0,0 +1,211 @@
+"""Trigger object efficiency weights for flat ntuples
+
+The trigger efficiency studies estimate the efficiency of a selection
+by weighting each selected event with the product of the trigger
+object efficiencies of its muons. This used to be done in a PyROOT
+event loop evaluating the selection with eval and looking up each muon
+with FindBin.
+
+Here the efficiency maps are loaded once into NumPy arrays and the
+weights are computed for all selected candidates at once:
+- the selection is applied with an RDataFrame Filter and the needed
+  columns are read with AsNumpy
+- only the first candidate of each event (run, evt) is used
+- muon pt is clamped to 19.99 GeV like before
+- bins are found with searchsorted following TH1::FindBin conventions
+  (low edge inclusive, underflow 0, overflow nbins+1)
+
+Weighted yields and uncertainties are the same as with the event loop.
+To compare both on a local flat ntuple use
+    python3 trigger_object_weights.py flat.root "cut" results/trigger_object_efficiency_X.root
+"""
+import re
+import sys
+import time
+import numpy
+import ROOT
+from histogram_booking import translate, get_branch_counters, TranslationError
+
+pt_max = 19.99
+barrel_eta = 0.7
+columns = ['run', 'evt', 'm1pt', 'm1eta', 'm2pt', 'm2eta']
+
+
+def _axis_edges(axis):
+    return numpy.array([axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)])
+
+
+class EfficiencyMap(object):
+    """Bin contents and errors of a 1D or 2D efficiency histogram"""
+
+    def __init__(self, hist):
+        self.name = hist.GetName()
+        self.dimension = hist.GetDimension()
+        self.x_edges = _axis_edges(hist.GetXaxis())
+        nx = len(self.x_edges) + 1
+        if self.dimension == 1:
+            shape = (nx,)
+            bins = [(i,) for i in range(nx)]
+        else:
+            self.y_edges = _axis_edges(hist.GetYaxis())
+            ny = len(self.y_edges) + 1
+            shape = (nx, ny)
+            bins = [(i, j) for i in range(nx) for j in range(ny)]
+        self.content = numpy.zeros(shape)
+        self.error = numpy.zeros(shape)
+        for b in bins:
+            self.content[b] = hist.GetBinContent(*b)
+            self.error[b] = hist.GetBinError(*b)
+
+    @property
+    def nbins(self):
+        return len(self.x_edges) - 1
+
+    def find_bin(self, x, y=None):
+        """Bin indices like TH1::FindBin, including under- and overflow"""
+        bx = numpy.searchsorted(self.x_edges, x, side='right')
+        if self.dimension == 1:
+            return bx
+        return bx, numpy.searchsorted(self.y_edges, y, side='right')
+
+    def value(self, x, y=None):
+        if self.dimension == 1:
+            return self.content[self.find_bin(x)]
+        return self.content[self.find_bin(x, y)]
+
+
+def read_candidates(chain, selection):
+    """Muon kinematics of the first selected candidate of each event"""
+    code, loops = translate(selection, get_branch_counters(chain))
+    if len(loops) > 0:
+        raise TranslationError("array branches are not supported: %s" % ", ".join(loops))
+    # implicit multi-threading would change the order of candidates
+    df = ROOT.RDataFrame(chain).Filter("(%s) != 0" % code)
+    data = df.AsNumpy(columns)
+    data = dict((c, numpy.asarray(data[c])) for c in columns)
+    keys = numpy.stack([data['run'].astype(numpy.uint64),
+                        data['evt'].astype(numpy.uint64)], axis=1)
+    if len(keys) == 0:
+        return data
+    first = numpy.sort(numpy.unique(keys, axis=0, return_index=True)[1])
+    return dict((c, data[c][first]) for c in columns)
+
+
+def _clamp(pt):
+    return numpy.where(pt >= 20, pt_max, pt)
+
+
+def channel_weights(data, h_chan0, h_chan1):
+    """Per candidate weights with efficiency maps for barrel and endcap muons
+
+    Returns the weights and the indices of the muon bins in the
+    combined (channel, pt bin) numbering used by the error estimate.
+    """
+    maps = [EfficiencyMap(h_chan0), EfficiencyMap(h_chan1)]
+    nbins = maps[0].nbins
+    weights = numpy.ones(len(data['run']))
+    indices = []
+    for mu in ['m1', 'm2']:
+        pt = _clamp(data[mu + 'pt'])
+        channel = (numpy.abs(data[mu + 'eta']) >= barrel_eta).astype(int)
+        bins = numpy.where(channel == 0, maps[0].find_bin(pt), maps[1].find_bin(pt))
+        weights *= numpy.where(channel == 0, maps[0].content[bins], maps[1].content[bins])
+        indices.append(channel * nbins + bins - 1)
+    return weights, indices
+
+
+def relative_error2(h_chan0, h_chan1, indices):
+    """Sum of squared relative errors over populated bin combinations"""
+    rel = []
+    for h in [EfficiencyMap(h_chan0), EfficiencyMap(h_chan1)]:
+        rel.append(h.error[1:-1] / h.content[1:-1])
+    rel = numpy.concatenate(rel)
+    nbins = len(rel)
+    event_counts = numpy.zeros((nbins, nbins))
+    numpy.add.at(event_counts, (indices[0], indices[1]), 1)
+    mu1, mu2 = numpy.nonzero(event_counts)
+    same = mu1 == mu2
+    return (numpy.sum((2 * rel[mu1[same]]) ** 2) +
+            numpy.sum(rel[mu1[~same]] ** 2 + rel[mu2[~same]] ** 2))
+
+
+def apply_efficiency(chain, selection, h_chan0, h_chan1):
+    """Number of selected events, their weighted sum and sum of relative errors squared"""
+    data = read_candidates(chain, selection)
+    weights, indices = channel_weights(data, h_chan0, h_chan1)
+    return len(weights), numpy.sum(weights), relative_error2(h_chan0, h_chan1, indices)
+
+
+def apply_efficiency2D(chain, selection, h2):
+    """Number of selected events and their weighted sum with a pt-eta map"""
+    data = read_candidates(chain, selection)
+    h = EfficiencyMap(h2)
+    weights = (h.value(_clamp(data['m1pt']), data['m1eta']) *
+               h.value(_clamp(data['m2pt']), data['m2eta']))
+    return len(weights), numpy.sum(weights)
+
+
+def apply_efficiency_loop(chain, selection, h_chan0, h_chan1):
+    """Reference implementation with the PyROOT event loop"""
+    from BmmScout.NanoAOD.selection import convert
+    cut = convert(chain, selection).format(tree='event')
+    nbins = h_chan0.GetNbinsX()
+    event_counts = numpy.zeros((2 * nbins, 2 * nbins))
+    events = dict()
+    n_weighted = 0
+    for event in chain:
+        if not eval(cut): continue
+        evt = "%u-%u" % (event.run, event.evt)
+        if evt in events: continue
+        events[evt] = 1
+        bins = []
+        for pt, eta in [(event.m1pt, event.m1eta), (event.m2pt, event.m2eta)]:
+            if pt >= 20:
+                pt = pt_max
+            ch = 0 if abs(eta) < barrel_eta else 1
+            h = h_chan0 if ch == 0 else h_chan1
+            b = h.FindBin(pt)
+            eff = h.GetBinContent(b)
+            bins.append((ch * nbins + b - 1, eff))
+        event_counts[bins[0][0]][bins[1][0]] += 1
+        n_weighted += bins[0][1] * bins[1][1]
+    sum_rel_err2 = 0
+    for mu1 in range(2 * nbins):
+        h1 = h_chan0 if mu1 < nbins else h_chan1
+        m1 = mu1 % nbins
+        for mu2 in range(2 * nbins):
+            if event_counts[mu1][mu2] == 0: continue
+            h2 = h_chan0 if mu2 < nbins else h_chan1
+            m2 = mu2 % nbins
+            if mu1 == mu2:
+                sum_rel_err2 += pow(2 * h1.GetBinError(m1 + 1) / h1.GetBinContent(m1 + 1), 2)
+            else:
+                sum_rel_err2 += pow(h1.GetBinError(m1 + 1) / h1.GetBinContent(m1 + 1), 2)
+                sum_rel_err2 += pow(h2.GetBinError(m2 + 1) / h2.GetBinContent(m2 + 1), 2)
+    return len(events), n_weighted, sum_rel_err2
+
+
+def benchmark(files, selection, eff_file):
+    """Compare yields and rates of the event loop and the columnar weights"""
+    chain = ROOT.TChain("mm")
+    for f in files:
+        chain.Add(f)
+    f_eff = ROOT.TFile(eff_file)
+    name = re.sub(r".*trigger_object_efficiency_(.*)\.root$", r"\1", eff_file)
+    h_chan0 = f_eff.Get("h_eff_chan0_" + name)
+    h_chan1 = f_eff.Get("h_eff_chan1_" + name)
+    n_entries = chain.GetEntries()
+    for label, method in [("event loop", apply_efficiency_loop),
+                          ("columnar", apply_efficiency)]:
+        t0 = time.time()
+        n, n_weighted, sum_rel_err2 = method(chain, selection, h_chan0, h_chan1)
+        dt = time.time() - t0
+        print("%-10s: %u selected, weighted %0.4f, rel err2 %0.6g, %0.2f sec, %0.0f entries/sec" %
+              (label, n, n_weighted, sum_rel_err2, dt, n_entries / dt))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: %s <flat ntuple files> <selection> <efficiency file>" % sys.argv[0])
+        sys.exit(1)
+    benchmark(sys.argv[1:-2], sys.argv[-2], sys.argv[-1])
@@ -8,6 +8,7 @@ the trigger efficiency.
 import os, sys, json
 import ROOT
 import tdrstyle
+from histogram_booking import HistogramBooker
 import numpy as np
 
 tdrstyle.setTDRStyle()
@@ -584,10 +585,19 @@ def draw_shades(h_eff, h_ref):
         
         h_shade.Draw("hist e0 same")
 
+bookers = dict()
+
+def get_booker(name):
+    if name not in bookers:
+        bookers[name] = HistogramBooker(get_data(name))
+    return bookers[name]
+
 def plot(study):
-    chain  = get_data(study['sample'])
+    """Book histograms of the study. Returns a function making the plots"""
+    booker = get_booker(study['sample'])
     name = '%s_%s_%s' % (study['sample'], study['selection'], study['trigger'])
-    
+
+    booked = []
     for var in study['variables']:
         var_name = "%s-%s" % (name, var)
         v = variables[var]
@@ -596,60 +606,72 @@ def plot(study):
         h_all.GetXaxis().SetTitle(v['title'])
         h_all.Sumw2()
         h_all.SetLineWidth(2)
-        chain.Draw("%s>>h_all_%s" % (v['var'], var_name), selections[study['selection']])
-
-        print_canvas("%s" % (var_name), output_path)
+        h_all.SetDirectory(0)
+        booker.book(h_all, v['var'], selections[study['selection']])
 
         h_trig = h_all.Clone("h_trig_%s" % var_name)
         weight = 1
         if 'prescale' in study:
             weight = study['prescale']
-        chain.Draw("%s>>h_trig_%s" % (v['var'], var_name), "(" + selections[study['selection']] + "&&" + study['trigger'] + ")*%s" % weight)
+        booker.book(h_trig, v['var'], "(" + selections[study['selection']] + "&&" + study['trigger'] + ")*%s" % weight)
+        booked.append((var_name, h_all, h_trig))
+
+    def make_plots():
+        for var_name, h_all, h_trig in booked:
+            h_all.Draw()
+            print_canvas("%s" % (var_name), output_path)
 
-        h_eff = h_trig.Clone("h_eff_%s" % var_name)
-        h_eff.Divide(h_trig, h_all, 1, 1, "B")
-        h_eff.SetMinimum(0)
-        h_eff.SetMaximum(1.1)
-        # h_eff.Draw("hist")
+            h_eff = h_trig.Clone("h_eff_%s" % var_name)
+            h_eff.Divide(h_trig, h_all, 1, 1, "B")
+            h_eff.SetMinimum(0)
+            h_eff.SetMaximum(1.1)
+            # h_eff.Draw("hist")
 
-        draw_shades(h_eff, h_all)
+            draw_shades(h_eff, h_all)
                     
-        print_canvas("%s_eff" % (var_name), output_path)
+            print_canvas("%s_eff" % (var_name), output_path)
 
-        h_all.SetDirectory(0)
-        hists["h_all_%s" % var_name] = h_all
-        hists["h_trig_%s" % var_name] = h_trig
-        hists["h_eff_%s" % var_name] = h_eff
+            hists["h_all_%s" % var_name] = h_all
+            hists["h_trig_%s" % var_name] = h_trig
+            hists["h_eff_%s" % var_name] = h_eff
+
+    return make_plots
 
 def measure_trigger_object_efficiency(study):
-    chain  = get_data(study['sample'])
+    """Book histograms of the study. Returns a function measuring efficiencies"""
+    booker = get_booker(study['sample'])
     name = '%s_%s_%s' % (study['sample'], study['selection'], study['trigger'])
 
     eta_bin_size = 0.5
     eta_bins = np.arange(-1.5, 1.5, eta_bin_size)
 
-    fout = ROOT.TFile.Open("results/%s.root" % name, "recreate")
-
+    booked = []
     for eta in eta_bins:
         for mu in ['mu1', 'mu2']:
             h_name = "h_all_%s_eta%s_%s" % (mu, eta, name)
             h_all = ROOT.TH1F(h_name, "", 32, 4, 20)
             h_all.Sumw2()
-            selection = selections[study['selection']] + "&& Muon_eta[mm_%s_index] > %s && Muon_eta[mm_%s_index] < %s" % (mu, eta, mu, eta + eta_bin_size) 
-            chain.Draw("%s>>%s" % ("Muon_pt[mm_%s_index]" % mu, h_name), selection)
-
-            print_canvas("%s" % (h_name), output_path)
             h_all.SetDirectory(0)
-            hists[h_name] = h_all
+            selection = selections[study['selection']] + "&& Muon_eta[mm_%s_index] > %s && Muon_eta[mm_%s_index] < %s" % (mu, eta, mu, eta + eta_bin_size) 
+            booker.book(h_all, "Muon_pt[mm_%s_index]" % mu, selection)
 
-            h_name = "h_trig_%s_eta%s_%s" % (mu, eta, name)
-            h_trig = h_all.Clone(h_name)
+            h_trig = h_all.Clone("h_trig_%s_eta%s_%s" % (mu, eta, name))
             weight = 1
             if 'prescale' in study:
                 weight = study['prescale']
-            chain.Draw("%s>>%s" % ("Muon_pt[mm_%s_index]" % mu, h_name), selection + "&& MuonId_hlt_pt[mm_%s_index]>0" % mu)
-            # print_canvas("%s" % (h_name), output_path)
-            hists[h_name] = h_trig
+            booker.book(h_trig, "Muon_pt[mm_%s_index]" % mu, selection + "&& MuonId_hlt_pt[mm_%s_index]>0" % mu)
+            booked.append((mu, eta, h_all, h_trig))
+
+    def measure():
+        fout = ROOT.TFile.Open("results/%s.root" % name, "recreate")
+
+        for mu, eta, h_all, h_trig in booked:
+            h_all.Draw()
+            print_canvas("%s" % (h_all.GetName()), output_path)
+            hists[h_all.GetName()] = h_all
+
+            # print_canvas("%s" % (h_trig.GetName()), output_path)
+            hists[h_trig.GetName()] = h_trig
 
             h_name = "h_eff_%s_eta%s_%s" % (mu, eta, name)
             h_eff = h_trig.Clone(h_name)
@@ -662,11 +684,11 @@ def measure_trigger_object_efficiency(study):
             # h_eff.SetDirectory(fout)
             fout.cd()
             h_eff.Write()
+            hists[h_name] = h_eff
         
-        
-        hists[h_name] = h_eff
-        
-    fout.Close()
+        fout.Close()
+
+    return measure
 
 def fit_efficiency(study):
     name = '%s_%s_%s' % (study['sample'], study['selection'], study['trigger'])
@@ -705,15 +727,24 @@ def fit_efficiency(study):
     fin.Close()
         
     
-for study in studies:
+# book histograms of all studies, fill them in one pass per sample and
+# then make plots, measurements and fits in the original order
+finish = dict()
+for i, study in enumerate(studies):
     if study['type'] == 'plot':
-        plot(study)
-        continue
+        finish[i] = plot(study)
     
     if study['type'] == 'efficiency':
-        measure_trigger_object_efficiency(study)
-        continue
+        finish[i] = measure_trigger_object_efficiency(study)
 
+for booker in bookers.values():
+    booker.run()
+
+for i, study in enumerate(studies):
+    if i in finish:
+        finish[i]()
+        continue
+    
     if study['type'] == 'fit':
         fit_efficiency(study)
         continue
@@ -37,6 +37,7 @@ import json
 import re
 import ROOT
 import tdrstyle
+from histogram_booking import HistogramBooker
 from array import array
 
 tdrstyle.setTDRStyle()
@@ -119,46 +120,64 @@ def print_canvas(output_name_without_extention, path, canvas=ROOT.gPad):
 
 hists = dict()
 
+bookers = dict()
+
+def get_booker(name):
+    if name not in bookers:
+        bookers[name] = HistogramBooker(get_data(name))
+    return bookers[name]
+
 def measure_trigger_object_efficiency(sample, suffix, preselection):
+    """Book histograms of the measurement. Returns a function making the plots"""
     chain  = get_data(sample)
-    if not chain: return
+    if not chain: return None
+    booker = get_booker(sample)
     name = sample + suffix
 
     eta_bins = split_range(-2.4, 2.4, samples[sample]['eta_step'])
 
-    fout = ROOT.TFile.Open("results/l1_turn-on_%s.root" % name, "recreate")
-
+    booked = []
     for (eta_min, eta_max) in eta_bins:
         h_name = f"h_all_eta{eta_min:+.1f}to{eta_max:+.1f}_{name}"
         h_all = ROOT.TH1F(h_name, "", 36, 2, 20)
         h_all.Sumw2()
+        h_all.SetDirectory(0)
         selection = f"Muon_eta > {eta_min} && Muon_eta < {eta_max}"
         if preselection != "":
             selection += "&&" + preselection
-        chain.Draw(f"Muon_pt>>{h_name}", selection)
-
-        print_canvas(h_name, output_path)
-        h_all.SetDirectory(0)
-        hists[h_name] = h_all
+        booker.book(h_all, "Muon_pt", selection)
 
         h_name = f"h_trig_eta{eta_min:+.1f}to{eta_max:+.1f}_{name}"
         h_trig = h_all.Clone(h_name)
-        chain.Draw(f"Muon_pt>>{h_name}", selection + "&& MuonId_l1_quality >= 12" ) # single muon quality
-        print_canvas("%s" % (h_name), output_path)
-        hists[h_name] = h_trig
-
-        h_name = f"h_eff_eta{eta_min:+.1f}to{eta_max:+.1f}_{name}"
-        h_eff = h_trig.Clone(h_name)
-        h_eff.Divide(h_trig, h_all, 1, 1, "B")
-        h_eff.SetMinimum(0)
-        h_eff.SetMaximum(1.1)
-        h_eff.Draw("hist")
-
-        print_canvas("%s" % (h_name), output_path)
+        booker.book(h_trig, "Muon_pt", selection + "&& MuonId_l1_quality >= 12") # single muon quality
+        booked.append((eta_min, eta_max, h_all, h_trig))
+
+    def make_plots():
+        fout = ROOT.TFile.Open("results/l1_turn-on_%s.root" % name, "recreate")
+
+        for eta_min, eta_max, h_all, h_trig in booked:
+            h_all.Draw()
+            print_canvas(h_all.GetName(), output_path)
+            hists[h_all.GetName()] = h_all
+
+            h_trig.Draw()
+            print_canvas("%s" % (h_trig.GetName()), output_path)
+            hists[h_trig.GetName()] = h_trig
+
+            h_name = f"h_eff_eta{eta_min:+.1f}to{eta_max:+.1f}_{name}"
+            h_eff = h_trig.Clone(h_name)
+            h_eff.Divide(h_trig, h_all, 1, 1, "B")
+            h_eff.SetMinimum(0)
+            h_eff.SetMaximum(1.1)
+            h_eff.Draw("hist")
+
+            print_canvas("%s" % (h_name), output_path)
         
-        hists[h_name] = h_eff
+            hists[h_name] = h_eff
         
-    fout.Close()
+        fout.Close()
+
+    return make_plots
 
 # # def _measure_trigger_object_efficiency_mm(chain, bin_name, name, eta_min, eta_max, preselection):
 # #     h_name = "h_all_%s_%s"    % (bin_name, name)
@@ -510,15 +529,23 @@ def measure_trigger_object_efficiency(sample, suffix, preselection):
         
 ROOT.gStyle.SetPaintTextFormat(".3f");
     
+# book all measurements first to fill them in one pass per sample
+measurements = []
 for sample in samples:
-
-    measure_trigger_object_efficiency(sample, "_base", "Muon_looseId&&Muon_isTracker&&Muon_isGlobal&&Muon_nStations>=2")
-    measure_trigger_object_efficiency(sample, "_loose", "Muon_looseId")
-    measure_trigger_object_efficiency(sample, "_medium", "Muon_mediumId")
-    measure_trigger_object_efficiency(sample, "_tight", "Muon_tightId")
+    measurements.append(measure_trigger_object_efficiency(sample, "_base", "Muon_looseId&&Muon_isTracker&&Muon_isGlobal&&Muon_nStations>=2"))
+    measurements.append(measure_trigger_object_efficiency(sample, "_loose", "Muon_looseId"))
+    measurements.append(measure_trigger_object_efficiency(sample, "_medium", "Muon_mediumId"))
+    measurements.append(measure_trigger_object_efficiency(sample, "_tight", "Muon_tightId"))
     # measure_trigger_object_efficiency(sample, "_looseFC", "Muon_looseId&&HLT_ZeroBias_FirstCollisionInTrain")
     # measure_trigger_object_efficiency(sample, "_looseDoubleMu4_3", "Muon_looseId&&HLT_DoubleMu4_3_LowMass")
 
+for booker in bookers.values():
+    booker.run()
+
+for make_plots in measurements:
+    if make_plots:
+        make_plots()
+
 # def make_overlay_plot(name, h1_name, name1, h2_name, name2):
 #     legend = ROOT.TLegend(0.70,0.65,0.85,0.77)
 #     legend.SetShadowColor(ROOT.kWhite)